@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class FliqConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'Fliq'
\ No newline at end of file
+    name = 'Fliq'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,148 @@
+"""
+Async versions of the catalog and cart views.
+
+Served instead of their counterparts in views.py when ASYNC_VIEWS is on,
+which the ASGI entry point (LaFliq/asgi.py) does by default. They render
+the same templates from the same caches, reading through the async ORM.
+
+Django's `condition` and `cache_control` decorators only wrap sync views
+in this version, so the async equivalent lives here. Anonymous visitors get
+the guest cart (guest_cart.py) rather than a login redirect. Each view first resolves the session and user (and, for catalog pages, the
+conditional GET validators) in a single thread hop; after that the lazy
+`request.user` is loaded and templates can be rendered on the event loop.
+"""
+from calendar import timegm
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.http import Http404
+from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import catalog_cache, views
+from .cart import add_item, asummarize_cart
+from .guest_cart import GuestCart
+from .models import Cart, Product
+from .pagination import apaginate, get_page_size
+
+
+def _load_user(request):
+    return request.user.is_authenticated
+
+
+def async_condition(etag_func, last_modified_func):
+    """
+    `@cache_control(no_cache=True)` plus `@condition(...)` for async views:
+    answers conditional GETs with 304 and sets ETag/Last-Modified otherwise.
+    """
+    def validators(request, *args, **kwargs):
+        _load_user(request)
+        return etag_func(request, *args, **kwargs), last_modified_func(request, *args, **kwargs)
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            etag, last_modified = None, None
+            if request.method in ('GET', 'HEAD'):
+                etag, last_modified = await sync_to_async(validators)(request, *args, **kwargs)
+                etag = quote_etag(etag) if etag else None
+                last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+            else:
+                await sync_to_async(_load_user)(request)
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD'):
+                if last_modified and not response.has_header('Last-Modified'):
+                    response.headers['Last-Modified'] = http_date(last_modified)
+                if etag:
+                    response.headers.setdefault('ETag', etag)
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+@async_condition(views._listing_etag, views._listing_last_modified)
+async def product_list(request):
+    categories = await catalog_cache.acategories()
+    category_slug = request.GET.get('category')
+    products = Product.objects.all()
+    if category_slug:
+        category = next((category for category in categories if category.slug == category_slug), None)
+        if category is None:
+            raise Http404('No such category')
+        products = products.filter(category_id=category.id)
+
+    sort = request.GET.get('sort')
+    if sort not in views.CATALOG_ORDERINGS:
+        sort = 'id'
+    page_size = get_page_size(request)
+    cursor, position = views.grid_cursor(request.GET.get('cursor'), views.CATALOG_ORDERINGS[sort])
+
+    query = {'sort': sort, 'page_size': page_size}
+    if category_slug:
+        query['category'] = category_slug
+
+    async def grid():
+        page = await apaginate(
+            products.only(*views.CATALOG_FIELDS), views.CATALOG_ORDERINGS[sort], cursor=cursor, page_size=page_size
+        )
+        return views.render_product_grid(page, query)
+
+    context = {
+        'grid': await catalog_cache.acached('grid', [category_slug, page_size] + position, grid, [catalog_cache.PRODUCTS]),
+        'categories': categories,
+        'current_category': category_slug,
+        'current_sort': sort,
+        'page_size': page_size,
+    }
+    return render(request, 'home.html', context)
+
+
+@async_condition(views._detail_etag, views._detail_last_modified)
+async def product_detail(request, product_id):
+    async def body():
+        try:
+            product = await Product.objects.select_related('category').aget(id=product_id)
+        except Product.DoesNotExist:
+            raise Http404('No Product matches the given query.')
+        return render_to_string('product_detail_body.html', {'product': product})
+
+    depends_on = [catalog_cache.CATEGORIES, catalog_cache.product_namespace(product_id)]
+    context = {
+        'body': await catalog_cache.acached('product', [product_id], body, depends_on),
+    }
+    return render(request, 'product_detail.html', context)
+
+
+async def cart_view(request):
+    if not await sync_to_async(_load_user)(request):
+        guest_cart = GuestCart.from_request(request)
+        summary = await guest_cart.asummarize()
+        return guest_cart.save(render(request, 'shopping_cart.html', summary.as_context()))
+    cart, _created = await Cart.objects.aget_or_create(user=request.user)
+    summary = await asummarize_cart(cart)
+    context = dict(summary.as_context(), cart=cart)
+    return render(request, 'shopping_cart.html', context)
+
+
+async def add_to_cart(request, product_id):
+    if not await Product.objects.filter(id=product_id).aexists():
+        raise Http404('No Product matches the given query.')
+    if not await sync_to_async(_load_user)(request):
+        guest_cart = GuestCart.from_request(request)
+        if guest_cart.add(product_id):
+            messages.success(request, 'Product added to cart.')
+        else:
+            messages.error(request, 'Your cart is full. Log in to add more products.')
+        return guest_cart.save(redirect('cart_view'))
+    cart, _created = await Cart.objects.aget_or_create(user=request.user)
+    # a raw upsert; the async ORM has no cursor API
+    await sync_to_async(add_item)(cart, product_id)
+    messages.success(request, 'Product added to cart.')
+    return redirect('cart_view')
@@ -0,0 +1,16 @@
+"""
+SQLite backend whose transactions take the write lock when they begin.
+
+Django starts transactions with a plain (deferred) BEGIN. A deferred
+transaction that reads and then writes, like a checkout reserving stock,
+has to upgrade its lock mid-way, and if another connection committed a
+write in between SQLite fails the upgrade with "database is locked" at
+once, without waiting out the busy timeout. BEGIN IMMEDIATE queues for the
+write lock up front instead, where the busy timeout applies.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -0,0 +1,157 @@
+"""
+Cart pricing and line updates.
+
+Line totals and the cart subtotal are computed in the database so rendering a
+cart costs a fixed number of queries regardless of how many lines it has.
+"""
+import decimal
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import Least
+
+from .models import Cart, CartItem
+
+TAX_RATE = Decimal('0.025')
+CENTS = Decimal('.01')
+
+LINE_TOTAL = ExpressionWrapper(
+    F('quantity') * F('product__price'),
+    output_field=DecimalField(max_digits=12, decimal_places=2),
+)
+
+
+def quantize(amount):
+    return amount.quantize(CENTS, rounding=decimal.ROUND_HALF_UP)
+
+
+class CartSummary:
+    """Priced view of a cart: its lines plus subtotal, tax and total"""
+
+    def __init__(self, items, subtotal):
+        self.items = items
+        self.subtotal = quantize(subtotal)
+        self.tax = quantize(self.subtotal * TAX_RATE)
+        self.total = quantize(self.subtotal + self.tax)
+
+    def as_context(self):
+        return {
+            'cart_items': self.items,
+            'subtotal': self.subtotal,
+            'tax': self.tax,
+            'total': self.total,
+        }
+
+
+def cart_lines(cart):
+    """Cart items with their product joined in and `line_total` annotated"""
+    return (
+        CartItem.objects.filter(cart=cart)
+        .select_related('product')
+        .annotate(line_total=LINE_TOTAL)
+        .order_by('id')
+    )
+
+
+def cart_subtotal(cart):
+    subtotal = CartItem.objects.filter(cart=cart).aggregate(subtotal=Sum(LINE_TOTAL))['subtotal']
+    return subtotal or Decimal('0')
+
+
+def summarize_cart(cart):
+    return CartSummary(list(cart_lines(cart)), cart_subtotal(cart))
+
+
+async def asummarize_cart(cart):
+    """`summarize_cart` with the async ORM"""
+    items = [item async for item in cart_lines(cart)]
+    subtotal = (await CartItem.objects.filter(cart=cart).aaggregate(subtotal=Sum(LINE_TOTAL)))['subtotal']
+    return CartSummary(items, subtotal or Decimal('0'))
+
+
+def apply_quantities(cart, quantities):
+    """
+    Set the quantity of several lines of `cart` at once.
+
+    `quantities` maps CartItem ids to their new quantity; a quantity of 0
+    removes the line. Ids that don't belong to `cart` are ignored. All
+    changes happen in one transaction using one read, one bulk UPDATE and one
+    DELETE. Returns (updated, removed) counts.
+    """
+    if not quantities:
+        return 0, 0
+    with transaction.atomic():
+        items = list(CartItem.objects.filter(cart=cart, id__in=list(quantities)).only('id', 'quantity'))
+        changed, removed = [], []
+        for item in items:
+            quantity = quantities[item.id]
+            if quantity == 0:
+                removed.append(item.id)
+            elif quantity != item.quantity:
+                item.quantity = quantity
+                changed.append(item)
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity'])
+        if removed:
+            CartItem.objects.filter(id__in=removed).delete()
+    return len(changed), len(removed)
+
+
+def get_cart(user):
+    """The user's cart, created on first use; the one-cart-per-user constraint settles races"""
+    return Cart.objects.get_or_create(user=user)[0]
+
+
+def add_item(cart, product_id, quantity=1):
+    """
+    Add `quantity` of a product to `cart`, creating the line or incrementing
+    it in a single INSERT ... ON CONFLICT statement, so concurrent adds of
+    the same product neither fail nor lose an increment.
+    """
+    add_items(cart, {product_id: quantity})
+
+
+def add_items(cart, quantities):
+    """
+    `add_item` for several products at once: `quantities` maps product ids
+    to the quantity to add. On SQLite and PostgreSQL every line is created or
+    incremented by one multi-row upsert (split only at the backend's
+    parameter limit). Lines stop growing at CART_MAX_QUANTITY.
+    """
+    if not quantities:
+        return
+    maximum = settings.CART_MAX_QUANTITY
+    connection = connections[router.db_for_write(CartItem)]
+    if connection.vendor in ('sqlite', 'postgresql'):
+        table = connection.ops.quote_name(CartItem._meta.db_table)
+        least = 'MIN' if connection.vendor == 'sqlite' else 'LEAST'
+        rows = [(cart.pk, product_id, min(quantity, maximum)) for product_id, quantity in quantities.items()]
+        # each row binds three parameters and the statement one more, the cap; PostgreSQL's
+        # wire protocol numbers parameters in 16 bits
+        batch_size = ((connection.features.max_query_params or 65535) - 1) // 3
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cursor.execute(
+                    'INSERT INTO {0} (cart_id, product_id, quantity) VALUES {1} '
+                    'ON CONFLICT (cart_id, product_id) DO UPDATE '
+                    'SET quantity = {2}({0}.quantity + excluded.quantity, %s)'.format(
+                        table, ', '.join(['(%s, %s, %s)'] * len(batch)), least
+                    ),
+                    [value for row in batch for value in row] + [maximum],
+                )
+        return
+
+    # other backends: increment, or insert and fall back to incrementing if another request won
+    for product_id, quantity in quantities.items():
+        quantity = min(quantity, maximum)
+        lines = CartItem.objects.filter(cart=cart, product_id=product_id)
+        if lines.update(quantity=Least(F('quantity') + quantity, maximum)):
+            continue
+        try:
+            with transaction.atomic(using=connection.alias):
+                CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+        except IntegrityError:
+            lines.update(quantity=Least(F('quantity') + quantity, maximum))
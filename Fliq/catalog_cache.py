@@ -0,0 +1,177 @@
+"""
+Versioned cache for the catalog pages.
+
+Cached values (the category list, rendered product grids, product detail
+bodies) are keyed on version tokens for what they depend on:
+
+    categories      every Category
+    products        every Product (grids)
+    product:<id>    one Product (its detail page)
+
+Changing a model replaces the relevant tokens, which orphans every key
+built on them, so invalidation is exact and nothing relies on a TTL being
+short. The Product/Category signals in signals.py do this for ORM saves
+and deletes; code that writes with bulk UPDATEs or upserts (inventory,
+image renditions, the catalog import) calls `invalidate_products` itself.
+
+Tokens are random rather than counters, so a token evicted from the cache
+is recreated with a fresh value instead of colliding with old keys. They
+live in the CATALOG_CACHE cache, which has to be shared by every worker
+process (the file cache by default) for invalidation to reach all of them.
+
+Catalog pages may be rendered from a read replica (see db_routers.py). A
+token also records when it was created, and for REPLICA_LAG_SECONDS after
+that (`settled`) values are computed but not stored, so rows a lagging
+replica still had from before the change are never cached under the new
+token.
+
+A token's creation time also dates the change behind it, which gives
+pages built on tokens a Last-Modified (`changed_at`) that deletes and
+category renames move forward too.
+"""
+import datetime
+import hashlib
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Category
+
+CATEGORIES = 'categories'
+PRODUCTS = 'products'
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE', 'default')]
+
+
+def fragment_timeout():
+    # orphaned fragments are never read again; this only bounds how long they linger
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def product_namespace(product_id):
+    return 'product:%s' % product_id
+
+
+def _version_key(namespace):
+    return 'catalog:version:%s' % namespace
+
+
+def _new_token():
+    return '%s.%d' % (uuid.uuid4().hex, time.time())
+
+
+def settled(versions):
+    """Whether the read replicas have had time to catch up with the changes behind `versions`"""
+    if not getattr(settings, 'CATALOG_READ_REPLICAS', None):
+        return True
+    cutoff = time.time() - getattr(settings, 'REPLICA_LAG_SECONDS', 5)
+    for token in versions:
+        created = token.partition('.')[2]
+        if created.isdigit() and int(created) > cutoff:
+            return False
+    return True
+
+
+def changed_at(versions, *dates):
+    """
+    When the newest of `versions` (or of the aware datetimes in `dates`) was
+    made, or None while that was less than a second ago: HTTP dates have
+    whole seconds, so a change later in the same second would carry the
+    same date.
+    """
+    stamps = [int(created) for created in (token.partition('.')[2] for token in versions) if created.isdigit()]
+    stamps += [date.timestamp() for date in dates if date is not None]
+    if not stamps or time.time() - max(stamps) < 1:
+        return None
+    return datetime.datetime.fromtimestamp(int(max(stamps)), tz=datetime.timezone.utc)
+
+
+def get_versions(namespaces):
+    """Return the current token of each namespace, creating missing ones"""
+    cache = get_cache()
+    keys = [_version_key(namespace) for namespace in namespaces]
+    tokens = cache.get_many(keys)
+    missing = [key for key in keys if key not in tokens]
+    if missing:
+        for key in missing:
+            cache.add(key, _new_token(), timeout=None)
+        # re-read so concurrent creators agree on the token that won
+        tokens.update(cache.get_many(missing))
+    return [tokens.get(key, '') for key in keys]
+
+
+def bump(namespaces):
+    """Invalidate everything cached under `namespaces` once the current transaction commits"""
+    namespaces = list(namespaces)
+    if not namespaces:
+        return
+
+    def replace_tokens():
+        get_cache().set_many({_version_key(namespace): _new_token() for namespace in namespaces}, timeout=None)
+
+    # bumping before commit would let a concurrent request cache the old rows under the new token
+    transaction.on_commit(replace_tokens)
+
+
+def invalidate_products(product_ids):
+    bump([PRODUCTS] + [product_namespace(product_id) for product_id in set(product_ids)])
+
+
+def invalidate_categories():
+    bump([CATEGORIES])
+
+
+def _fragment_key(name, parts, versions):
+    digest = hashlib.md5(':'.join(str(part) for part in list(parts) + versions).encode('utf-8')).hexdigest()
+    return 'catalog:%s:%s' % (name, digest)
+
+
+def cached(name, parts, compute, depends_on):
+    """
+    Return the value cached for `name`/`parts` under the current tokens of
+    `depends_on`, calling `compute()` and storing its result on a miss.
+    """
+    versions = get_versions(depends_on)
+    key = _fragment_key(name, parts, versions)
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        if settled(versions):
+            cache.set(key, value, fragment_timeout())
+    return value
+
+
+async def acached(name, parts, compute, depends_on):
+    """`cached` for async views; `compute` is a coroutine function"""
+    # one thread hop for the tokens rather than one per cache call in get_versions
+    versions = await sync_to_async(get_versions)(depends_on)
+    key = _fragment_key(name, parts, versions)
+    cache = get_cache()
+    value = await cache.aget(key)
+    if value is None:
+        value = await compute()
+        if settled(versions):
+            await cache.aset(key, value, fragment_timeout())
+    return value
+
+
+def _category_list():
+    return Category.objects.only('id', 'name', 'slug').order_by('id')
+
+
+def categories():
+    """Every category, cached until a category changes"""
+    return cached('categories', [], lambda: list(_category_list()), [CATEGORIES])
+
+
+async def acategories():
+    async def compute():
+        return [category async for category in _category_list()]
+    return await acached('categories', [], compute, [CATEGORIES])
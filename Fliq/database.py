@@ -0,0 +1,20 @@
+"""
+Per-connection database setup, applied through the connection_created signal.
+
+SQLite connections get the SQLITE_PRAGMAS from settings: WAL journaling so
+readers never block the writer, synchronous=NORMAL (durable across
+application crashes, and WAL keeps the file consistent after power loss),
+a busy timeout so writers queue for the lock instead of failing, and a
+memory-mapped read window. Postgres needs nothing per connection; its
+profile (persistent connections, health checks, server-side cursors) is
+plain settings, see LaFliq/settings.py.
+"""
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        # on the raw DB-API connection, so setup never shows up in query logs or counts
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
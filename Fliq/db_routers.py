@@ -0,0 +1,127 @@
+"""
+Read replicas for catalog traffic.
+
+`CatalogReplicaRouter` sends reads of the catalog models (Product,
+Category) made while serving a request to one of CATALOG_READ_REPLICAS,
+picked at random per query. Everything else (carts, orders, payments,
+sessions, auth) and every write goes to `default`, the primary, as do all
+reads made outside a request: workers and management commands act on what
+they just wrote, and they are a small share of the reads.
+
+Replicas lag behind the primary, so a visitor must not read the catalog
+from one right after changing it (an admin edit, or stock taken by a
+checkout). `ReplicaPinningMiddleware` pins a request to the primary once it
+writes a catalog model (or from the start, for unsafe methods), and then
+sets a cookie that keeps that visitor on the primary for
+REPLICA_LAG_SECONDS. Reads inside a transaction on the primary also stay
+there. Other visitors are covered by catalog_cache, which does not cache
+what it renders while a change may not have reached the replicas yet.
+
+Replicas are not migrated; they are copies of the primary. Locally, two
+SQLite files stand in for primary and replica: set SQLITE_REPLICA_PATHS and
+keep the copies fed with `manage.py sync_sqlite_replicas`.
+"""
+import contextvars
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+CATALOG_MODELS = {'Fliq.product', 'Fliq.category'}
+
+PIN_COOKIE = 'primary_pin'
+
+
+class RequestRouting:
+    """Where the current request may read from"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_routing = contextvars.ContextVar('fliq_request_routing', default=None)
+
+
+def replica_aliases():
+    return getattr(settings, 'CATALOG_READ_REPLICAS', [])
+
+
+def pin_to_primary():
+    """Send the rest of the current request's reads to the primary"""
+    routing = _routing.get()
+    if routing is not None:
+        routing.pinned = routing.wrote = True
+
+
+class CatalogReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower not in CATALOG_MODELS:
+            return DEFAULT_DB_ALIAS
+        routing = _routing.get()
+        replicas = replica_aliases()
+        if routing is None or routing.pinned or not replicas:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # a transaction reads its own writes
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # only catalog reads leave the primary, so only catalog writes need pinning
+        if model._meta.label_lower in CATALOG_MODELS:
+            pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinningMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        routing = self.routing(request)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(routing, response)
+
+    async def __acall__(self, request):
+        routing = self.routing(request)
+        token = _routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(routing, response)
+
+    def routing(self, request):
+        return RequestRouting(pinned=request.method not in ('GET', 'HEAD', 'OPTIONS') or PIN_COOKIE in request.COOKIES)
+
+    def finish(self, routing, response):
+        if routing.wrote and replica_aliases():
+            # long enough for the replicas to catch up with this write
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=getattr(settings, 'REPLICA_LAG_SECONDS', 5), httponly=True, samesite='Lax'
+            )
+        return response
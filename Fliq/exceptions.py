@@ -20,6 +20,13 @@ class MpesaConnectionError(Exception):
 	"""
 	pass
 
+class MpesaUnknownResultError(MpesaConnectionError):
+	"""
+	Raised when a request may have reached M-Pesa but no usable answer came
+	back (a read timeout, a dropped connection), so it must not be resent
+	"""
+	pass
+
 class MpesaConfigurationException(Exception):
 	"""
 	Raised when Mpesa environment variables are not configured properly
@@ -35,4 +42,17 @@ class MpesaInvalidParameterException(Exception):
 	"""
 	pass
 
+class EmptyCartError(Exception):
+	"""
+	Raised when checking out a cart that has no lines
+	"""
+	pass
 
+class InsufficientStockError(Exception):
+	"""
+	Raised when a product does not have enough stock left to reserve
+	"""
+	def __init__(self, product_id, requested):
+		self.product_id = product_id
+		self.requested = requested
+		super().__init__('Insufficient stock for product {} (requested {})'.format(product_id, requested))
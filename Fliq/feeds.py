@@ -0,0 +1,136 @@
+"""
+Product feeds for marketplaces and ad platforms.
+
+Every format is produced by a generator over a chunked database iterator,
+optionally gzip-compressed on the fly, so exporting the catalog uses the
+same small amount of memory whether it has a hundred products or a million.
+"""
+import csv
+import hashlib
+import io
+import json
+import zlib
+from xml.sax.saxutils import escape
+
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+
+from . import catalog_cache
+from .models import Product
+
+FEED_FIELDS = ('id', 'name', 'price', 'stock', 'category', 'image_url')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json',
+    'xml': 'application/xml; charset=utf-8',
+}
+
+CHUNK_SIZE = 2000
+
+
+def catalog_state():
+    """
+    (version, last modification time) of everything the feed shows, or
+    (None, None) while a read replica may still be behind a change. Product
+    rows date their own changes; the catalog cache tokens also move on
+    deletes and category renames, which leave the remaining rows alone.
+    """
+    versions = catalog_cache.get_versions([catalog_cache.CATEGORIES, catalog_cache.PRODUCTS])
+    if not catalog_cache.settled(versions):
+        return None, None
+    state = Product.objects.aggregate(last_modified=Max('updated_at'), count=Count('id'))
+    key = ':'.join(versions + [str(state['count']), str(state['last_modified'])])
+    return hashlib.md5(key.encode('utf-8')).hexdigest(), catalog_cache.changed_at(versions, state['last_modified'])
+
+
+def feed_rows(absolute_url=None, using=None):
+    """
+    Yield one dict per product, in id order, `CHUNK_SIZE` rows per fetch.
+    `using` fixes the database alias up front: the rows are read while the
+    response streams, after the request's routing has been torn down.
+    """
+    products = (
+        Product.objects.using(using).select_related('category')
+        .only('id', 'name', 'price', 'stock', 'image', 'category__name')
+        .order_by('id')
+    )
+    for product in products.iterator(chunk_size=CHUNK_SIZE):
+        image_url = default_storage.url(product.image.name) if product.image else ''
+        if image_url and absolute_url is not None:
+            image_url = absolute_url(image_url)
+        yield {
+            'id': product.id,
+            'name': product.name,
+            'price': str(product.price),
+            'stock': product.stock,
+            'category': product.category.name,
+            'image_url': image_url,
+        }
+
+
+def render_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FEED_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def render_json(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ','
+    yield ']'
+
+
+def render_xml(rows):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<products>\n'
+    for row in rows:
+        yield '<product>{}</product>\n'.format(
+            ''.join('<{0}>{1}</{0}>'.format(field, escape(str(row[field]))) for field in FEED_FIELDS)
+        )
+    yield '</products>\n'
+
+
+RENDERERS = {
+    'csv': render_csv,
+    'json': render_json,
+    'xml': render_xml,
+}
+
+
+def encode(chunks, buffer_size=64 * 1024):
+    """Encode text chunks to UTF-8, coalescing them into blocks of about `buffer_size` bytes"""
+    pending, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        pending.append(data)
+        size += len(data)
+        if size >= buffer_size:
+            yield b''.join(pending)
+            pending, size = [], 0
+    if pending:
+        yield b''.join(pending)
+
+
+def gzip_stream(blocks, level=6):
+    """Compress a stream of byte blocks into a single gzip member, incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def product_feed(fmt, compress=False, absolute_url=None, using=None):
+    """Yield the whole catalog feed in `fmt` as bytes"""
+    stream = encode(RENDERERS[fmt](feed_rows(absolute_url, using=using)))
+    return gzip_stream(stream) if compress else stream
@@ -0,0 +1,165 @@
+"""
+Carts for visitors who are not logged in.
+
+A guest cart is a signed cookie holding the product ids and quantities the
+visitor picked, so adding to it writes nothing to the database and needs no
+session (a session-stored cart would write the session row on every add).
+Only buyers get a Cart row: when the visitor logs in, `merge_into` folds the
+cookie into their Cart with one upsert.
+
+The signature only proves the cookie came from us, not that its products
+still exist, so ids are re-read with one `id__in` query whenever the cart
+is priced or merged, and lines whose product is gone are dropped. Quantities
+are capped at CART_MAX_QUANTITY when written and checked again when read, so
+a cookie signed before the cap (or with a bad line) cannot fail a login merge.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+
+from .cart import CartSummary, add_items
+from .models import CartItem, Product
+from .pagination import MAX_INTEGER
+
+COOKIE = 'guest_cart'
+SALT = 'Fliq.guest_cart'
+
+# what shopping_cart.html and the product_picture tag read from each product
+PRODUCT_FIELDS = ('id', 'name', 'price', 'image', 'image_renditions')
+
+
+def valid_line(product_id, quantity):
+    return 0 < product_id <= MAX_INTEGER and 0 < quantity <= settings.CART_MAX_QUANTITY
+
+
+class GuestCart:
+    """{product_id: quantity} read from, and written back to, the guest cart cookie"""
+
+    def __init__(self, quantities=None):
+        self.quantities = dict(quantities or {})
+        self.changed = False
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.COOKIES.get(COOKIE)
+        if not value:
+            return cls()
+        try:
+            pairs = signing.loads(value, salt=SALT, max_age=settings.GUEST_CART_MAX_AGE)
+            quantities = {int(product_id): int(quantity) for product_id, quantity in pairs}
+        except (signing.BadSignature, TypeError, ValueError):
+            # tampered, expired or from an older format: start over and drop the cookie
+            guest_cart = cls()
+            guest_cart.changed = True
+            return guest_cart
+        guest_cart = cls({
+            product_id: quantity for product_id, quantity in quantities.items() if valid_line(product_id, quantity)
+        })
+        # out-of-range lines are dropped rather than failing the request, and the cookie rewritten
+        guest_cart.changed = len(guest_cart.quantities) != len(quantities)
+        return guest_cart
+
+    def __bool__(self):
+        return bool(self.quantities)
+
+    def add(self, product_id, quantity=1):
+        """Add `quantity` of a product; False, leaving the cart as it was, if it is full"""
+        if product_id not in self.quantities and len(self.quantities) >= settings.GUEST_CART_MAX_LINES:
+            return False
+        self.quantities[product_id] = min(self.quantities.get(product_id, 0) + quantity, settings.CART_MAX_QUANTITY)
+        self.changed = True
+        return True
+
+    def remove(self, product_id):
+        if self.quantities.pop(product_id, None) is not None:
+            self.changed = True
+
+    def apply_quantities(self, quantities):
+        """
+        `cart.apply_quantities` for a guest cart, whose lines are addressed by
+        product id. Returns (updated, removed) counts.
+        """
+        updated, removed = 0, 0
+        for product_id, quantity in quantities.items():
+            if product_id not in self.quantities:
+                continue
+            quantity = min(quantity, settings.CART_MAX_QUANTITY)
+            if quantity == 0:
+                del self.quantities[product_id]
+                removed += 1
+            elif quantity != self.quantities[product_id]:
+                self.quantities[product_id] = quantity
+                updated += 1
+        self.changed = self.changed or bool(updated or removed)
+        return updated, removed
+
+    def clear(self):
+        self.changed = self.changed or bool(self.quantities)
+        self.quantities = {}
+
+    # database
+
+    def products(self):
+        return Product.objects.filter(id__in=list(self.quantities)).only(*PRODUCT_FIELDS)
+
+    def _summary(self, products):
+        by_id = {product.id: product for product in products}
+        gone = [product_id for product_id in self.quantities if product_id not in by_id]
+        for product_id in gone:
+            self.remove(product_id)
+
+        items, subtotal = [], Decimal('0')
+        for product_id, quantity in self.quantities.items():
+            # unsaved lines shaped like cart.cart_lines(); the cart template links
+            # their id to remove/update, which for a guest cart is the product id
+            item = CartItem(id=product_id, product=by_id[product_id], quantity=quantity)
+            item.line_total = item.product.price * quantity
+            subtotal += item.line_total
+            items.append(item)
+        return CartSummary(items, subtotal)
+
+    def summarize(self):
+        """Price the cart with one query, forgetting products that no longer exist"""
+        if not self.quantities:
+            return CartSummary([], Decimal('0'))
+        return self._summary(self.products())
+
+    async def asummarize(self):
+        """`summarize` with the async ORM"""
+        if not self.quantities:
+            return CartSummary([], Decimal('0'))
+        return self._summary([product async for product in self.products()])
+
+    def merge_into(self, cart):
+        """
+        Add the guest cart's lines to `cart` (quantities of products already in
+        it are summed) with one query to re-validate the products and one
+        bulk upsert, then empty the guest cart.
+        """
+        if self.quantities:
+            existing = set(self.products().values_list('id', flat=True))
+            add_items(cart, {
+                product_id: quantity for product_id, quantity in self.quantities.items()
+                if product_id in existing and valid_line(product_id, quantity)
+            })
+        self.clear()
+
+    # cookie
+
+    def save(self, response):
+        """Write the cart back to `response` if it changed; returns the response"""
+        if not self.changed:
+            return response
+        if self.quantities:
+            response.set_cookie(
+                COOKIE,
+                signing.dumps(list(self.quantities.items()), salt=SALT, compress=True),
+                max_age=settings.GUEST_CART_MAX_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        else:
+            response.delete_cookie(COOKIE, samesite='Lax')
+        return response
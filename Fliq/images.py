@@ -0,0 +1,136 @@
+"""
+Product image renditions.
+
+When a product image is uploaded, resized JPEG and WebP copies are written
+next to the original through the default (S3) storage, e.g.
+products/shirt.jpg -> products/shirt-320w.jpg, products/shirt-320w.webp.
+EXIF data is applied (rotation) and then dropped. Generation runs on a small
+background thread pool so saving a product in the admin doesn't wait on
+Pillow or S3. The widths generated are recorded on
+`Product.image_renditions` for the `product_picture` template tag.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from . import catalog_cache
+from .models import Product
+
+logger = logging.getLogger("default")
+
+RENDITION_WIDTHS = (320, 640, 1024)
+
+FORMATS = {
+    'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def rendition_name(name, width, fmt):
+    stem, _ext = os.path.splitext(name)
+    return '{}-{}w.{}'.format(stem, width, FORMATS[fmt][0])
+
+
+def rendition_url(name, width, fmt, storage=None):
+    return (storage or default_storage).url(rendition_name(name, width, fmt))
+
+
+def _load(name, storage):
+    with storage.open(name, 'rb') as source:
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _encode(image, fmt):
+    if fmt == 'jpeg' and image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        image = background
+    buffer = io.BytesIO()
+    # saving without exif=/icc_profile= strips the camera metadata
+    image.save(buffer, format=fmt.upper(), **FORMATS[fmt][1])
+    return buffer.getvalue()
+
+
+def generate_renditions(name, storage=None, widths=RENDITION_WIDTHS):
+    """
+    Write every rendition of the stored image `name`. Images are never
+    upscaled: widths beyond the original are replaced by one rendition at the
+    original width. Returns the widths written.
+    """
+    storage = storage or default_storage
+    original = _load(name, storage)
+    targets = sorted({min(width, original.width) for width in widths})
+    written = []
+    for width in targets:
+        image = original.copy()
+        image.thumbnail((width, image.height), Image.LANCZOS)
+        for fmt in FORMATS:
+            target = rendition_name(name, width, fmt)
+            if storage.exists(target):
+                storage.delete(target)
+            storage.save(target, ContentFile(_encode(image, fmt)))
+        written.append(width)
+    return written
+
+
+def process_product(product_id, name):
+    """Generate renditions for a product image and record them if it is unchanged"""
+    try:
+        widths = generate_renditions(name)
+        if Product.objects.filter(pk=product_id, image=name).update(
+            image_renditions={'source': name, 'widths': widths}
+        ):
+            catalog_cache.invalidate_products([product_id])
+        return widths
+    except Exception:
+        logger.exception("Could not generate renditions for %s", name)
+        return []
+
+
+def process_in_background(product_id, name):
+    try:
+        return process_product(product_id, name)
+    finally:
+        # pool threads own their DB connections; don't leave them open
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'IMAGE_RENDITION_WORKERS', 2),
+                    thread_name_prefix='renditions',
+                )
+    return _executor
+
+
+def needs_renditions(product):
+    return bool(product.image) and (product.image_renditions or {}).get('source') != product.image.name
+
+
+def schedule_renditions(product):
+    """Queue rendition generation for `product` once the current transaction commits"""
+    product_id, name = product.pk, product.image.name
+    if getattr(settings, 'IMAGE_RENDITIONS_ASYNC', True):
+        transaction.on_commit(lambda: get_executor().submit(process_in_background, product_id, name))
+    else:
+        transaction.on_commit(lambda: process_product(product_id, name))
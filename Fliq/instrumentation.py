@@ -0,0 +1,309 @@
+"""
+Request instrumentation and Prometheus metrics.
+
+`RequestMetricsMiddleware` times every request, sync or async. A query
+wrapper installed on each database connection as it opens (see
+`install_query_wrapper`) counts the SQL queries of the request it runs for
+and the time spent in them; the request is found through a context
+variable, which also follows async views into their sync_to_async threads.
+Time spent in Daraja calls is added by the M-Pesa client (see
+`observe_gateway_call`). Each request feeds a set of histograms, and requests
+over SLOW_REQUEST_SECONDS or SLOW_REQUEST_QUERIES are logged with their
+slowest statements.
+
+Metrics live in memory in each process. With METRICS_DIR set (required
+under gunicorn with more than one worker), each process also writes its
+totals to its own file in that directory at most every
+METRICS_FLUSH_INTERVAL seconds, and `/metrics` sums all the files. That
+keeps the request path free of locks shared between processes. Clear the
+directory when deploying, as prometheus_client's multiprocess mode also
+requires.
+"""
+import atexit
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger("default")
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+GATEWAY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# any other method is counted as OTHER, so clients can't mint label values
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'CONNECT', 'TRACE'}
+
+# name: (type, help, label names, histogram buckets)
+METRICS = {
+    'fliq_http_request_duration_seconds': (
+        'histogram', 'Time to produce a response, by view.', ('view', 'method', 'status'), TIME_BUCKETS),
+    'fliq_http_request_db_queries': (
+        'histogram', 'SQL queries run per request.', ('view',), QUERY_BUCKETS),
+    'fliq_http_request_db_seconds': (
+        'histogram', 'Time spent in SQL per request.', ('view',), TIME_BUCKETS),
+    'fliq_http_request_gateway_seconds': (
+        'histogram', 'Time spent calling M-Pesa per request.', ('view',), GATEWAY_BUCKETS),
+    'fliq_mpesa_call_duration_seconds': (
+        'histogram', 'M-Pesa API call latency, retries included.', ('endpoint',), GATEWAY_BUCKETS),
+    'fliq_mpesa_call_errors_total': (
+        'counter', 'M-Pesa API calls that failed.', ('endpoint',), None),
+    'fliq_mpesa_call_retries_total': (
+        'counter', 'M-Pesa API call retries.', ('endpoint',), None),
+}
+
+
+class Registry:
+    """
+    Thread-safe metric values for this process. A histogram series is stored
+    as [per-bucket counts..., +Inf count, sum]; a counter as [value].
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._last_flush = 0.0
+        # pid alone can be reused by a later worker, which would make counters go backwards
+        self.process_id = '%d-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        with self._lock:
+            series = self._series.get((name, labels))
+            if series is None:
+                series = self._series[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[len(buckets)] += 1
+            series[-1] += value
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            series = self._series.setdefault((name, labels), [0])
+            series[0] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, list(labels), list(values)] for (name, labels), values in self._series.items()]
+
+    def maybe_flush(self, force=False):
+        """Write this process's totals to METRICS_DIR if the flush interval has passed"""
+        directory = getattr(settings, 'METRICS_DIR', None)
+        if not directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0):
+            return
+        self._last_flush = now
+        try:
+            os.makedirs(directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(descriptor, 'w') as target:
+                json.dump(self.snapshot(), target)
+            # readers only ever see complete files
+            os.replace(temporary, os.path.join(directory, 'metrics-%s.json' % self.process_id))
+        except OSError:
+            logger.exception("Could not write metrics to %s", directory)
+
+
+registry = Registry()
+atexit.register(registry.maybe_flush, force=True)
+
+
+def collect():
+    """Sum the series of every process (or just this one without METRICS_DIR)"""
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if not directory:
+        snapshots = [registry.snapshot()]
+    else:
+        registry.maybe_flush(force=True)
+        snapshots = []
+        for filename in os.listdir(directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as source:
+                    snapshots.append(json.load(source))
+            except (OSError, ValueError):
+                continue
+
+    totals = {}
+    for snapshot in snapshots:
+        for name, labels, values in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(labels))
+            if key in totals:
+                totals[key] = [total + value for total, value in zip(totals[key], values)]
+            else:
+                totals[key] = values
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals=None):
+    """Format metrics in the Prometheus text exposition format (version 0.0.4)"""
+    totals = collect() if totals is None else totals
+    lines = []
+    for name, (kind, documentation, label_names, buckets) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, documentation))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (series_name, labels), values in sorted(totals.items()):
+            if series_name != name:
+                continue
+            if kind == 'counter':
+                lines.append('%s%s %s' % (name, _labels(label_names, labels), _number(values[0])))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(label_names, labels, ('le', bound)), cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(label_names, labels), _number(values[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(label_names, labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    """What one request spent, fed by the query wrapper and the M-Pesa client"""
+
+    def __init__(self, keep_slowest):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.gateway_seconds = 0.0
+        self.keep_slowest = keep_slowest
+        self.slowest = []
+        self._order = itertools.count()
+
+    def record_query(self, sql, elapsed):
+        self.queries += 1
+        self.db_seconds += elapsed
+        if self.keep_slowest:
+            entry = (elapsed, next(self._order), sql)
+            if len(self.slowest) < self.keep_slowest:
+                heapq.heappush(self.slowest, entry)
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def slowest_statements(self):
+        return [(elapsed, sql) for elapsed, _order, sql in sorted(self.slowest, reverse=True)]
+
+
+_current = contextvars.ContextVar('fliq_request_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper that charges each query to the current request"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - started)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """connection_created receiver; reconnects reuse the wrapper object, so add it once"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def observe_gateway_call(endpoint, seconds, error=False, retries=0):
+    """Record one M-Pesa API call against the metrics and the current request, if any"""
+    registry.observe('fliq_mpesa_call_duration_seconds', (endpoint,), seconds)
+    if error:
+        registry.inc('fliq_mpesa_call_errors_total', (endpoint,))
+    if retries:
+        registry.inc('fliq_mpesa_call_retries_total', (endpoint,), retries)
+    stats = _current.get()
+    if stats is not None:
+        stats.gateway_seconds += seconds
+    else:
+        # payment workers have no request to flush for them
+        registry.maybe_flush()
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            # served without a thread hop under ASGI
+            markcoroutinefunction(self)
+        self.slow_seconds = getattr(settings, 'SLOW_REQUEST_SECONDS', 1.0)
+        self.slow_queries = getattr(settings, 'SLOW_REQUEST_QUERIES', 50)
+        self.keep_slowest = getattr(settings, 'SLOW_REQUEST_LOGGED_QUERIES', 3)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = RequestStats(self.keep_slowest)
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            # queries run while a streaming response is consumed fall outside this window
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats(self.keep_slowest)
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def finish(self, request, response, stats, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        # unresolved paths share one label so 404 scans can't blow up cardinality
+        view = match.view_name if match is not None else '<unresolved>'
+        method = request.method if request.method in HTTP_METHODS else 'OTHER'
+        registry.observe('fliq_http_request_duration_seconds', (view, method, str(response.status_code)), elapsed)
+        registry.observe('fliq_http_request_db_queries', (view,), stats.queries)
+        registry.observe('fliq_http_request_db_seconds', (view,), stats.db_seconds)
+        registry.observe('fliq_http_request_gateway_seconds', (view,), stats.gateway_seconds)
+        registry.maybe_flush()
+
+        if elapsed >= self.slow_seconds or stats.queries >= self.slow_queries:
+            logger.warning(
+                "Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, M-Pesa %.0f ms; slowest SQL:%s",
+                request.method, request.path, view, elapsed * 1000, stats.queries, stats.db_seconds * 1000,
+                stats.gateway_seconds * 1000,
+                ''.join('\n  %.1f ms  %s' % (seconds * 1000, sql[:500]) for seconds, sql in stats.slowest_statements()),
+            )
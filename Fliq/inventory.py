@@ -0,0 +1,142 @@
+"""
+Stock reservations.
+
+Checkout takes stock out of `Product.stock` up front with one conditional
+UPDATE per product (`stock >= qty`), so concurrent checkouts can never
+oversell and never read-modify-write. Every hold is recorded in the
+StockReservation ledger; a confirmed payment commits it, a failed payment or
+the expiry sweeper (`manage.py release_expired_reservations`) gives the
+stock back.
+
+The catalog pages only say whether a product is in stock, so their cache
+is invalidated for the products a reservation sells out or a release puts
+back on the shelf, not for every checkout.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, When
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from . import catalog_cache
+from .exceptions import InsufficientStockError
+from .models import CartItem, Product, StockReservation
+
+logger = logging.getLogger("default")
+
+
+def reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+def reserve(quantities, reference, ttl=None):
+    """
+    Take stock for {product_id: quantity} and record the holds under
+    `reference`. Either every product is reserved or, if one is short,
+    InsufficientStockError is raised and nothing is.
+    """
+    expires_at = timezone.now() + (ttl or reservation_ttl())
+    with transaction.atomic():
+        # a fixed lock order keeps concurrent multi-line reservations from deadlocking
+        for product_id, quantity in sorted(quantities.items()):
+            taken = Product.objects.filter(id=product_id, stock__gte=quantity).update(
+                stock=F('stock') - quantity, updated_at=Now()
+            )
+            if not taken:
+                raise InsufficientStockError(product_id, quantity)
+        sold_out = Product.objects.filter(id__in=list(quantities), stock=0).values_list('id', flat=True)
+        _invalidate(sold_out)
+        return StockReservation.objects.bulk_create([
+            StockReservation(product_id=product_id, quantity=quantity, reference=reference, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+
+
+def reserve_cart(cart, reference, ttl=None):
+    quantities = Counter()
+    for product_id, quantity in CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'):
+        quantities[product_id] += quantity
+    return reserve(dict(quantities), reference, ttl=ttl)
+
+
+def commit(**lookup):
+    """
+    Mark held reservations matching `lookup` (e.g. reference=...) as sold.
+    The stock already left the shelf when it was reserved, so this is a
+    single conditional UPDATE.
+    """
+    committed = StockReservation.objects.filter(status=StockReservation.HELD, **lookup).update(
+        status=StockReservation.COMMITTED
+    )
+    if not committed:
+        logger.warning("No held stock reservations to commit for %s", lookup)
+    return committed
+
+
+def _invalidate(product_ids):
+    """Drop the cached catalog pages of products that went in or out of stock"""
+    product_ids = list(product_ids)
+    if product_ids:
+        catalog_cache.invalidate_products(product_ids)
+
+
+def _restore_stock(quantities):
+    """Add {product_id: quantity} back to stock with one UPDATE"""
+    if not quantities:
+        return
+    Product.objects.filter(id__in=list(quantities)).update(
+        stock=F('stock') + Case(
+            *[When(id=product_id, then=quantity) for product_id, quantity in quantities.items()],
+            default=0,
+            output_field=IntegerField(),
+        ),
+        updated_at=Now(),
+    )
+    # a product now holding exactly what came back had none before
+    stock = Product.objects.filter(id__in=list(quantities)).values_list('id', 'stock')
+    _invalidate(product_id for product_id, count in stock if count == quantities[product_id])
+
+
+def _release(reservations):
+    """
+    Release the given held reservations. Rows are locked (where the backend
+    supports it) and transitioned with a conditional UPDATE so a reservation
+    is never returned to stock twice.
+    """
+    with transaction.atomic():
+        rows = list(
+            reservations.filter(status=StockReservation.HELD)
+            .select_for_update(skip_locked=True)
+            .values_list('id', 'product_id', 'quantity')
+        )
+        if not rows:
+            return 0
+        StockReservation.objects.filter(id__in=[row[0] for row in rows]).update(status=StockReservation.RELEASED)
+        quantities = Counter()
+        for _id, product_id, quantity in rows:
+            quantities[product_id] += quantity
+        _restore_stock(quantities)
+        return len(rows)
+
+
+def release(**lookup):
+    """Give back the stock held for `lookup`, e.g. after a failed payment"""
+    return _release(StockReservation.objects.filter(**lookup))
+
+
+def release_expired(batch_size=500, now=None):
+    """Release every held reservation past its expiry, `batch_size` at a time"""
+    now = now or timezone.now()
+    released = 0
+    while True:
+        expired = StockReservation.objects.filter(
+            status=StockReservation.HELD, expires_at__lt=now
+        ).order_by('expires_at')
+        count = _release(StockReservation.objects.filter(id__in=list(expired.values_list('id', flat=True)[:batch_size])))
+        released += count
+        if count < batch_size:
+            return released
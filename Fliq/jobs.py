@@ -0,0 +1,162 @@
+"""
+A small database-backed job queue.
+
+Jobs are rows in the Job table. Workers (`manage.py run_payment_workers`)
+claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED where the backend
+supports it, or with a conditional UPDATE per row on SQLite, run the
+registered handler, and either finish the job, schedule a retry with
+exponential backoff, or move it to the dead state after `max_attempts`.
+Kinds can also register a coroutine handler, which the asyncio worker mode
+(`run_payment_workers --asyncio`) runs through `arun`.
+"""
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger("default")
+
+HANDLERS = {}
+ASYNC_HANDLERS = {}
+
+# seconds a running job may stay claimed before it is assumed abandoned
+LEASE_SECONDS = 300
+
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 15 * 60
+
+
+class RetryLater(Exception):
+    """Raised by a handler to ask for a retry without logging a traceback"""
+
+
+def register(kind, on_dead=None):
+    """
+    Register the decorated function as the handler for jobs of `kind`.
+    `on_dead(payload)` runs once if the job exhausts its attempts.
+    """
+    def decorator(handler):
+        HANDLERS[kind] = (handler, on_dead)
+        return handler
+    return decorator
+
+
+def register_async(kind):
+    """
+    Register the decorated coroutine function as the async handler for jobs
+    of `kind`. The kind's sync handler must be registered too; its `on_dead`
+    applies to both.
+    """
+    def decorator(handler):
+        ASYNC_HANDLERS[kind] = handler
+        return handler
+    return decorator
+
+
+def enqueue(kind, payload, delay=0, max_attempts=5):
+    return Job.objects.create(
+        kind=kind,
+        payload=payload,
+        max_attempts=max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def enqueue_many(kind, payloads, max_attempts=5):
+    """Queue one job per payload with a single INSERT"""
+    now = timezone.now()
+    return Job.objects.bulk_create([
+        Job(kind=kind, payload=payload, max_attempts=max_attempts, run_at=now) for payload in payloads
+    ])
+
+
+def retry_delay(attempts):
+    """Exponential backoff with full jitter, capped at RETRY_MAX_SECONDS"""
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempts))
+
+
+def requeue_abandoned(lease=LEASE_SECONDS):
+    """Put back jobs whose worker died while running them"""
+    return Job.objects.filter(
+        status=Job.RUNNING, locked_at__lt=timezone.now() - timedelta(seconds=lease)
+    ).update(status=Job.QUEUED, locked_at=None)
+
+
+def claim(limit):
+    """Atomically mark up to `limit` due jobs as running and return them"""
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by('run_at')
+    connection = connections[router.db_for_write(Job)]
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=connection.alias):
+            jobs = list(due.select_for_update(skip_locked=True)[:limit])
+            Job.objects.filter(id__in=[job.id for job in jobs]).update(status=Job.RUNNING, locked_at=now)
+    else:
+        # no row locks: race for each candidate with a conditional UPDATE and keep the ones we won
+        jobs = []
+        for job in due[:limit]:
+            if Job.objects.filter(id=job.id, status=Job.QUEUED).update(status=Job.RUNNING, locked_at=now):
+                jobs.append(job)
+
+    for job in jobs:
+        job.status, job.locked_at = Job.RUNNING, now
+    return jobs
+
+
+def _record_failure(job, err, error_text, on_dead, retryable=True):
+    job.attempts += 1
+    job.last_error = error_text
+    if job.attempts >= job.max_attempts or not retryable:
+        job.status = Job.DEAD
+        logger.error("Job %s is dead after %d attempts: %s", job, job.attempts, err)
+    else:
+        job.status = Job.QUEUED
+        job.run_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+        logger.warning("Job %s failed (attempt %d), retrying: %s", job, job.attempts, err)
+    job.locked_at = None
+    job.save(update_fields=['attempts', 'last_error', 'status', 'run_at', 'locked_at', 'updated_at'])
+    if job.status == Job.DEAD and on_dead is not None:
+        on_dead(job.payload)
+
+
+def _record_success(job):
+    job.status = Job.DONE
+    job.locked_at = None
+    job.save(update_fields=['status', 'locked_at', 'updated_at'])
+
+
+def _error_text(err):
+    # called inside the except block so the traceback is still available
+    return str(err) if isinstance(err, RetryLater) else traceback.format_exc()
+
+
+def run(job):
+    """Run one claimed job and record its outcome"""
+    handler, on_dead = HANDLERS.get(job.kind, (None, None))
+    try:
+        if handler is None:
+            raise LookupError('No handler registered for job kind {!r}'.format(job.kind))
+        handler(job.payload)
+    except Exception as err:
+        _record_failure(job, err, _error_text(err), on_dead, retryable=handler is not None)
+    else:
+        _record_success(job)
+
+
+async def arun(job):
+    """Run one claimed job whose kind has an async handler and record its outcome"""
+    handler = ASYNC_HANDLERS[job.kind]
+    _handler, on_dead = HANDLERS.get(job.kind, (None, None))
+    try:
+        await handler(job.payload)
+    except Exception as err:
+        await sync_to_async(_record_failure)(job, err, _error_text(err), on_dead)
+    else:
+        await sync_to_async(_record_success)(job)
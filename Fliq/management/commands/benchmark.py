@@ -0,0 +1,274 @@
+import json
+import os
+import random
+import statistics
+import time
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from Fliq.models import Cart, CartItem, Category, Product, Profile
+
+DEFAULT_BASELINE = os.path.join(str(settings.BASE_DIR), 'benchmarks', 'baseline.json')
+
+# the options that shape the dataset, in seed_shop's argument order
+CONFIG_KEYS = ('categories', 'products', 'users', 'lines', 'seed')
+
+VIEWS = (
+    'product_list', 'product_detail', 'cart_view', 'add_to_cart', 'update_cart', 'checkout',
+    'guest_add_to_cart', 'guest_cart_view',
+)
+
+
+class StubGateway:
+    """Stands in for Daraja so nothing the benchmark triggers can reach the network"""
+
+    def stk_push(self, **kwargs):
+        raise AssertionError("The benchmark must not send STK pushes")
+
+    stk_query = stk_push
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Shop:
+    """What `seed_shop` created: ids to request, and a logged-in test client per user"""
+
+    def __init__(self, rng, product_ids, category_slugs, clients, cart_items, cart_lines):
+        self.rng = rng
+        self.product_ids = product_ids
+        self.category_slugs = category_slugs
+        self.clients = clients
+        self.cart_items = cart_items
+        # each cart's seeded CartItem rows, to refill it after a checkout empties it
+        self.cart_lines = cart_lines
+
+
+def seed_shop(categories, products, users, lines, seed):
+    """Fill the current database with a deterministic catalog, users and carts"""
+    rng = random.Random(seed)
+    category_rows = Category.objects.bulk_create([
+        Category(name='Category %d' % number, slug='category-%d' % number)
+        for number in range(categories)
+    ])
+    product_rows = []
+    for number in range(products):
+        image = 'products/bench-%d.jpg' % number
+        product_rows.append(Product(
+            sku='BENCH-%06d' % number,
+            name='Product %d' % number,
+            description='Benchmark product %d' % number,
+            image=image,
+            image_renditions={'source': image, 'widths': [320, 640]},
+            price=Decimal(rng.randrange(100, 1000000)) / 100,
+            category=category_rows[number % len(category_rows)],
+            stock=10 ** 6,
+        ))
+    product_ids = [product.pk for product in Product.objects.bulk_create(product_rows, batch_size=500)]
+
+    password = make_password('benchmark')
+    user_rows = User.objects.bulk_create([
+        User(username='bench-%d' % number, password=password) for number in range(users)
+    ])
+    Profile.objects.bulk_create([Profile(user=user, phone_number='2547%08d' % user.pk) for user in user_rows])
+    carts = Cart.objects.bulk_create([Cart(user=user) for user in user_rows])
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, product_id=product_id, quantity=rng.randint(1, 3))
+        for cart in carts
+        for product_id in rng.sample(product_ids, lines)
+    ], batch_size=1000)
+
+    clients = []
+    for user in user_rows:
+        client = Client()
+        client.force_login(user)
+        clients.append(client)
+    cart_lines = [list(CartItem.objects.filter(cart=cart)) for cart in carts]
+    cart_items = [[line.id for line in lines] for lines in cart_lines]
+    return Shop(rng, product_ids, [category.slug for category in category_rows], clients, cart_items, cart_lines)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a deterministic shop in a throwaway test database, drive the catalog, cart and "
+        "checkout views through the test client, and report latency percentiles and SQL "
+        "query counts per view. Fails when a view runs more queries than the baseline allows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--lines', type=int, default=10, help="Cart lines per user")
+        parser.add_argument('--requests', type=int, default=200, help="Timed requests per view")
+        parser.add_argument('--warmup', type=int, default=10, help="Untimed requests per view")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--views', nargs='+', choices=VIEWS, default=list(VIEWS))
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Stored query-count baseline")
+        parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
+        parser.add_argument('--query-tolerance', type=int, default=0, help="Extra queries allowed over the baseline")
+
+    # one request per scenario; each returns (client, method, path, kwargs)
+
+    def product_list(self, number):
+        query = {'category': self.shop.category_slugs[number % len(self.shop.category_slugs)]} if number % 2 else {}
+        return Client(), 'get', reverse('home'), {'data': query}
+
+    def product_detail(self, number):
+        return Client(), 'get', reverse('product_detail', args=[self.shop.rng.choice(self.shop.product_ids)]), {}
+
+    def cart_view(self, number):
+        return self.shop.clients[number % len(self.shop.clients)], 'get', reverse('cart_view'), {}
+
+    def add_to_cart(self, number):
+        client = self.shop.clients[number % len(self.shop.clients)]
+        return client, 'get', reverse('add_to_cart', args=[self.shop.rng.choice(self.shop.product_ids)]), {}
+
+    def update_cart(self, number):
+        client = self.shop.clients[number % len(self.shop.clients)]
+        item_ids = self.shop.cart_items[number % len(self.shop.clients)]
+        body = json.dumps({'items': [{'id': item_id, 'quantity': self.shop.rng.randint(1, 5)} for item_id in item_ids]})
+        return client, 'post', reverse('update_cart'), {'data': body, 'content_type': 'application/json'}
+
+    def checkout(self, number):
+        index = number % len(self.shop.clients)
+        client = self.shop.clients[index]
+        # checking out empties the cart into the order; refill it so every request places one
+        lines = self.shop.cart_lines[index]
+        if lines and not CartItem.objects.filter(cart_id=lines[0].cart_id).exists():
+            CartItem.objects.bulk_create(lines)
+        data = {'phone_number': '254700000000', 'address': 'Nairobi'}
+        return client, 'post', reverse('checkout'), {'data': data}
+
+    # anonymous shoppers, whose carts live in a cookie
+
+    def guest_add_to_cart(self, number):
+        client = self.guests[number % len(self.guests)]
+        return client, 'get', reverse('add_to_cart', args=[self.shop.rng.choice(self.shop.product_ids)]), {}
+
+    def guest_cart_view(self, number):
+        return self.guests[number % len(self.guests)], 'get', reverse('cart_view'), {}
+
+    def measure(self, view, options):
+        scenario = getattr(self, view)
+        for number in range(options['warmup']):
+            client, method, path, kwargs = scenario(number)
+            getattr(client, method)(path, **kwargs)
+
+        timings, queries = [], []
+        for number in range(options['requests']):
+            client, method, path, kwargs = scenario(number)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(client, method)(path, **kwargs)
+                timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                raise CommandError("%s %s returned %d" % (method.upper(), path, response.status_code))
+            queries.append(len(captured))
+
+        return {
+            'requests': len(timings),
+            'p50_ms': round(percentile(timings, 0.50), 3),
+            'p90_ms': round(percentile(timings, 0.90), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'mean_ms': round(statistics.mean(timings), 3),
+            'max_ms': round(max(timings), 3),
+            'queries': max(queries),
+            'queries_min': min(queries),
+        }
+
+    # baseline
+
+    def compare(self, report, baseline_path, tolerance):
+        with open(baseline_path) as source:
+            baseline = json.load(source)
+        if baseline.get('config') != report['config']:
+            # checkout holds stock with one conditional UPDATE per cart line, so --lines shifts its count
+            self.stdout.write(self.style.WARNING("The baseline was recorded with different options: %s" % baseline.get('config')))
+        regressions = []
+        for view, result in report['results'].items():
+            allowed = baseline['results'].get(view, {}).get('queries')
+            if allowed is not None and result['queries'] > allowed + tolerance:
+                regressions.append("%s: %d queries (baseline %d)" % (view, result['queries'], allowed))
+        return regressions
+
+    def write(self, path, report):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as target:
+            json.dump(report, target, indent=2, sort_keys=True)
+            target.write('\n')
+
+    def handle(self, *args, **options):
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        databases = runner.setup_databases()
+        try:
+            results = self.run_benchmark(options)
+        finally:
+            runner.teardown_databases(databases)
+            runner.teardown_test_environment()
+
+        report = {
+            'config': {key: options[key] for key in CONFIG_KEYS},
+            'requests': options['requests'],
+            'database': connection.vendor,
+            'results': results,
+        }
+
+        self.stdout.write("%-18s %9s %9s %9s %9s %8s" % ('view', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries'))
+        for view, result in results.items():
+            self.stdout.write("%-18s %9.2f %9.2f %9.2f %9.2f %8d" % (
+                view, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['max_ms'], result['queries']
+            ))
+
+        if options['output']:
+            self.write(options['output'], report)
+        if options['update_baseline']:
+            self.write(options['baseline'], report)
+            self.stdout.write(self.style.SUCCESS("Baseline written to %s" % options['baseline']))
+            return
+        if not os.path.exists(options['baseline']):
+            self.stdout.write(self.style.WARNING("No baseline at %s; run with --update-baseline to store one" % options['baseline']))
+            return
+
+        regressions = self.compare(report, options['baseline'], options['query_tolerance'])
+        if regressions:
+            raise CommandError("Query count regressions:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS("Query counts are within the baseline."))
+
+    def run_benchmark(self, options):
+        # images resolve against local storage; catalog and sessions start cold in
+        # private caches, kept apart as in production so fragments never evict logins
+        with override_settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+            CACHES=dict(settings.CACHES, benchmark_sessions={
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'benchmark-sessions',
+                'OPTIONS': {'MAX_ENTRIES': 100000},
+            }),
+            CATALOG_CACHE='default',
+            SESSION_CACHE_ALIAS='benchmark_sessions',
+            IMAGE_RENDITIONS_ASYNC=False,
+        ), mock.patch('Fliq.payments.get_gateway', return_value=StubGateway()):
+            caches['default'].clear()
+            caches['benchmark_sessions'].clear()
+            self.shop = seed_shop(*(options[key] for key in CONFIG_KEYS))
+            self.guests = [Client() for _ in self.shop.clients]
+            return {view: self.measure(view, options) for view in options['views']}
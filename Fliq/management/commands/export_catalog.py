@@ -0,0 +1,26 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from Fliq import feeds
+
+
+class Command(BaseCommand):
+    help = "Write the product feed (CSV, JSON or XML) to a file or stdout with constant memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(feeds.RENDERERS), default='csv')
+        parser.add_argument('--output', default='-', help="File to write, or - for stdout")
+        parser.add_argument('--gzip', action='store_true', help="Gzip-compress the output")
+
+    def handle(self, *args, **options):
+        stream = feeds.product_feed(options['format'], compress=options['gzip'])
+        if options['output'] == '-':
+            for block in stream:
+                sys.stdout.buffer.write(block)
+            sys.stdout.buffer.flush()
+            return
+        with open(options['output'], 'wb') as target:
+            for block in stream:
+                target.write(block)
+        self.stderr.write(self.style.SUCCESS("Wrote %s" % options['output']))
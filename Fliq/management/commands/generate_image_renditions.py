@@ -0,0 +1,47 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+
+from Fliq import images
+from Fliq.models import Product
+
+
+class Command(BaseCommand):
+    help = "Generate resized JPEG/WebP renditions for existing product images in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Images processed concurrently")
+        parser.add_argument('--force', action='store_true', help="Regenerate renditions that already exist")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        products = Product.objects.exclude(image='').only('id', 'image', 'image_renditions').order_by('id')
+
+        started = time.monotonic()
+        processed = failed = 0
+        in_flight = set()
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='renditions') as pool:
+            # pk-keyset chunks rather than one open cursor, so the workers' writes never wait on our read
+            while True:
+                chunk = list(products.filter(pk__gt=last_pk)[:500])
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+                for product in chunk:
+                    if not options['force'] and not images.needs_renditions(product):
+                        continue
+                    # bound the queue so memory stays flat however big the catalog is
+                    if len(in_flight) >= workers * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        processed += len(done)
+                        failed += sum(1 for future in done if not future.result())
+                    in_flight.add(pool.submit(images.process_in_background, product.pk, product.image.name))
+            done, _ = wait(in_flight)
+            processed += len(done)
+            failed += sum(1 for future in done if not future.result())
+
+        self.stdout.write(self.style.SUCCESS(
+            "Processed %d images in %.1fs (%d failed)." % (processed, time.monotonic() - started, failed)
+        ))
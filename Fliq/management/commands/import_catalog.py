@@ -0,0 +1,210 @@
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.text import get_valid_filename, slugify
+
+from Fliq import catalog_cache, search
+from Fliq.models import Category, Product
+
+PRODUCT_UPDATE_FIELDS = ['name', 'description', 'price', 'stock', 'category', 'updated_at']
+
+
+class RowError(Exception):
+    pass
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as source:
+        for row in csv.DictReader(source):
+            yield row
+
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as source:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a CSV or JSONL supplier feed into the catalog, upserting categories by slug "
+        "and products by sku in batches. Columns: sku, name, description, price, stock, "
+        "category (name), category_slug (optional), image (optional path under --image-dir)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or JSONL file")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows written per bulk upsert")
+        parser.add_argument('--image-dir', default='.', help="Directory image paths are relative to")
+        parser.add_argument('--upload-workers', type=int, default=8, help="Concurrent image uploads")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if not os.path.exists(path):
+            raise CommandError("No such file: %s" % path)
+        rows = read_jsonl(path) if fmt == 'jsonl' else read_csv(path)
+
+        self.image_dir = options['image_dir']
+        self.category_ids = dict(Category.objects.values_list('slug', 'id'))
+        self.errors = 0
+        imported = line = 0
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=options['upload_workers'], thread_name_prefix='catalog-upload') as self.uploads:
+            for batch in batches(rows, options['batch_size']):
+                numbered = list(enumerate(batch, start=line + 1))
+                line += len(batch)
+                imported += self.import_batch(numbered)
+                elapsed = time.monotonic() - started
+                self.stdout.write("%d rows, %d imported, %d errors, %.0f rows/s" % (line, imported, self.errors, line / elapsed))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Imported %d of %d rows in %.1fs (%d errors)." % (imported, line, time.monotonic() - started, self.errors)
+        ))
+        if imported:
+            self.stdout.write("Run `manage.py generate_image_renditions` to resize any new images.")
+
+    def error(self, line, message):
+        self.errors += 1
+        self.stderr.write("Row %d: %s" % (line, message))
+
+    def parse(self, row):
+        sku = (row.get('sku') or '').strip()
+        name = (row.get('name') or '').strip()
+        category = (row.get('category') or '').strip()
+        if not sku or not name or not category:
+            raise RowError("sku, name and category are required")
+        try:
+            price = Decimal(str(row.get('price'))).quantize(Decimal('.01'))
+            stock = int(row.get('stock') or 0)
+        except (InvalidOperation, ValueError, TypeError):
+            raise RowError("invalid price or stock")
+        if price < 0 or price >= Decimal('1000000') or stock < 0:
+            raise RowError("price or stock out of range")
+        return {
+            'sku': sku[:64],
+            'name': name[:200],
+            'description': row.get('description') or '',
+            'price': price,
+            'stock': stock,
+            'category': category[:200],
+            'category_slug': slugify(row.get('category_slug') or category)[:200],
+            'image': (row.get('image') or '').strip(),
+        }
+
+    def upload(self, sku, image):
+        """
+        Store `image` as products/<sku>/<content hash><ext>. Products never
+        share a key, and an image that has not changed since the last import
+        is already there, so it is not sent again.
+        """
+        with open(os.path.join(self.image_dir, image), 'rb') as source:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: source.read(64 * 1024), b''):
+                digest.update(chunk)
+            name = 'products/%s/%s%s' % (
+                get_valid_filename(sku), digest.hexdigest()[:16], os.path.splitext(image)[1][:8].lower()
+            )
+            if default_storage.exists(name):
+                return name
+            source.seek(0)
+            return default_storage.save(name, File(source))
+
+    def upsert_categories(self, parsed):
+        """Create the batch's unseen categories and return {slug: id} for them"""
+        new = {}
+        for _line, data in parsed:
+            if data['category_slug'] not in self.category_ids:
+                new[data['category_slug']] = Category(slug=data['category_slug'], name=data['category'])
+        if not new:
+            return {}
+        Category.objects.bulk_create(new.values(), update_conflicts=True, unique_fields=['slug'], update_fields=['name', 'updated_at'])
+        return dict(Category.objects.filter(slug__in=list(new)).values_list('slug', 'id'))
+
+    def write_products(self, products, update_fields):
+        if products:
+            Product.objects.bulk_create(
+                products, update_conflicts=True, unique_fields=['sku'], update_fields=update_fields
+            )
+
+    def import_batch(self, numbered):
+        parsed = []
+        for line, row in numbered:
+            try:
+                parsed.append((line, self.parse(row)))
+            except RowError as err:
+                self.error(line, err)
+
+        # upload every image in the batch concurrently, then drop the rows whose upload failed
+        pending = {line: self.uploads.submit(self.upload, data['sku'], data['image']) for line, data in parsed if data['image']}
+        ready = []
+        for line, data in parsed:
+            if line in pending:
+                try:
+                    data['image'] = pending[line].result()
+                except Exception as err:
+                    # local files raise OSError, S3 raises botocore/boto3 errors that aren't OSErrors
+                    self.error(line, "image upload failed: %s" % err)
+                    continue
+            ready.append((line, data))
+        if not ready:
+            return 0
+
+        # the last row wins when a sku repeats within a batch
+        latest = {data['sku']: (line, data) for line, data in ready}
+        return self.write(sorted(latest.values(), key=lambda item: item[0]))
+
+    def build(self, data, category_ids):
+        return Product(
+            sku=data['sku'], name=data['name'], description=data['description'], price=data['price'],
+            stock=data['stock'], category_id=category_ids[data['category_slug']], image=data['image'],
+        )
+
+    def write(self, ready):
+        """Upsert parsed rows; on failure bisect down to the rows that can't be saved"""
+        try:
+            with transaction.atomic():
+                category_ids = dict(self.category_ids, **self.upsert_categories(ready))
+                # rows without an image keep whatever image the product already has
+                self.write_products([self.build(data, category_ids) for _line, data in ready if data['image']], PRODUCT_UPDATE_FIELDS + ['image'])
+                self.write_products([self.build(data, category_ids) for _line, data in ready if not data['image']], PRODUCT_UPDATE_FIELDS)
+        except Exception as err:
+            if len(ready) == 1:
+                self.error(ready[0][0], "could not be saved: %s" % err)
+                return 0
+            middle = len(ready) // 2
+            return self.write(ready[:middle]) + self.write(ready[middle:])
+
+        if len(category_ids) != len(self.category_ids):
+            catalog_cache.invalidate_categories()
+        self.category_ids = category_ids
+        # bulk upserts bypass the Product signals, so index the batch and invalidate its cached pages here
+        rows = list(
+            Product.objects.filter(sku__in=[data['sku'] for _line, data in ready]).values_list('id', 'name', 'description')
+        )
+        search.index_products(rows)
+        catalog_cache.invalidate_products(row[0] for row in rows)
+        return len(ready)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import router
+
+from Fliq import search
+from Fliq.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index from the Product table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None, help="Database alias to rebuild (defaults to the Product write database)")
+
+    def handle(self, *args, **options):
+        using = options['database'] or router.db_for_write(Product)
+        search.rebuild_index(using=using)
+        self.stdout.write(self.style.SUCCESS("Indexed %d products." % Product.objects.using(using).count()))
@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Fliq import payments
+from Fliq.exceptions import MpesaConnectionError
+from Fliq.models import PaymentTransaction
+from Fliq.utils import get_gateway
+
+logger = logging.getLogger("default")
+
+
+class RateLimiter:
+    """Thread-safe limiter handing out at most `rate` slots per second, evenly spaced"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Command(BaseCommand):
+    help = (
+        "Settle pending M-Pesa payments whose callback never arrived by querying "
+        "their STK push status concurrently, within a requests-per-second budget. "
+        "Payments whose push timed out have no CheckoutRequestID to query; they are "
+        "failed once no callback has claimed them for --unknown-after minutes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=10, help="Only payments pending for more than N minutes")
+        parser.add_argument('--chunk-size', type=int, default=200, help="Payments read and settled per batch")
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent STK query requests")
+        parser.add_argument('--rps', type=float, default=5.0, help="Maximum STK query requests per second")
+        parser.add_argument(
+            '--unknown-after', type=int, default=30,
+            help="Fail payments whose STK push outcome has been unknown for more than N minutes",
+        )
+
+    def query(self, payment):
+        """
+        Return (pk, result_code, description), None if the outcome is not
+        final yet, or False if the query failed or its answer made no sense.
+        Runs on the pool, so nothing may escape it and end the whole run.
+        """
+        self.limiter.wait()
+        try:
+            response = self.gateway.stk_query(payment.checkout_request_id)
+            body = response.json()
+        except (MpesaConnectionError, ValueError):
+            return False
+        try:
+            if 'ResultCode' not in body:
+                # e.g. "The transaction is being processed"
+                return None
+            result_code = int(body['ResultCode'])
+            if not -2 ** 31 <= result_code < 2 ** 31:
+                raise ValueError('ResultCode out of range')
+        except (ValueError, TypeError, OverflowError) as err:
+            logger.warning("Unusable STK query answer for payment %s: %s", payment.pk, err)
+            return False
+        return payment.pk, result_code, str(body.get('ResultDesc', ''))
+
+    def handle(self, *args, **options):
+        self.gateway = get_gateway()
+        self.limiter = RateLimiter(options['rps'])
+        cutoff = timezone.now() - timedelta(minutes=options['older_than'])
+        stale = PaymentTransaction.objects.filter(
+            status=PaymentTransaction.PENDING,
+            checkout_request_id__isnull=False,
+            created_at__lt=cutoff,
+        ).only('pk', 'checkout_request_id').order_by('pk')
+
+        started = time.monotonic()
+        queried = settled = errors = 0
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='reconcile') as pool:
+            while True:
+                # keyset over pk so each chunk is an index range scan
+                chunk = list(stale.filter(pk__gt=last_pk)[:options['chunk_size']])
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+                results = list(pool.map(self.query, chunk))
+                errors += results.count(False)
+                results = [result for result in results if result]
+                queried += len(chunk)
+                settled += payments.apply_query_results(results)
+                self.stdout.write("Queried %d, settled %d so far" % (queried, settled))
+
+        # an STK prompt lapses within minutes, and a paid one would have been claimed by its callback
+        expired = payments.expire_unknown(timezone.now() - timedelta(minutes=options['unknown_after']))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Reconciled %d of %d stale payments in %.1fs (%d query errors); failed %d unknown payments."
+            % (settled, queried, time.monotonic() - started, errors, expired)
+        ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from Fliq import inventory
+
+
+class Command(BaseCommand):
+    help = "Return stock held by checkouts whose reservation has expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Reservations released per transaction")
+
+    def handle(self, *args, **options):
+        released = inventory.release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Released %d expired reservations." % released))
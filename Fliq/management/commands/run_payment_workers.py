@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from Fliq import jobs
+from Fliq import payments  # noqa: F401  registers the payment job handlers
+
+logger = logging.getLogger("default")
+
+
+def run_job(job):
+    try:
+        jobs.run(job)
+    finally:
+        # worker threads each hold their own connection; don't leak it
+        connections.close_all()
+
+
+async def arun_job(job):
+    if job.kind in jobs.ASYNC_HANDLERS:
+        await jobs.arun(job)
+    else:
+        # kinds without an async handler run on a pool thread, as in threaded mode
+        await sync_to_async(run_job, thread_sensitive=False)(job)
+
+
+class Command(BaseCommand):
+    help = "Run background payment jobs (STK pushes) from the database job queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help="Jobs run concurrently")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Drain the due jobs and exit")
+        parser.add_argument(
+            '--asyncio', action='store_true',
+            help="Run jobs as coroutines on one event loop; STK pushes wait on M-Pesa without holding a thread",
+        )
+        parser.add_argument('--concurrency', type=int, default=50, help="Jobs run concurrently with --asyncio")
+
+    def handle(self, *args, **options):
+        if options['asyncio']:
+            self.stdout.write("Payment workers started on asyncio with concurrency %d." % options['concurrency'])
+            try:
+                asyncio.run(self.serve(options))
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping.")
+            self.stdout.write(self.style.SUCCESS("Payment workers stopped."))
+            return
+
+        threads = options['threads']
+        in_flight = set()
+        last_requeue = 0
+        self.stdout.write("Payment workers started with %d threads." % threads)
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='payment-worker') as pool:
+            try:
+                while True:
+                    close_old_connections()
+                    if time.monotonic() - last_requeue > jobs.LEASE_SECONDS / 2:
+                        jobs.requeue_abandoned()
+                        last_requeue = time.monotonic()
+
+                    claimed = jobs.claim(threads - len(in_flight)) if len(in_flight) < threads else []
+                    for job in claimed:
+                        in_flight.add(pool.submit(run_job, job))
+
+                    if not in_flight:
+                        if options['once']:
+                            break
+                        time.sleep(options['poll_interval'])
+                        continue
+                    done, in_flight = wait(in_flight, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() is not None:
+                            logger.error("Payment worker crashed: %s", future.exception())
+                    in_flight = set(in_flight)
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping, waiting for running jobs to finish...")
+        self.stdout.write(self.style.SUCCESS("Payment workers stopped."))
+
+    async def serve(self, options):
+        concurrency = options['concurrency']
+        in_flight = set()
+        last_requeue = 0
+        # database calls hop to one shared thread, which keeps a single connection
+        claim = sync_to_async(jobs.claim)
+        while True:
+            await sync_to_async(close_old_connections)()
+            if time.monotonic() - last_requeue > jobs.LEASE_SECONDS / 2:
+                await sync_to_async(jobs.requeue_abandoned)()
+                last_requeue = time.monotonic()
+
+            claimed = await claim(concurrency - len(in_flight)) if len(in_flight) < concurrency else []
+            for job in claimed:
+                in_flight.add(asyncio.ensure_future(arun_job(job)))
+
+            if not in_flight:
+                if options['once']:
+                    break
+                await asyncio.sleep(options['poll_interval'])
+                continue
+            done, in_flight = await asyncio.wait(in_flight, timeout=options['poll_interval'], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    logger.error("Payment worker crashed: %s", task.exception())
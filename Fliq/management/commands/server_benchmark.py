@@ -0,0 +1,235 @@
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+from django.urls import reverse
+
+from .benchmark import CONFIG_KEYS, percentile, seed_shop
+
+VIEWS = ('product_list', 'product_detail', 'cart_view', 'add_to_cart')
+
+SERVERS = ('wsgi', 'asgi')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the WSGI deployment (gunicorn, threaded workers, sync views) with the ASGI one "
+        "(uvicorn, async views) under concurrent load. Seeds a throwaway SQLite database, starts "
+        "each server on it in turn, drives the catalog and cart views from --concurrency "
+        "simulated shoppers for --duration seconds, and reports requests/sec and latency percentiles."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--lines', type=int, default=10, help="Cart lines per user")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+        parser.add_argument('--views', nargs='+', choices=VIEWS, default=list(VIEWS))
+        parser.add_argument('--concurrency', type=int, default=100, help="Simulated shoppers, one connection each")
+        parser.add_argument('--duration', type=float, default=20.0, help="Seconds of timed load per server")
+        parser.add_argument('--warmup', type=float, default=3.0, help="Seconds of untimed load per server")
+        parser.add_argument('--workers', type=int, default=2, help="Server processes")
+        parser.add_argument('--threads', type=int, default=8, help="Threads per gunicorn worker")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+
+    # dataset
+
+    def seed(self, directory, options):
+        """Create and migrate a SQLite file for the servers to share, and fill it"""
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        databases = runner.setup_databases()
+        # keep the seeding's cache writes out of the project's shared cache
+        with override_settings(CATALOG_CACHE='default', SESSION_CACHE_ALIAS='default'):
+            shop = seed_shop(*(options[key] for key in CONFIG_KEYS))
+        self.product_ids = shop.product_ids
+        self.category_slugs = shop.category_slugs
+        self.sessions = [client.cookies[settings.SESSION_COOKIE_NAME].value for client in shop.clients]
+        self.rng = shop.rng
+        database = connection.settings_dict['NAME']
+        # the servers open their own connections; don't hold a lock on the file
+        connections.close_all()
+        return runner, databases, database
+
+    def request(self, view, number):
+        """(path, session key or None) of the `number`th request to `view`"""
+        session = self.sessions[number % len(self.sessions)]
+        if view == 'product_list':
+            slug = self.category_slugs[number % len(self.category_slugs)]
+            return (reverse('home') + '?category=' + slug if number % 2 else reverse('home')), None
+        if view == 'product_detail':
+            return reverse('product_detail', args=[self.rng.choice(self.product_ids)]), None
+        if view == 'cart_view':
+            return reverse('cart_view'), session
+        return reverse('add_to_cart', args=[self.rng.choice(self.product_ids)]), session
+
+    # servers
+
+    def command(self, server, port, options):
+        if server == 'wsgi':
+            return [
+                sys.executable, '-m', 'gunicorn', 'LaFliq.wsgi:application',
+                '--bind', '127.0.0.1:%d' % port,
+                '--worker-class', 'gthread',
+                '--workers', str(options['workers']),
+                '--threads', str(options['threads']),
+                '--log-level', 'warning',
+            ]
+        return [
+            sys.executable, '-m', 'uvicorn', 'LaFliq.asgi:application',
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--workers', str(options['workers']),
+            '--log-level', 'warning',
+            '--no-access-log',
+        ]
+
+    def start(self, server, database, directory, options):
+        module = 'gunicorn' if server == 'wsgi' else 'uvicorn'
+        if importlib.util.find_spec(module) is None:
+            raise CommandError("%s is not installed (pip install %s)" % (module, module))
+        port = free_port()
+        env = dict(
+            os.environ,
+            SQLITE_PATH=database,
+            SHARED_CACHE_LOCATION=os.path.join(directory, 'cache-%s' % server),
+            ASYNC_VIEWS='true' if server == 'asgi' else 'false',
+        )
+        log = open(os.path.join(directory, '%s.log' % server), 'w+')
+        process = subprocess.Popen(
+            self.command(server, port, options), cwd=str(settings.BASE_DIR), env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+        return process, log, 'http://127.0.0.1:%d' % port
+
+    def stop(self, process, log):
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        log.close()
+
+    async def wait_until_ready(self, httpx, process, log, base_url, timeout=60):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            while time.monotonic() < deadline:
+                if process.poll() is not None:
+                    log.seek(0)
+                    raise CommandError("The server exited:\n%s" % log.read()[-2000:])
+                try:
+                    if (await client.get(reverse('home'))).status_code < 500:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise CommandError("The server at %s did not come up within %d seconds" % (base_url, timeout))
+
+    # load
+
+    async def drive(self, httpx, base_url, options, duration):
+        """Run the shoppers for `duration` seconds; returns (latencies in ms, error count)"""
+        latencies, errors = [], [0]
+        deadline = time.monotonic() + duration
+        views = options['views']
+
+        async def shopper(number):
+            # one keep-alive connection per shopper, like a browser tab
+            async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=httpx.Limits(max_connections=1)) as client:
+                count = 0
+                while time.monotonic() < deadline:
+                    view = views[(number + count) % len(views)]
+                    path, session = self.request(view, number + count * options['concurrency'])
+                    count += 1
+                    client.cookies.clear()
+                    if session:
+                        client.cookies.set(settings.SESSION_COOKIE_NAME, session)
+                    started = time.perf_counter()
+                    try:
+                        response = await client.get(path)
+                    except httpx.HTTPError:
+                        errors[0] += 1
+                        continue
+                    if response.status_code >= 400:
+                        errors[0] += 1
+                    else:
+                        latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(shopper(number) for number in range(options['concurrency'])))
+        return latencies, errors[0]
+
+    async def measure(self, server, database, directory, options):
+        import httpx
+
+        process, log, base_url = self.start(server, database, directory, options)
+        try:
+            await self.wait_until_ready(httpx, process, log, base_url)
+            await self.drive(httpx, base_url, options, options['warmup'])
+            latencies, errors = await self.drive(httpx, base_url, options, options['duration'])
+        finally:
+            self.stop(process, log)
+        if not latencies:
+            raise CommandError("No request to the %s server succeeded" % server)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'requests_per_second': round(len(latencies) / options['duration'], 1),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p90_ms': round(percentile(latencies, 0.90), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+        }
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec('httpx') is None:
+            raise CommandError("httpx is not installed (pip install httpx)")
+        if connection.vendor != 'sqlite':
+            raise CommandError("The server benchmark seeds a SQLite file; run it with the SQLite settings")
+
+        directory = tempfile.mkdtemp(prefix='fliq-server-benchmark-')
+        runner, databases, database = self.seed(directory, options)
+        try:
+            results = {}
+            for server in options['servers']:
+                self.stdout.write("Benchmarking %s..." % server)
+                results[server] = asyncio.run(self.measure(server, database, directory, options))
+        finally:
+            runner.teardown_databases(databases)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write("%-6s %10s %9s %9s %9s %8s" % ('server', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors'))
+        for server, result in results.items():
+            self.stdout.write("%-6s %10.1f %9.2f %9.2f %9.2f %8d" % (
+                server, result['requests_per_second'], result['p50_ms'], result['p90_ms'], result['p99_ms'], result['errors']
+            ))
+
+        if options['output']:
+            report = {
+                'config': {key: options[key] for key in CONFIG_KEYS + ('concurrency', 'duration', 'workers', 'threads')},
+                'views': options['views'],
+                'results': results,
+            }
+            with open(options['output'], 'w') as target:
+                json.dump(report, target, indent=2, sort_keys=True)
+                target.write('\n')
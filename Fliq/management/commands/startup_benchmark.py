@@ -0,0 +1,78 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# what a fresh worker does before it can serve its first request
+BOOT_SCRIPT = """
+import importlib
+from LaFliq.wsgi import application
+from django.conf import settings
+importlib.import_module(settings.ROOT_URLCONF)
+"""
+
+# a non-routable address: any connection attempt hangs until it times out
+BLACKHOLE_URL = "http://10.255.255.1/"
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cold-start time of LaFliq.wsgi (plus the URLconf and views) in fresh "
+        "interpreters and report the slowest imports from `python -X importtime`"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Number of cold starts to time")
+        parser.add_argument('--top', type=int, default=15, help="Number of slowest imports to list")
+        parser.add_argument(
+            '--unreachable-provider',
+            action='store_true',
+            help="Point the M-Pesa URLs at a black-hole address to prove boot does no payment I/O",
+        )
+
+    def boot(self, environment):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT],
+            cwd=str(settings.BASE_DIR),
+            env=environment,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        return elapsed, result.stderr
+
+    def parse_importtime(self, report):
+        """Return [(cumulative_us, module)] from a -X importtime report"""
+        imports = []
+        for line in report.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _self, cumulative, module = line[len('import time:'):].split('|', 2)
+            imports.append((int(cumulative), module.strip()))
+        return imports
+
+    def handle(self, *args, **options):
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'LaFliq.settings'))
+        if options['unreachable_provider']:
+            environment.update(access_token_url=BLACKHOLE_URL, checkout_url=BLACKHOLE_URL)
+
+        timings, report = [], ''
+        for _run in range(options['runs']):
+            elapsed, report = self.boot(environment)
+            timings.append(elapsed)
+
+        self.stdout.write("Cold start over %d runs:" % len(timings))
+        self.stdout.write("  min    %.1f ms" % (min(timings) * 1000))
+        self.stdout.write("  median %.1f ms" % (statistics.median(timings) * 1000))
+        self.stdout.write("  max    %.1f ms" % (max(timings) * 1000))
+
+        self.stdout.write("\nSlowest imports (cumulative, last run):")
+        for cumulative, module in sorted(self.parse_importtime(report), reverse=True)[:options['top']]:
+            self.stdout.write("  %8.1f ms  %s" % (cumulative / 1000, module))
@@ -0,0 +1,44 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the primary SQLite database into each SQLite read replica (SQLITE_REPLICA_PATHS), "
+        "standing in for replication when developing locally. Uses SQLite's online backup, so "
+        "the site can keep running. With --interval, repeats forever, which also gives the "
+        "replicas a realistic lag."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help="Seconds between copies; copy once without it")
+
+    def handle(self, *args, **options):
+        aliases = ['default'] + settings.CATALOG_READ_REPLICAS
+        if any(connections[alias].vendor != 'sqlite' for alias in aliases):
+            raise CommandError("Only SQLite primaries and replicas can be synced this way")
+        primary = settings.DATABASES['default']
+        replicas = [settings.DATABASES[alias] for alias in settings.CATALOG_READ_REPLICAS]
+        if not replicas:
+            raise CommandError("No replicas configured; set SQLITE_REPLICA_PATHS")
+
+        while True:
+            started = time.perf_counter()
+            source = sqlite3.connect(str(primary['NAME']))
+            try:
+                for replica in replicas:
+                    target = sqlite3.connect(str(replica['NAME']))
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write("Synced %d replica(s) in %.0f ms." % (len(replicas), (time.perf_counter() - started) * 1000))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
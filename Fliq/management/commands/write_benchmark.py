@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+from django.urls import reverse
+
+from .benchmark import CONFIG_KEYS, percentile, seed_shop
+
+# what each profile changes on top of the configured database; pragmas apply to SQLite only
+PROFILES = {
+    'sqlite-rollback': {
+        'vendor': 'sqlite',
+        'pragmas': {'journal_mode': 'delete', 'synchronous': 'full'},
+        'conn_max_age': 0,
+    },
+    'sqlite-wal': {
+        'vendor': 'sqlite',
+        'pragmas': None,
+        'conn_max_age': None,
+    },
+    'postgresql-per-request': {
+        'vendor': 'postgresql',
+        'conn_max_age': 0,
+    },
+    'postgresql-persistent': {
+        'vendor': 'postgresql',
+        'conn_max_age': None,
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure add-to-cart write throughput under each database profile. Seeds a throwaway "
+        "database (a temporary SQLite file, or the Postgres test database with DATABASE_URL), then "
+        "for each profile sends add_to_cart requests from --threads concurrent shoppers through "
+        "the full middleware stack for --duration seconds and reports writes/sec, latency and "
+        "how many failed, e.g. with \"database is locked\". "
+        "sqlite-rollback is Django's bare SQLite (rollback journal, no persistent connections); "
+        "sqlite-wal and postgresql-persistent are the configured profiles."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--lines', type=int, default=10, help="Cart lines per user")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--threads', type=int, default=16, help="Concurrent shoppers")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds of load per profile")
+        parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), help="Defaults to every profile for this backend")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+
+    def settings_for(self, profile):
+        pragmas = profile.get('pragmas')
+        conn_max_age = profile['conn_max_age']
+        if conn_max_age is None:
+            conn_max_age = settings.DATABASES['default'].get('CONN_MAX_AGE', 0)
+        return (dict(settings.SQLITE_PRAGMAS, **pragmas) if pragmas else settings.SQLITE_PRAGMAS), conn_max_age
+
+    def measure(self, shop, profile, options):
+        pragmas, conn_max_age = self.settings_for(profile)
+        # new connections pick these up; every thread below opens its own
+        connections.close_all()
+        connections.settings['default']['CONN_MAX_AGE'] = conn_max_age
+        journal_mode = None
+        with override_settings(SQLITE_PRAGMAS=pragmas):
+            if connection.vendor == 'sqlite':
+                # the journal mode is stored in the file; switch it while nothing else is connected
+                connection.ensure_connection()
+                journal_mode = connection.connection.execute('PRAGMA journal_mode').fetchone()[0]
+                connection.close()
+        latencies, failures, lock = [], [], threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def shopper(number):
+            client = shop.clients[number % len(shop.clients)]
+            count = 0
+            try:
+                while time.monotonic() < deadline:
+                    product_id = shop.product_ids[(number * 7919 + count) % len(shop.product_ids)]
+                    count += 1
+                    started = time.perf_counter()
+                    try:
+                        response = client.get(reverse('add_to_cart', args=[product_id]))
+                    except OperationalError as err:
+                        with lock:
+                            failures.append(str(err))
+                        continue
+                    elapsed = (time.perf_counter() - started) * 1000
+                    with lock:
+                        if response.status_code >= 400:
+                            failures.append('HTTP %d' % response.status_code)
+                        else:
+                            latencies.append(elapsed)
+            finally:
+                connections.close_all()
+
+        with override_settings(SQLITE_PRAGMAS=pragmas):
+            threads = [threading.Thread(target=shopper, args=(number,)) for number in range(options['threads'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if not latencies:
+            raise CommandError("Every add_to_cart failed: %s" % (failures[:1] or ['no requests sent']))
+        return {
+            'writes': len(latencies),
+            'writes_per_second': round(len(latencies) / options['duration'], 1),
+            'failed': len(failures),
+            'locked': sum('locked' in failure for failure in failures),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'journal_mode': journal_mode,
+            'conn_max_age': conn_max_age,
+        }
+
+    def handle(self, *args, **options):
+        profiles = options['profiles'] or [name for name, profile in PROFILES.items() if profile['vendor'] == connection.vendor]
+        wrong = [name for name in profiles if PROFILES[name]['vendor'] != connection.vendor]
+        if wrong:
+            raise CommandError("%s need a %s database" % (', '.join(wrong), PROFILES[wrong[0]]['vendor']))
+
+        if options['threads'] > options['users']:
+            raise CommandError("Each thread needs a user of its own; raise --users to at least --threads")
+
+        directory = tempfile.mkdtemp(prefix='fliq-write-benchmark-')
+        if connection.vendor == 'sqlite':
+            # a file rather than the in-memory test database, so journaling and locking are real
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        databases = runner.setup_databases()
+        original_conn_max_age = connections.settings['default'].get('CONN_MAX_AGE', 0)
+        try:
+            # a private cache keeps the shared one clean, and slow-request
+            # logging would only add noise while the database is saturated
+            with override_settings(
+                CATALOG_CACHE='default',
+                SESSION_CACHE_ALIAS='default',
+                SLOW_REQUEST_SECONDS=float('inf'),
+                SLOW_REQUEST_QUERIES=float('inf'),
+            ):
+                shop = seed_shop(*(options[key] for key in CONFIG_KEYS))
+                results = {}
+                for name in profiles:
+                    self.stdout.write("Benchmarking %s..." % name)
+                    results[name] = self.measure(shop, PROFILES[name], options)
+        finally:
+            connections.close_all()
+            connections.settings['default']['CONN_MAX_AGE'] = original_conn_max_age
+            runner.teardown_databases(databases)
+            runner.teardown_test_environment()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write("%-24s %10s %9s %9s %8s %8s %8s" % ('profile', 'writes/s', 'p50 ms', 'p99 ms', 'failed', 'locked', 'journal'))
+        for name, result in results.items():
+            self.stdout.write("%-24s %10.1f %9.2f %9.2f %8d %8d %8s" % (
+                name, result['writes_per_second'], result['p50_ms'], result['p99_ms'], result['failed'], result['locked'],
+                result['journal_mode'] or '-',
+            ))
+
+        if options['output']:
+            report = {
+                'config': {key: options[key] for key in CONFIG_KEYS + ('threads', 'duration')},
+                'database': connection.vendor,
+                'results': results,
+            }
+            with open(options['output'], 'w') as target:
+                json.dump(report, target, indent=2, sort_keys=True)
+                target.write('\n')
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from Fliq import search
+
+    search.create_index(schema_editor.connection)
+    search.rebuild_index(using=schema_editor.connection.alias)
+
+
+def drop_search_index(apps, schema_editor):
+    from Fliq import search
+
+    search.drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Fliq', '0004_product_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
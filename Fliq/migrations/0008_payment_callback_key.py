@@ -0,0 +1,27 @@
+# Generated by Django 4.2.1 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Fliq', '0007_job_paymenttransaction'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='stockreservation',
+            name='checkout_request_id',
+        ),
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='receipt_number',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='paymenttransaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,100 @@
+from functools import reduce
+from operator import or_
+
+from django.db import migrations, transaction
+from django.db.models import Case, Count, IntegerField, Min, Q, Sum, Value, When
+
+BATCH_SIZE = 200
+
+
+def _repoint(queryset, moves):
+    """Point rows of `queryset` at the cart kept in place of each duplicate"""
+    queryset.filter(cart_id__in=list(moves)).update(
+        cart_id=Case(
+            *[When(cart_id=duplicate, then=Value(keep)) for duplicate, keep in moves.items()],
+            output_field=IntegerField(),
+        )
+    )
+
+
+def merge_carts(apps, using):
+    """Fold every user's extra carts into their oldest one"""
+    Cart = apps.get_model('Fliq', 'Cart')
+    related = [
+        apps.get_model('Fliq', 'CartItem').objects.using(using),
+        apps.get_model('Fliq', 'Order').objects.using(using),
+        apps.get_model('Fliq', 'PaymentTransaction').objects.using(using),
+    ]
+    carts = Cart.objects.using(using)
+    last_user = 0
+    while True:
+        user_ids = list(
+            carts.filter(user_id__gt=last_user)
+            .values('user_id')
+            .annotate(carts=Count('id'))
+            .filter(carts__gt=1)
+            .order_by('user_id')
+            .values_list('user_id', flat=True)[:BATCH_SIZE]
+        )
+        if not user_ids:
+            return
+        last_user = user_ids[-1]
+
+        keep, moves = {}, {}
+        for cart_id, user_id in carts.filter(user_id__in=user_ids).order_by('user_id', 'id').values_list('id', 'user_id'):
+            if user_id in keep:
+                moves[cart_id] = keep[user_id]
+            else:
+                keep[user_id] = cart_id
+        with transaction.atomic(using=using):
+            for queryset in related:
+                _repoint(queryset, moves)
+            carts.filter(id__in=list(moves)).delete()
+
+
+def merge_cart_lines(apps, using):
+    """Collapse repeated (cart, product) lines into one, summing quantities"""
+    items = apps.get_model('Fliq', 'CartItem').objects.using(using)
+    last_cart = 0
+    while True:
+        # merged groups drop out of this query, so resuming at the last cart seen misses nothing
+        groups = list(
+            items.filter(cart_id__gte=last_cart)
+            .values('cart_id', 'product_id')
+            .annotate(lines=Count('id'), keep=Min('id'), total=Sum('quantity'))
+            .filter(lines__gt=1)
+            .order_by('cart_id', 'product_id')[:BATCH_SIZE]
+        )
+        if not groups:
+            return
+        last_cart = groups[-1]['cart_id']
+
+        with transaction.atomic(using=using):
+            items.filter(id__in=[group['keep'] for group in groups]).update(
+                quantity=Case(
+                    *[When(id=group['keep'], then=Value(group['total'])) for group in groups],
+                    output_field=IntegerField(),
+                )
+            )
+            items.filter(
+                reduce(or_, [Q(cart_id=group['cart_id'], product_id=group['product_id']) for group in groups])
+            ).exclude(id__in=[group['keep'] for group in groups]).delete()
+
+
+def merge_duplicates(apps, schema_editor):
+    using = schema_editor.connection.alias
+    merge_carts(apps, using)
+    merge_cart_lines(apps, using)
+
+
+class Migration(migrations.Migration):
+    # each batch commits on its own so large tables aren't locked for the whole merge
+    atomic = False
+
+    dependencies = [
+        ('Fliq', '0012_catalog_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Fliq', '0015_order_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymenttransaction',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('unknown', 'Unknown'), ('success', 'Success'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+    ]
@@ -6,17 +6,32 @@ from django.contrib.auth.models import User
 class Category(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
 
 class Product(models.Model):
+    # supplier stock-keeping unit; the natural key catalog imports upsert on
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     name = models.CharField(max_length=200)
     description = models.TextField()
     image = models.ImageField(upload_to='products/')
+    # {"source": <image name>, "widths": [...]} once resized copies exist, see images.py
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     price = models.DecimalField(max_digits=8, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     stock = models.PositiveIntegerField(default=0)
+    # indexed so "when did the catalog last change" is a single index lookup
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # keyset pagination orderings used by the catalog
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['category', 'id'], name='product_category_id_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_cat_price_id_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -25,14 +40,114 @@ class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # concurrent first visits must not give a user two carts
+            models.UniqueConstraint(fields=['user'], name='cart_one_per_user'),
+        ]
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            # one line per product; also the index cart lookups and add-to-cart upserts use
+            models.UniqueConstraint(fields=['cart', 'product'], name='cartitem_cart_product_uniq'),
+        ]
     
     def get_total_cost(self):
         return self.quantity * self.product.price
 
+class StockReservation(models.Model):
+    HELD = 'held'
+    COMMITTED = 'committed'
+    RELEASED = 'released'
+    STATUS_CHOICES = (
+        (HELD, 'Held'),
+        (COMMITTED, 'Committed'),
+        (RELEASED, 'Released'),
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    reference = models.CharField(max_length=64, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=HELD)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # sweeper scan: held reservations past their expiry
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry_idx'),
+        ]
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (DEAD, 'Dead'),
+    )
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField()
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # workers claim the oldest due jobs of a given status
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return '{} #{} ({})'.format(self.kind, self.pk, self.status)
+
+class PaymentTransaction(models.Model):
+    PENDING = 'pending'
+    # the STK push timed out after it was sent: it may or may not have reached the phone
+    UNKNOWN = 'unknown'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (UNKNOWN, 'Unknown'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed'),
+    )
+    reference = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments')
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True, blank=True)
+    phone_number = models.CharField(max_length=20)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # the callback's only key back to us; unique so lookups are a single index probe
+    checkout_request_id = models.CharField(max_length=64, null=True, blank=True, unique=True)
+    receipt_number = models.CharField(max_length=20, blank=True)
+    result_code = models.IntegerField(null=True, blank=True)
+    result_description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # reconciliation scans stale pending payments
+            models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return self.reference
+
 class ContactInfo(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     email = models.EmailField(max_length=255, null=True, blank=True)
@@ -46,22 +161,51 @@ class Profile(models.Model):
     address = models.CharField(max_length=255, null=True, blank=True)
 
 class Order(models.Model):
+    PENDING = 'pending'
+    # paid, but its stock was released before the payment came through: refund or fulfil by hand
+    REVIEW = 'review'
+    PROCESSING = 'processing'
+    SHIPPED = 'shipped'
+    DELIVERED = 'delivered'
+    CANCELLED = 'cancelled'
     STATUS_CHOICES = (
-        ('processing', 'Processing'),
-        ('shipped', 'Shipped'),
-        ('delivered', 'Delivered'),
+        (PENDING, 'Awaiting payment'),
+        (REVIEW, 'Paid, under review'),
+        (PROCESSING, 'Processing'),
+        (SHIPPED, 'Shipped'),
+        (DELIVERED, 'Delivered'),
+        (CANCELLED, 'Cancelled'),
     )
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='orders')
+    # the cart it was placed from; the order's contents live in OrderItem
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders')
+    # the PaymentTransaction/StockReservation reference of the checkout that placed it
+    reference = models.CharField(max_length=64, unique=True, null=True, blank=True)
     total_amount = models.DecimalField(max_digits=8, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='processing')
-    contact_info = models.ForeignKey(ContactInfo, on_delete=models.CASCADE)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PROCESSING)
+    contact_info = models.ForeignKey(ContactInfo, on_delete=models.CASCADE, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # a user's order history, newest first (keyset pages scan it backwards)
+            models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        if not self.contact_info:
-            profile = self.user.profile
-            self.contact_info = profile.contact_info
+        if self.contact_info_id is None:
+            self.contact_info_id = self.user.profile.contact_info_id
         super().save(*args, **kwargs)
 
+class OrderItem(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
+    # name and price are copied at purchase so later catalog edits don't rewrite history
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
+    product_name = models.CharField(max_length=200)
+    unit_price = models.DecimalField(max_digits=8, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+    def get_total_cost(self):
+        return self.quantity * self.unit_price
+
 
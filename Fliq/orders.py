@@ -0,0 +1,72 @@
+"""
+Orders.
+
+An order is a snapshot of a cart taken at checkout: its lines are copied
+into OrderItem rows along with the product name and price of the moment,
+so editing the cart or the catalog afterwards never rewrites order history.
+Orders start out pending and follow the outcome of their payment.
+"""
+from collections import Counter
+
+from django.db import transaction
+
+from .cart import summarize_cart
+from .models import Order, OrderItem
+from .pagination import DEFAULT_PAGE_SIZE, paginate
+
+HISTORY_ORDERING = ('-created_at', '-id')
+
+# a payment may still succeed after we failed it and cancelled its order
+AWAITING_PAYMENT = (Order.PENDING, Order.CANCELLED)
+
+
+def place_order(user, cart, reference):
+    """Snapshot `cart` into a pending Order plus its items with one bulk INSERT"""
+    summary = summarize_cart(cart)
+    with transaction.atomic():
+        order = Order.objects.create(
+            user=user, cart=cart, reference=reference, total_amount=summary.total, status=Order.PENDING
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product_id=item.product_id,
+                product_name=item.product.name,
+                unit_price=item.product.price,
+                quantity=item.quantity,
+            )
+            for item in summary.items
+        ])
+    return order
+
+
+def mark_paid(reference):
+    return Order.objects.filter(reference=reference, status__in=AWAITING_PAYMENT).update(status=Order.PROCESSING)
+
+
+def cancel(reference):
+    return Order.objects.filter(reference=reference, status=Order.PENDING).update(status=Order.CANCELLED)
+
+
+def flag_for_review(reference):
+    return Order.objects.filter(reference=reference, status__in=AWAITING_PAYMENT).update(status=Order.REVIEW)
+
+
+def ordered_quantities(reference):
+    """{product_id: quantity} of the order placed under `reference`"""
+    quantities = Counter()
+    for product_id, quantity in OrderItem.objects.filter(
+        order__reference=reference, product__isnull=False
+    ).values_list('product_id', 'quantity'):
+        quantities[product_id] += quantity
+    return dict(quantities)
+
+
+def order_history(user, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """A KeysetPage of the user's orders, newest first, in two queries (orders, then their items)"""
+    return paginate(
+        Order.objects.filter(user=user).prefetch_related('items'),
+        HISTORY_ORDERING,
+        cursor=cursor,
+        page_size=page_size,
+    )
@@ -0,0 +1,186 @@
+"""
+Keyset (cursor) pagination for the catalog and order history.
+
+Rather than OFFSET, each page is located by the ordering values of the last
+(or first) row of the previous page, so fetching page 1000 costs the same as
+fetching page 1 as long as the ordering is backed by an index.
+"""
+import base64
+import binascii
+import datetime
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import timezone
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 96
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+# the widest integer any backend stores; larger cursor values overflow the driver
+MAX_INTEGER = 2 ** 63 - 1
+
+
+class KeysetPage:
+    """A single page of results plus the cursors that lead away from it"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _cursor_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        # ISO strings are parsed back by the DateTimeField lookups
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values, direction):
+    payload = json.dumps([direction, [_cursor_value(v) for v in values]])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _coerce(field, value):
+    """`value` as `field` stores it; ValidationError if it isn't one"""
+    if value is None or isinstance(value, (dict, list)):
+        raise ValidationError('Not a cursor value')
+    value = field.to_python(value)
+    if isinstance(value, int) and not -MAX_INTEGER <= value <= MAX_INTEGER:
+        raise ValidationError('Out of range')
+    if isinstance(value, datetime.datetime) and settings.USE_TZ and timezone.is_naive(value):
+        # encode_cursor writes aware timestamps; a naive one was made up
+        raise ValidationError('Naive datetime')
+    field.run_validators(value)
+    return value
+
+
+def decode_cursor(cursor, fields):
+    """
+    Decode a cursor produced by encode_cursor. `fields` are the model fields
+    of the ordering (see `ordering_fields`), which each value must be valid for.
+
+    Returns (direction, values), or (None, None) for a missing or tampered
+    cursor so the caller falls back to the first page.
+    """
+    if not cursor:
+        return None, None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError, binascii.Error):
+        return None, None
+    if direction not in (NEXT, PREVIOUS) or not isinstance(values, list) or len(values) != len(fields):
+        return None, None
+    try:
+        return direction, [_coerce(field, value) for field, value in zip(fields, values)]
+    except (ValidationError, ValueError, TypeError, ArithmeticError):
+        return None, None
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(page_size, maximum))
+
+
+def _field_name(field):
+    return field.lstrip('-')
+
+
+def ordering_fields(model, ordering):
+    """The model fields behind `ordering`, for decode_cursor"""
+    return [model._meta.get_field(_field_name(field)) for field in ordering]
+
+
+def _reverse_ordering(ordering):
+    return [_field_name(field) if field.startswith('-') else '-' + field for field in ordering]
+
+
+def _keyset_filter(ordering, values, backwards=False):
+    """
+    Build the row-value comparison "comes after (x, y) in `ordering`" as
+    a > x OR (a = x AND b > y), which every backend can serve from an index.
+    Descending ('-a') fields compare with < instead, and `backwards` flips
+    every comparison to select the rows that come before.
+    """
+    condition = Q()
+    for position, field in enumerate(ordering):
+        lookup = 'lt' if field.startswith('-') != backwards else 'gt'
+        clause = Q(**{'%s__%s' % (_field_name(field), lookup): values[position]})
+        for previous_field, previous_value in zip(ordering[:position], values[:position]):
+            clause &= Q(**{_field_name(previous_field): previous_value})
+        condition |= clause
+    return condition
+
+
+def _page_query(queryset, ordering, cursor, page_size):
+    """The query for the page `cursor` points at, fetching one extra row to detect more"""
+    direction, values = decode_cursor(cursor, ordering_fields(queryset.model, ordering))
+
+    if direction == PREVIOUS:
+        queryset = queryset.filter(_keyset_filter(ordering, values, backwards=True))
+        queryset = queryset.order_by(*_reverse_ordering(ordering))
+    else:
+        if direction == NEXT:
+            queryset = queryset.filter(_keyset_filter(ordering, values))
+        queryset = queryset.order_by(*ordering)
+    return direction, queryset[:page_size + 1]
+
+
+def _build_page(rows, ordering, direction, page_size):
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if direction == PREVIOUS:
+        rows.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, direction == NEXT
+
+    def row_values(obj):
+        return [getattr(obj, _field_name(field)) for field in ordering]
+
+    next_cursor = encode_cursor(row_values(rows[-1]), NEXT) if rows and has_next else None
+    previous_cursor = encode_cursor(row_values(rows[0]), PREVIOUS) if rows and has_previous else None
+    return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+def paginate(queryset, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Return a KeysetPage of `queryset` ordered by the `ordering` fields
+    ('-field' for descending). The last field must be unique (normally 'id')
+    so the order is total.
+    """
+    direction, query = _page_query(queryset, ordering, cursor, page_size)
+    return _build_page(list(query), ordering, direction, page_size)
+
+
+async def apaginate(queryset, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """`paginate` for async views, fetching the rows with the async ORM"""
+    direction, query = _page_query(queryset, ordering, cursor, page_size)
+    return _build_page([obj async for obj in query], ordering, direction, page_size)
@@ -0,0 +1,374 @@
+"""
+M-Pesa checkout flow.
+
+Checkout reserves stock, snapshots the cart into a pending Order, records a
+pending PaymentTransaction and enqueues
+an STK push job, then returns straight away; the push itself is sent by
+`manage.py run_payment_workers`. The customer's browser polls the payment
+status until the M-Pesa callback settles it; the callback itself only
+records the result and leaves the stock bookkeeping to a follow-up job.
+"""
+import logging
+import uuid
+from decimal import Decimal, InvalidOperation
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import inventory, jobs, orders
+from .exceptions import (
+    EmptyCartError, InsufficientStockError, MpesaConfigurationException, MpesaConnectionError,
+    MpesaInvalidParameterException, MpesaUnknownResultError,
+)
+from .models import Cart, CartItem, Job, PaymentTransaction
+from .utils import get_gateway
+
+logger = logging.getLogger("default")
+
+STK_PUSH = 'stk_push'
+APPLY_CALLBACK = 'apply_callback'
+SETTLE_STOCK = 'settle_stock'
+
+CALLBACK_URL = "http://pos.pos.ocratsystems.co.ke/callback/"
+ACCOUNT_REFERENCE = "LaFliq"
+TRANSACTION_DESCRIPTION = "Payment"
+
+
+UNSETTLED = (PaymentTransaction.PENDING, PaymentTransaction.UNKNOWN)
+
+
+def start_payment(user, cart, phone_number):
+    """
+    Reserve the cart's stock, place its order, empty the cart into it and
+    queue the STK push for the order total. Raises InsufficientStockError,
+    leaving nothing behind, if stock ran out, and EmptyCartError for a cart
+    with no lines.
+
+    The cart row is locked first, so a checkout submitted twice waits for
+    the first one, finds the cart emptied and gets that checkout's
+    unsettled payment back instead of placing a second order.
+    """
+    reference = uuid.uuid4().hex
+    with transaction.atomic():
+        Cart.objects.select_for_update().only('pk').get(pk=cart.pk)
+        if not CartItem.objects.filter(cart=cart).exists():
+            payment = PaymentTransaction.objects.filter(
+                cart=cart, user=user, status__in=UNSETTLED
+            ).order_by('-created_at').first()
+            if payment is None:
+                raise EmptyCartError(cart.pk)
+            return payment
+        inventory.reserve_cart(cart, reference)
+        order = orders.place_order(user, cart, reference)
+        payment = PaymentTransaction.objects.create(
+            reference=reference,
+            user=user,
+            cart=cart,
+            phone_number=phone_number,
+            amount=order.total_amount,
+        )
+        CartItem.objects.filter(cart=cart).delete()
+        jobs.enqueue(STK_PUSH, {'reference': reference})
+    return payment
+
+
+def fail_payment(reference, description):
+    """Mark a still-pending (or unknown) payment failed and give its stock back"""
+    with transaction.atomic():
+        failed = PaymentTransaction.objects.filter(reference=reference, status__in=UNSETTLED).update(
+            status=PaymentTransaction.FAILED, result_description=description[:255]
+        )
+        if failed:
+            inventory.release(reference=reference)
+            orders.cancel(reference)
+    return failed
+
+
+def mark_unknown(reference, description):
+    """
+    Park a payment whose STK push may have reached the phone without us
+    hearing back. Resending could prompt (and charge) the customer twice, so
+    it waits instead: a callback claims it (`apply_callback`), or
+    `expire_unknown` fails it once no callback can be coming.
+    """
+    return PaymentTransaction.objects.filter(reference=reference, status=PaymentTransaction.PENDING).update(
+        status=PaymentTransaction.UNKNOWN, result_description=description[:255]
+    )
+
+
+NO_ANSWER = 'No answer from M-Pesa'
+
+
+def expire_unknown(before):
+    """Fail the unknown payments created before `before` that no callback claimed"""
+    references = PaymentTransaction.objects.filter(
+        status=PaymentTransaction.UNKNOWN, created_at__lt=before
+    ).values_list('reference', flat=True)
+    return sum(fail_payment(reference, NO_ANSWER) for reference in list(references))
+
+
+def callback_metadata(stk_callback):
+    """
+    Flatten CallbackMetadata.Item into {Name: Value}. The callback endpoint
+    is unauthenticated, so anything not shaped like Daraja's items is skipped.
+    """
+    metadata = stk_callback.get('CallbackMetadata')
+    items = metadata.get('Item') if isinstance(metadata, dict) else None
+    if not isinstance(items, list):
+        return {}
+    return {
+        item['Name']: item.get('Value')
+        for item in items if isinstance(item, dict) and isinstance(item.get('Name'), str)
+    }
+
+
+# pushes that may have reached the phone without us hearing back: still
+# unknown, or already failed by `expire_unknown`
+UNANSWERED = Q(status=PaymentTransaction.UNKNOWN) | Q(status=PaymentTransaction.FAILED, result_description=NO_ANSWER)
+
+
+def _claim_unanswered_payment(checkout_request_id, metadata):
+    """
+    Hand the CheckoutRequestID of a callback that matches no payment to the
+    oldest unanswered payment for the same phone number and amount, whose
+    push must have gone through after all. An unknown payment goes back to
+    pending; an expired one stays failed for `apply_callback` to revive.
+    Only successful callbacks carry the phone number and amount; the push
+    sent the amount in whole shillings.
+    """
+    try:
+        amount = Decimal(str(metadata['Amount']))
+        phone_number = str(metadata['PhoneNumber'])
+    except (KeyError, InvalidOperation):
+        return 0
+    candidate = PaymentTransaction.objects.filter(
+        UNANSWERED,
+        checkout_request_id__isnull=True,
+        phone_number=phone_number,
+        amount__gte=amount,
+        amount__lt=amount + 1,
+    ).order_by('created_at').values_list('pk', 'status').first()
+    if candidate is None:
+        return 0
+    pk, status = candidate
+    return PaymentTransaction.objects.filter(pk=pk, status=status, checkout_request_id__isnull=True).update(
+        checkout_request_id=checkout_request_id,
+        status=PaymentTransaction.PENDING if status == PaymentTransaction.UNKNOWN else status,
+    )
+
+
+def _early_callback_expected():
+    """
+    Whether a callback for an unknown CheckoutRequestID may have beaten its
+    worker to storing the ID. That needs a push in flight (a pending payment
+    with no CheckoutRequestID yet), and no more are queued than there are
+    pushes in flight: the callback endpoint is unauthenticated, so anyone
+    can post made-up IDs to it.
+    """
+    in_flight = PaymentTransaction.objects.filter(
+        status=PaymentTransaction.PENDING, checkout_request_id__isnull=True
+    ).count()
+    if not in_flight:
+        return False
+    waiting = Job.objects.filter(kind=APPLY_CALLBACK, status__in=(Job.QUEUED, Job.RUNNING)).count()
+    return waiting < in_flight
+
+
+def apply_callback(stk_callback):
+    """
+    Record the outcome of an STK push from its callback body.
+
+    This is one conditional UPDATE on the unique CheckoutRequestID, so
+    duplicate deliveries are no-ops. Stock is settled later by a job.
+    A callback that beats the worker to storing its CheckoutRequestID is
+    queued and applied once the payment row catches up (while pushes are
+    in flight; otherwise it is logged and dropped); one for a push whose
+    outcome was unknown claims that payment first.
+
+    The customer has paid once a success arrives, even for a payment we
+    already failed (expired, or failed by a status query): that payment is
+    moved to success and its settle job takes the stock again or sends the
+    order to review.
+    """
+    checkout_request_id = stk_callback['CheckoutRequestID']
+    result_code = int(stk_callback['ResultCode'])
+    metadata = callback_metadata(stk_callback)
+
+    def record(status):
+        return PaymentTransaction.objects.filter(
+            checkout_request_id=checkout_request_id, status=status
+        ).update(
+            status=PaymentTransaction.SUCCESS if result_code == 0 else PaymentTransaction.FAILED,
+            result_code=result_code,
+            result_description=str(stk_callback.get('ResultDesc', ''))[:255],
+            receipt_number=str(metadata.get('MpesaReceiptNumber') or '')[:20],
+        )
+
+    applied = record(PaymentTransaction.PENDING)
+    if not applied and _claim_unanswered_payment(checkout_request_id, metadata):
+        applied = record(PaymentTransaction.PENDING)
+    if not applied and result_code == 0:
+        applied = record(PaymentTransaction.FAILED)
+        if applied:
+            logger.error("STK push %s was paid after its payment was failed; settling it late", checkout_request_id)
+    if applied:
+        jobs.enqueue(SETTLE_STOCK, {'checkout_request_id': checkout_request_id})
+    elif not PaymentTransaction.objects.filter(checkout_request_id=checkout_request_id).exists():
+        if _early_callback_expected():
+            jobs.enqueue(APPLY_CALLBACK, {'stk_callback': stk_callback}, delay=5)
+        else:
+            logger.warning("Dropped STK callback for unknown CheckoutRequestID %s", checkout_request_id)
+    return applied
+
+
+def apply_query_results(results):
+    """
+    Apply STK push query outcomes in bulk.
+
+    `results` is a list of (payment_pk, result_code, description). Payments
+    that were settled by a callback in the meantime are left alone; the rest
+    are written with one bulk UPDATE and their stock settled by queued jobs.
+    Returns the number of payments settled.
+    """
+    if not results:
+        return 0
+    now = timezone.now()
+    with transaction.atomic():
+        pending = PaymentTransaction.objects.select_for_update().filter(
+            pk__in=[pk for pk, _code, _description in results], status=PaymentTransaction.PENDING
+        ).only('pk', 'checkout_request_id').in_bulk()
+        settled = []
+        for pk, result_code, description in results:
+            payment = pending.get(pk)
+            if payment is None:
+                continue
+            payment.status = PaymentTransaction.SUCCESS if result_code == 0 else PaymentTransaction.FAILED
+            payment.result_code = result_code
+            payment.result_description = description[:255]
+            payment.updated_at = now
+            settled.append(payment)
+        PaymentTransaction.objects.bulk_update(settled, ['status', 'result_code', 'result_description', 'updated_at'])
+        jobs.enqueue_many(SETTLE_STOCK, [{'checkout_request_id': payment.checkout_request_id} for payment in settled])
+    return len(settled)
+
+
+@jobs.register(APPLY_CALLBACK)
+def apply_early_callback(payload):
+    checkout_request_id = payload['stk_callback']['CheckoutRequestID']
+    if not PaymentTransaction.objects.filter(checkout_request_id=checkout_request_id).exists():
+        raise jobs.RetryLater('No payment with CheckoutRequestID {} yet'.format(checkout_request_id))
+    apply_callback(payload['stk_callback'])
+
+
+def _hold_again(reference):
+    """Take the order's stock once more after its reservation expired; False if it has run out"""
+    try:
+        with transaction.atomic():
+            inventory.reserve(orders.ordered_quantities(reference), reference)
+            return bool(inventory.commit(reference=reference))
+    except InsufficientStockError:
+        return False
+
+
+@jobs.register(SETTLE_STOCK)
+def settle_stock(payload):
+    """
+    Sell or give back the stock held for a settled payment and move its
+    order on. A payment that succeeds after its reservation was released
+    (by the sweeper, or by failing the payment) takes the stock again if it
+    is still there; otherwise its order is paid for but unfillable, and
+    goes to review for a refund.
+    """
+    payment = PaymentTransaction.objects.only('reference', 'status').get(
+        checkout_request_id=payload['checkout_request_id']
+    )
+    if payment.status == PaymentTransaction.SUCCESS:
+        if inventory.commit(reference=payment.reference) or _hold_again(payment.reference):
+            orders.mark_paid(payment.reference)
+        else:
+            orders.flag_for_review(payment.reference)
+            logger.error("Payment %s succeeded after its stock was released and sold; order needs a refund", payment.reference)
+    elif payment.status == PaymentTransaction.FAILED:
+        inventory.release(reference=payment.reference)
+        orders.cancel(payment.reference)
+
+
+def _stk_push_dead(payload):
+    fail_payment(payload['reference'], 'Could not reach M-Pesa')
+
+
+def _stk_push_arguments(payment):
+    return {
+        'phone_number': payment.phone_number,
+        'amount': int(payment.amount),
+        'callback_url': CALLBACK_URL,
+        'account_reference': ACCOUNT_REFERENCE,
+        'transaction_desc': TRANSACTION_DESCRIPTION,
+    }
+
+
+def _stk_push_rejection(response):
+    """The CheckoutRequestID of an accepted push, or (None, why it was rejected)"""
+    checkout_request_id = response.json().get('CheckoutRequestID') if response.ok else None
+    if checkout_request_id:
+        return checkout_request_id, None
+    return None, response.error_message or response.response_description or 'STK push rejected'
+
+
+@jobs.register(STK_PUSH, on_dead=_stk_push_dead)
+def send_stk_push(payload):
+    reference = payload['reference']
+    payment = PaymentTransaction.objects.get(reference=reference)
+    if payment.status != PaymentTransaction.PENDING or payment.checkout_request_id:
+        # settled or already sent by an earlier attempt
+        return
+
+    try:
+        response = get_gateway().stk_push(**_stk_push_arguments(payment))
+    except MpesaUnknownResultError as err:
+        # sent, but unanswered: never resend a push
+        mark_unknown(reference, str(err))
+        return
+    except MpesaConnectionError as err:
+        # nothing reached the phone (no connection, or a refused token the gateway has
+        # dropped), so another attempt, with a fresh token, is safe
+        raise jobs.RetryLater(str(err))
+    except (MpesaConfigurationException, MpesaInvalidParameterException) as err:
+        fail_payment(reference, str(err))
+        return
+
+    checkout_request_id, rejection = _stk_push_rejection(response)
+    if rejection:
+        fail_payment(reference, rejection)
+        return
+
+    PaymentTransaction.objects.filter(reference=reference).update(checkout_request_id=checkout_request_id)
+
+
+@jobs.register_async(STK_PUSH)
+async def asend_stk_push(payload):
+    """`send_stk_push` for the asyncio workers: many pushes wait on Daraja at once without a thread each"""
+    reference = payload['reference']
+    payment = await PaymentTransaction.objects.aget(reference=reference)
+    if payment.status != PaymentTransaction.PENDING or payment.checkout_request_id:
+        return
+
+    try:
+        response = await get_gateway().astk_push(**_stk_push_arguments(payment))
+    except MpesaUnknownResultError as err:
+        await sync_to_async(mark_unknown)(reference, str(err))
+        return
+    except MpesaConnectionError as err:
+        raise jobs.RetryLater(str(err))
+    except (MpesaConfigurationException, MpesaInvalidParameterException) as err:
+        await sync_to_async(fail_payment)(reference, str(err))
+        return
+
+    checkout_request_id, rejection = _stk_push_rejection(response)
+    if rejection:
+        await sync_to_async(fail_payment)(reference, rejection)
+        return
+
+    await PaymentTransaction.objects.filter(reference=reference).aupdate(checkout_request_id=checkout_request_id)
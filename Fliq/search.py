@@ -0,0 +1,206 @@
+"""
+Full-text product search.
+
+Products are mirrored into an inverted index kept next to the catalog tables:
+an FTS5 virtual table on SQLite and a GIN-indexed tsvector table on Postgres.
+The index is maintained by the Product signals in signals.py and can be
+rebuilt from scratch with `manage.py rebuild_search_index`. Other backends
+fall back to a (slow) icontains scan.
+"""
+import re
+
+from django.db import connections, models, router, transaction
+from django.db.models import Q
+
+from .models import Product
+from .pagination import NEXT, PREVIOUS, KeysetPage, decode_cursor, encode_cursor, paginate
+
+SQLITE_TABLE = 'fliq_product_fts'
+POSTGRES_TABLE = 'fliq_product_search'
+
+# fields whose changes require the search document to be rewritten
+INDEXED_FIELDS = {'name', 'description'}
+
+# search results are ordered by (rank, id): the bm25/ts_rank score, then the product id
+SEARCH_CURSOR_FIELDS = (models.FloatField(), Product._meta.pk)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _vendor(connection):
+    return connection.vendor if connection.vendor in ('sqlite', 'postgresql') else None
+
+
+def create_index(connection):
+    """Create the index structures for `connection`'s backend"""
+    vendor = _vendor(connection)
+    with connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                "name, description, tokenize = 'porter unicode61')" % SQLITE_TABLE
+            )
+        elif vendor == 'postgresql':
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS %s ("
+                "product_id bigint PRIMARY KEY REFERENCES %s (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "document tsvector NOT NULL)" % (POSTGRES_TABLE, connection.ops.quote_name(Product._meta.db_table))
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS %s_document_idx ON %s USING GIN (document)"
+                % (POSTGRES_TABLE, POSTGRES_TABLE)
+            )
+
+
+def drop_index(connection):
+    vendor = _vendor(connection)
+    with connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute("DROP TABLE IF EXISTS %s" % SQLITE_TABLE)
+        elif vendor == 'postgresql':
+            cursor.execute("DROP TABLE IF EXISTS %s" % POSTGRES_TABLE)
+
+
+def _postgres_document_sql():
+    # product names weigh more than descriptions when ranking
+    return "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B')"
+
+
+def index_products(rows, using=None):
+    """
+    Write (id, name, description) tuples into the search index, replacing
+    any existing documents for those ids.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    connection = connections[using or router.db_for_write(Product)]
+    vendor = _vendor(connection)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.executemany(
+                "DELETE FROM %s WHERE rowid = %%s" % SQLITE_TABLE, [(row[0],) for row in rows]
+            )
+            cursor.executemany(
+                "INSERT INTO %s (rowid, name, description) VALUES (%%s, %%s, %%s)" % SQLITE_TABLE, rows
+            )
+        elif vendor == 'postgresql':
+            cursor.executemany(
+                "INSERT INTO %s (product_id, document) VALUES (%%s, %s) "
+                "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document"
+                % (POSTGRES_TABLE, _postgres_document_sql()),
+                rows,
+            )
+
+
+def unindex_products(product_ids, using=None):
+    product_ids = [(product_id,) for product_id in product_ids]
+    if not product_ids:
+        return
+    connection = connections[using or router.db_for_write(Product)]
+    vendor = _vendor(connection)
+    with connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % SQLITE_TABLE, product_ids)
+        elif vendor == 'postgresql':
+            cursor.executemany("DELETE FROM %s WHERE product_id = %%s" % POSTGRES_TABLE, product_ids)
+
+
+def rebuild_index(using=None):
+    """Repopulate the whole index from the Product table in one statement"""
+    connection = connections[using or router.db_for_write(Product)]
+    vendor = _vendor(connection)
+    product_table = connection.ops.quote_name(Product._meta.db_table)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute("DELETE FROM %s" % SQLITE_TABLE)
+            cursor.execute(
+                "INSERT INTO %s (rowid, name, description) SELECT id, name, description FROM %s"
+                % (SQLITE_TABLE, product_table)
+            )
+        elif vendor == 'postgresql':
+            cursor.execute("TRUNCATE %s" % POSTGRES_TABLE)
+            cursor.execute(
+                "INSERT INTO %s (product_id, document) SELECT id, %s FROM %s"
+                % (POSTGRES_TABLE, _postgres_document_sql() % ('name', 'description'), product_table)
+            )
+
+
+def _match_expression(query):
+    """
+    Turn free text into a safe FTS5 expression: every word must match and the
+    last one is treated as a prefix so results appear while typing.
+    """
+    tokens = TOKEN_RE.findall(query)
+    if not tokens:
+        return None
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _ranked_ids(connection, query, direction, values, limit):
+    """
+    Return up to `limit` (id, rank) pairs after/before the cursor `values`.
+    Ranks are normalised so that lower is better on every backend.
+    """
+    vendor = _vendor(connection)
+    if vendor == 'sqlite':
+        expression = _match_expression(query)
+        if expression is None:
+            return []
+        hits = (
+            "SELECT rowid AS id, bm25(%s, 10.0, 1.0) AS rank FROM %s WHERE %s MATCH %%s"
+            % (SQLITE_TABLE, SQLITE_TABLE, SQLITE_TABLE)
+        )
+    else:
+        expression = query
+        hits = (
+            "SELECT product_id AS id, -ts_rank(document, query)::float8 AS rank "
+            "FROM %s, plainto_tsquery('english', %%s) query WHERE document @@ query" % POSTGRES_TABLE
+        )
+
+    params = [expression]
+    comparison, order = ('<', 'DESC') if direction == PREVIOUS else ('>', 'ASC')
+    where = ''
+    if values is not None:
+        where = 'WHERE rank {0} %s OR (rank = %s AND id {0} %s)'.format(comparison)
+        params += [values[0], values[0], values[1]]
+    sql = 'SELECT id, rank FROM (%s) hits %s ORDER BY rank %s, id %s LIMIT %%s' % (hits, where, order, order)
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def search_products(query, cursor=None, page_size=24, fields=None):
+    """
+    Return a KeysetPage of products matching `query`, best matches first.
+    `fields` restricts the Product columns loaded for the page.
+    """
+    connection = connections[router.db_for_read(Product)]
+    products = Product.objects.using(connection.alias)
+    if fields:
+        products = products.only(*fields)
+
+    if _vendor(connection) is None:
+        condition = Q(name__icontains=query) | Q(description__icontains=query)
+        return paginate(products.filter(condition), ('id',), cursor=cursor, page_size=page_size)
+
+    direction, values = decode_cursor(cursor, SEARCH_CURSOR_FIELDS)
+    hits = _ranked_ids(connection, query, direction, values, page_size + 1)
+    has_more = len(hits) > page_size
+    hits = hits[:page_size]
+    if direction == PREVIOUS:
+        hits.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, direction == NEXT
+
+    # hydrate in one query and restore rank order; ids deleted meanwhile are skipped
+    by_id = products.in_bulk([product_id for product_id, rank in hits])
+    object_list = [by_id[product_id] for product_id, rank in hits if product_id in by_id]
+
+    next_cursor = encode_cursor(hits[-1][::-1], NEXT) if hits and has_next else None
+    previous_cursor = encode_cursor(hits[0][::-1], PREVIOUS) if hits and has_previous else None
+    return KeysetPage(object_list, next_cursor, previous_cursor)
@@ -0,0 +1,43 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog_cache, database, images, instrumentation, search
+from .models import Category, Product
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    # stock/price-only saves don't change the search document
+    if update_fields is not None and not search.INDEXED_FIELDS.intersection(update_fields):
+        return
+    search.index_products([(instance.pk, instance.name, instance.description)], using=kwargs.get('using'))
+
+
+@receiver(post_save, sender=Product)
+def render_product_image(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if images.needs_renditions(instance):
+        images.schedule_renditions(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.unindex_products([instance.pk], using=kwargs.get('using'))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    catalog_cache.invalidate_products([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_categories(sender, instance, **kwargs):
+    catalog_cache.invalidate_categories()
+
+
+connection_created.connect(instrumentation.install_query_wrapper)
+connection_created.connect(database.configure_connection)
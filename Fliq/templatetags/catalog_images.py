@@ -0,0 +1,41 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from Fliq.images import rendition_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_picture(product, sizes='100vw', css_class='img-fluid', default_width=640):
+    """
+    Render a product image as <picture> with WebP and JPEG srcsets so the
+    browser downloads the smallest rendition that fits `sizes`. Falls back to
+    the original upload until its renditions have been generated.
+
+    Usage: {% product_picture product sizes="(min-width: 992px) 25vw, 100vw" %}
+    """
+    if not product.image:
+        return ''
+    name = product.image.name
+    renditions = product.image_renditions or {}
+    widths = renditions.get('widths') if renditions.get('source') == name else None
+    if not widths:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" loading="lazy">', product.image.url, product.name, css_class
+        )
+
+    def srcset(fmt):
+        return ', '.join('%s %dw' % (rendition_url(name, width, fmt, default_storage), width) for width in widths)
+
+    fallback_width = max([width for width in widths if width <= default_width] or widths[:1])
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" loading="lazy"></picture>',
+        format_html('<source type="image/webp" srcset="{}" sizes="{}">', srcset('webp'), sizes),
+        rendition_url(name, fallback_width, 'jpeg', default_storage),
+        srcset('jpeg'),
+        sizes,
+        product.name,
+        css_class,
+    )
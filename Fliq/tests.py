@@ -1,3 +1,1684 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db.models import F
+from django.db import IntegrityError, connection, router, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+import requests
+import urllib3
+from PIL import Image
+from requests import Response
+
+from . import (
+    async_views, cart as carts, catalog_cache, database, db_routers, feeds, guest_cart, images, instrumentation, inventory, jobs, orders,
+    payments, search, urls, utils,
+)
+from .exceptions import InsufficientStockError, MpesaConfigurationException, MpesaConnectionError
+from .management.commands import benchmark, reconcile_payments
+from .models import Cart, CartItem, Category, Job, Order, PaymentTransaction, Product, StockReservation
+from .pagination import NEXT, decode_cursor, encode_cursor, ordering_fields, paginate
+from .templatetags.catalog_images import product_picture
+from .utils import AccessTokenProvider, MpesaGateWay
+
+# catalog fragments and sessions in the per-process cache, images on local disk
+TEST_SETTINGS = {
+    'CATALOG_CACHE': 'default',
+    'SESSION_CACHE_ALIAS': 'default',
+    'DEFAULT_FILE_STORAGE': 'django.core.files.storage.FileSystemStorage',
+    'MEDIA_ROOT': tempfile.mkdtemp(),
+    'IMAGE_RENDITIONS_ASYNC': False,
+    'MPESA_TOKEN_CACHE': 'default',
+}
+
+PHONE_NUMBER = '254700000000'
+
+
+def make_category(name='Shirts', slug='shirts'):
+    return Category.objects.create(name=name, slug=slug)
+
+
+def make_product(category=None, name='Shirt', price='100.00', stock=5):
+    return Product.objects.create(
+        name=name, description='', image='products/shirt.jpg', price=Decimal(price),
+        category=category or Category.objects.first() or make_category(), stock=stock,
+        # as if its renditions were made, so saving it doesn't go looking for the image
+        image_renditions={'source': 'products/shirt.jpg', 'widths': []},
+    )
+
+
+def make_user(username='buyer', password='secret'):
+    return User.objects.create_user(username, '%s@example.com' % username, password)
+
+
+def make_cart(user, quantities):
+    """A cart for `user` holding {product: quantity}"""
+    cart = Cart.objects.get_or_create(user=user)[0]
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, product=product, quantity=quantity) for product, quantity in quantities.items()
+    ])
+    return cart
+
+
+def run_jobs(kind):
+    """Run every queued job of `kind`, oldest first"""
+    for job in Job.objects.filter(kind=kind, status=Job.QUEUED).order_by('id'):
+        jobs.run(job)
+
+
+MPESA_ENVIRON = {
+    'business_shortcode': '174379',
+    'consumer_key': 'key',
+    'consumer_secret': 'secret',
+    'access_token_url': 'https://mpesa.test/oauth/v1/generate',
+    'pass_key': 'passkey',
+    'checkout_url': 'https://mpesa.test/mpesa/stkpush/v1/processrequest',
+}
+
+
+def make_gateway(*responses):
+    """
+    An MpesaGateWay whose Daraja answers each call with the next of
+    `responses` ((status, body) pairs) and hands out numbered tokens
+    """
+    with mock.patch.dict(os.environ, MPESA_ENVIRON):
+        gateway = MpesaGateWay()
+    tokens = iter(range(1, 100))
+    gateway.token_provider.fetch = mock.Mock(side_effect=lambda: ('token-%d' % next(tokens), 3600))
+    answers = []
+    for status, body in responses:
+        response = Response()
+        response.status_code, response._content = status, json.dumps(body).encode('utf-8')
+        answers.append(response)
+    gateway.session.request = mock.Mock(side_effect=answers)
+    return gateway
+
+
+def stk_callback(checkout_request_id, result_code=0, amount=None, phone_number=PHONE_NUMBER):
+    callback = {
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Cancelled',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': 'RKT1234567'},
+            {'Name': 'PhoneNumber', 'Value': int(phone_number)},
+        ]}
+    return callback
+
+
+@override_settings(**TEST_SETTINGS)
+class ShopTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+
+class CatalogClockTestCase(ShopTestCase):
+    """Catalog version tokens stamped by a clock the test moves by hand"""
+
+    def setUp(self):
+        super().setUp()
+        self.clock = mock.Mock()
+        self.clock.time.return_value = time.time()
+        patcher = mock.patch.object(catalog_cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tick(self, seconds=2):
+        self.clock.time.return_value += seconds
+
+    def now(self):
+        return datetime.fromtimestamp(self.clock.time(), tz=dt_timezone.utc)
+
+    def committed(self):
+        """Run the version bumps that wait for the transaction to commit"""
+        return self.captureOnCommitCallbacks(execute=True)
+
+
+class CheckoutTestCase(ShopTestCase):
+    """A buyer with two shirts in their cart and five on the shelf"""
+
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(stock=5)
+        self.user = make_user()
+        self.cart = make_cart(self.user, {self.product: 2})
+
+    def checkout(self, checkout_request_id='ws_CO_1'):
+        """Start a payment and record the CheckoutRequestID its push got back"""
+        payment = payments.start_payment(self.user, self.cart, PHONE_NUMBER)
+        if checkout_request_id:
+            PaymentTransaction.objects.filter(pk=payment.pk).update(checkout_request_id=checkout_request_id)
+        payment.refresh_from_db()
+        return payment
+
+    def stock(self):
+        return Product.objects.values_list('stock', flat=True).get(pk=self.product.pk)
+
+    def order_status(self, payment):
+        return Order.objects.values_list('status', flat=True).get(reference=payment.reference)
+
+
+class LateCallbackTests(CheckoutTestCase):
+    def paid_late(self, payment):
+        callback = stk_callback(payment.checkout_request_id or 'ws_CO_late', amount=int(payment.amount))
+        with self.assertLogs('default', 'WARNING') as logs:
+            self.assertTrue(payments.apply_callback(callback))
+            run_jobs(payments.SETTLE_STOCK)
+        self.assertIn('ERROR', logs.output[0])
+        payment.refresh_from_db()
+
+    def test_success_after_failing_takes_the_stock_again(self):
+        payment = self.checkout()
+        payments.fail_payment(payment.reference, 'Request timed out')
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(self.order_status(payment), Order.CANCELLED)
+
+        self.paid_late(payment)
+        self.assertEqual(payment.status, PaymentTransaction.SUCCESS)
+        self.assertEqual(payment.receipt_number, 'RKT1234567')
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(self.order_status(payment), Order.PROCESSING)
+        self.assertEqual(
+            StockReservation.objects.get(reference=payment.reference, status=StockReservation.COMMITTED).quantity, 2
+        )
+
+    def test_success_after_failing_without_stock_goes_to_review(self):
+        payment = self.checkout()
+        payments.fail_payment(payment.reference, 'Request timed out')
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+
+        self.paid_late(payment)
+        self.assertEqual(payment.status, PaymentTransaction.SUCCESS)
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(self.order_status(payment), Order.REVIEW)
+
+    def test_success_claims_an_expired_unknown_payment(self):
+        payment = self.checkout(checkout_request_id=None)
+        payments.mark_unknown(payment.reference, 'Read timed out')
+        payments.expire_unknown(before=payment.created_at + timedelta(seconds=1))
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.FAILED)
+
+        self.paid_late(payment)
+        self.assertEqual(payment.status, PaymentTransaction.SUCCESS)
+        self.assertEqual(payment.checkout_request_id, 'ws_CO_late')
+        self.assertEqual(self.order_status(payment), Order.PROCESSING)
+
+    def test_late_failure_leaves_a_failed_payment_alone(self):
+        payment = self.checkout()
+        payments.fail_payment(payment.reference, 'Request timed out')
+        self.assertFalse(payments.apply_callback(stk_callback(payment.checkout_request_id, result_code=1032)))
+        self.assertFalse(Job.objects.filter(kind=payments.SETTLE_STOCK).exists())
+
+
+class ListingLastModifiedTests(CatalogClockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+        self.client.get('/')
+        self.tick()
+        self.last_modified = self.client.get('/')['Last-Modified']
+
+    def assertModified(self, modified=True):
+        self.tick()
+        response = self.client.get('/', HTTP_IF_MODIFIED_SINCE=self.last_modified)
+        self.assertEqual(response.status_code, 200 if modified else 304)
+
+    def test_unchanged_listing_is_not_modified(self):
+        self.assertModified(False)
+
+    def test_deleting_a_product_modifies_the_listing(self):
+        with self.committed():
+            self.product.delete()
+        self.assertModified()
+
+    def test_renaming_a_category_modifies_the_listing(self):
+        category = self.product.category
+        category.name = 'Tops'
+        with self.committed():
+            category.save()
+        self.assertModified()
+
+    def test_no_last_modified_within_a_second_of_a_change(self):
+        with self.committed():
+            make_product(name='Blouse')
+        self.assertFalse(self.client.get('/').has_header('Last-Modified'))
+
+
+class FeedValidatorTests(CatalogClockTestCase):
+    url = '/feeds/products.csv'
+
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+        make_product(name='Blouse')
+        self.client.get(self.url)
+        self.tick()
+        response = self.client.get(self.url)
+        self.etag, self.last_modified = response['ETag'], response['Last-Modified']
+
+    def assertModified(self, modified=True):
+        self.tick()
+        for headers in ({'HTTP_IF_NONE_MATCH': self.etag}, {'HTTP_IF_MODIFIED_SINCE': self.last_modified}):
+            response = self.client.get(self.url, **headers)
+            self.assertEqual(response.status_code, 200 if modified else 304, headers)
+
+    def test_unchanged_feed_is_not_modified(self):
+        self.assertModified(False)
+
+    def test_renaming_a_category_modifies_the_feed(self):
+        category = self.product.category
+        category.name = 'Tops'
+        with self.committed():
+            category.save()
+        self.assertModified()
+        self.assertIn(b'Tops', b''.join(self.client.get(self.url).streaming_content))
+
+    def test_deleting_a_product_modifies_the_feed(self):
+        with self.committed():
+            self.product.delete()
+        self.assertModified()
+
+    def test_stock_change_modifies_the_feed(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=F('stock') - 1, updated_at=self.now())
+        self.assertModified()
+
+
+class UpdateCartTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.item = make_cart(self.user, {make_product(): 2}).cartitem_set.get()
+        self.client.force_login(self.user)
+
+    def post_json(self, items):
+        return self.client.post('/update-cart/', json.dumps({'items': items}), content_type='application/json')
+
+    def quantity(self):
+        return CartItem.objects.values_list('quantity', flat=True).get(pk=self.item.pk)
+
+    def test_updates_and_removes_lines(self):
+        response = self.post_json([{'id': self.item.pk, 'quantity': 5}])
+        self.assertEqual(response.json(), {'updated': 1, 'removed': 0})
+        self.assertEqual(self.quantity(), 5)
+        response = self.post_json([{'id': self.item.pk, 'quantity': 0}])
+        self.assertEqual(response.json(), {'updated': 0, 'removed': 1})
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_rejects_quantities_out_of_range(self):
+        for quantity in (-1, 100, 1e400, '1e400', None):
+            response = self.post_json([{'id': self.item.pk, 'quantity': quantity}])
+            self.assertEqual(response.status_code, 400, quantity)
+        self.assertEqual(self.quantity(), 2)
+
+    def test_rejects_ids_out_of_range(self):
+        for item_id in (10 ** 23, -1, 0):
+            self.assertEqual(self.post_json([{'id': item_id, 'quantity': 1}]).status_code, 400, item_id)
+            response = self.client.post('/update-cart/', {'cart_item': [item_id], 'quantity': [1]})
+            self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+        self.assertEqual(self.quantity(), 2)
+
+    def test_guest_rejects_ids_out_of_range(self):
+        self.client.logout()
+        self.assertEqual(self.post_json([{'id': 10 ** 23, 'quantity': 1}]).status_code, 400)
+
+    def test_ids_out_of_range_in_urls_are_not_found(self):
+        for url in ('/add-to-cart/%d/', '/remove-from-cart/%d/', '/product/%d/'):
+            self.assertEqual(self.client.get(url % 10 ** 23).status_code, 404, url)
+
+
+class CheckoutViewTests(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def submit(self):
+        return self.client.post('/checkout/', {'phone_number': PHONE_NUMBER, 'address': 'Nairobi'})
+
+    def test_checkout_moves_the_cart_into_an_order(self):
+        with mock.patch('Fliq.payments.get_gateway') as get_gateway:
+            response = self.submit()
+        # the push is left to a worker
+        get_gateway.assert_not_called()
+        payment = PaymentTransaction.objects.get()
+        self.assertRedirects(response, '/payment/%s/' % payment.reference, fetch_redirect_response=False)
+        order = Order.objects.get(reference=payment.reference)
+        self.assertEqual(order.status, Order.PENDING)
+        self.assertEqual([(item.product_id, item.quantity) for item in order.items.all()], [(self.product.pk, 2)])
+        self.assertEqual(payment.amount, order.total_amount)
+        self.assertEqual(self.stock(), 3)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+        self.assertEqual(Job.objects.get().kind, payments.STK_PUSH)
+
+    def test_submitting_twice_places_one_order(self):
+        first, second = self.submit(), self.submit()
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(self.stock(), 3)
+
+    def test_empty_cart_places_no_order(self):
+        CartItem.objects.all().delete()
+        self.assertRedirects(self.client.get('/checkout/'), '/cart/', fetch_redirect_response=False)
+        self.assertRedirects(self.submit(), '/cart/', fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Job.objects.exists())
+
+    def test_out_of_stock_leaves_the_cart_alone(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        self.assertRedirects(self.submit(), '/cart/', fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 2)
+        self.assertEqual(self.stock(), 1)
+
+
+class CallbackEndpointTests(CheckoutTestCase):
+    def post(self, callback):
+        return self.client.post('/mpesa/callback/', json.dumps({'Body': {'stkCallback': callback}}), content_type='application/json')
+
+    def test_success_is_recorded(self):
+        payment = self.checkout()
+        response = self.post(stk_callback(payment.checkout_request_id, amount=int(payment.amount)))
+        self.assertEqual(response.json()['ResultCode'], 0)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.receipt_number), (PaymentTransaction.SUCCESS, 'RKT1234567'))
+
+    def test_malformed_metadata_is_ignored(self):
+        payment = self.checkout()
+        for metadata in ([], {'Item': {}}, {'Item': [{'Value': 1}, ['Name'], {'Name': ['Amount']}]}, 'x'):
+            callback = dict(stk_callback(payment.checkout_request_id, result_code=1032), CallbackMetadata=metadata)
+            self.assertEqual(self.post(callback).status_code, 200, metadata)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.FAILED)
+
+    def test_duplicate_deliveries_settle_once(self):
+        payment = self.checkout()
+        callback = stk_callback(payment.checkout_request_id, amount=int(payment.amount))
+        for _delivery in range(3):
+            self.assertEqual(self.post(callback).status_code, 200)
+        self.assertEqual(Job.objects.filter(kind=payments.SETTLE_STOCK).count(), 1)
+        run_jobs(payments.SETTLE_STOCK)
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(self.order_status(payment), Order.PROCESSING)
+
+    def test_declined_push_gives_the_stock_back(self):
+        payment = self.checkout()
+        self.post(stk_callback(payment.checkout_request_id, result_code=1032))
+        run_jobs(payments.SETTLE_STOCK)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.result_code), (PaymentTransaction.FAILED, 1032))
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(self.order_status(payment), Order.CANCELLED)
+
+    def test_early_callback_waits_for_its_push(self):
+        payment = self.checkout(checkout_request_id=None)
+        self.assertEqual(self.post(stk_callback('ws_CO_early', amount=int(payment.amount))).status_code, 200)
+        self.assertTrue(Job.objects.filter(kind=payments.APPLY_CALLBACK).exists())
+        PaymentTransaction.objects.filter(pk=payment.pk).update(checkout_request_id='ws_CO_early')
+        Job.objects.filter(kind=payments.APPLY_CALLBACK).update(run_at=payments.timezone.now())
+        run_jobs(payments.APPLY_CALLBACK)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.SUCCESS)
+
+    def test_unknown_callbacks_are_acknowledged_and_dropped(self):
+        with self.assertLogs('default', 'WARNING'):
+            response = self.post(stk_callback('ws_CO_made_up'))
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertFalse(Job.objects.exists())
+
+    def test_malformed_callbacks_are_rejected(self):
+        for callback in (
+            [], {'ResultCode': 0}, {'CheckoutRequestID': ['x'], 'ResultCode': 0},
+            {'CheckoutRequestID': 'x', 'ResultCode': 1e400}, {'CheckoutRequestID': 'x', 'ResultCode': 10 ** 23},
+        ):
+            self.assertEqual(self.post(callback).status_code, 400, callback)
+
+
+@override_settings(CATALOG_READ_REPLICAS=['replica1'], **TEST_SETTINGS)
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    The primary and replica1 test databases are two SQLite files (see
+    DATABASES in settings). The replica is synced once, then the primary
+    renames the product, so each read shows where it went.
+    """
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        caches['default'].clear()
+        self.product = make_product(name='Shirt')
+        call_command('sync_sqlite_replicas', stdout=io.StringIO())
+        Product.objects.filter(pk=self.product.pk).update(name='Blouse')
+
+    def read(self, url, pinned=False):
+        if pinned:
+            self.client.cookies[db_routers.PIN_COOKIE] = '1'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def in_request(self, view, method='get'):
+        """Run `view(request)` inside the pinning middleware; returns its response"""
+        request = getattr(RequestFactory(), method)('/')
+        return db_routers.ReplicaPinningMiddleware(view)(request)
+
+    def test_catalog_pages_read_the_replica(self):
+        self.assertIn(b'Shirt', self.read('/product/%d/' % self.product.pk))
+        self.assertIn(b'Shirt', self.read('/'))
+
+    def test_pinned_visitor_reads_the_primary(self):
+        self.assertIn(b'Blouse', self.read('/product/%d/' % self.product.pk, pinned=True))
+
+    def test_feed_streams_from_the_replica_chosen_for_its_request(self):
+        self.assertIn(b'Shirt', self.read('/feeds/products.csv'))
+        self.assertIn(b'Blouse', self.read('/feeds/products.csv', pinned=True))
+
+    def test_writing_the_catalog_pins_the_request_and_the_visitor(self):
+        aliases = []
+
+        def view(request):
+            aliases.append(router.db_for_read(Product))
+            Product.objects.filter(pk=self.product.pk).update(stock=4)
+            aliases.append(router.db_for_read(Product))
+            return HttpResponse()
+
+        response = self.in_request(view)
+        self.assertEqual(aliases, ['replica1', 'default'])
+        self.assertIn(db_routers.PIN_COOKIE, response.cookies)
+
+    def test_unsafe_methods_transactions_and_other_models_read_the_primary(self):
+        aliases = []
+
+        def view(request):
+            aliases.append(router.db_for_read(Product))
+            with transaction.atomic():
+                aliases.append(router.db_for_read(Product))
+            aliases.append(router.db_for_read(Cart))
+            return HttpResponse()
+
+        self.in_request(view, method='post')
+        self.in_request(view)
+        self.assertEqual(aliases, ['default', 'default', 'default', 'replica1', 'default', 'default'])
+        # outside a request, e.g. in workers and commands
+        self.assertEqual(router.db_for_read(Product), 'default')
+        self.assertEqual(Product.objects.get(pk=self.product.pk).name, 'Blouse')
+
+
+class StkPushTests(CheckoutTestCase):
+    def send(self, gateway):
+        """Run the queued STK push job against `gateway`, as if it were due"""
+        Job.objects.filter(kind=payments.STK_PUSH).update(run_at=payments.timezone.now())
+        with mock.patch('Fliq.payments.get_gateway', return_value=gateway):
+            run_jobs(payments.STK_PUSH)
+
+    def test_refused_token_is_renewed_and_the_push_retried(self):
+        payment = self.checkout(checkout_request_id=None)
+        gateway = make_gateway(
+            (401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}),
+            (200, {'CheckoutRequestID': 'ws_CO_2', 'ResponseCode': '0'}),
+        )
+        with self.assertLogs('default', 'WARNING'):
+            self.send(gateway)
+        job = Job.objects.get(kind=payments.STK_PUSH)
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.PENDING)
+        self.assertEqual(self.order_status(payment), Order.PENDING)
+
+        self.send(gateway)
+        payment.refresh_from_db()
+        self.assertEqual(payment.checkout_request_id, 'ws_CO_2')
+        sent_with = [call.kwargs['headers']['Authorization'] for call in gateway.session.request.call_args_list]
+        self.assertEqual(sent_with, ['Bearer token-1', 'Bearer token-2'])
+
+    def test_refused_token_is_not_an_unknown_result(self):
+        gateway = make_gateway((401, {}))
+        with self.assertRaises(MpesaConnectionError) as raised:
+            gateway.stk_push(PHONE_NUMBER, 205, 'https://shop.test/callback/', 'LaFliq', 'Payment')
+        self.assertEqual(type(raised.exception), MpesaConnectionError)
+
+    def test_rejected_push_fails_the_payment(self):
+        payment = self.checkout(checkout_request_id=None)
+        self.send(make_gateway((400, {'errorCode': '400.002.02', 'errorMessage': 'Invalid PhoneNumber'})))
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.result_description), (PaymentTransaction.FAILED, 'Invalid PhoneNumber'))
+        self.assertEqual(self.order_status(payment), Order.CANCELLED)
+        self.assertEqual(self.stock(), 5)
+
+    def test_failing_a_payment_is_all_or_nothing(self):
+        payment = self.checkout()
+        with mock.patch('Fliq.orders.cancel', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            payments.fail_payment(payment.reference, 'Cancelled')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.PENDING)
+        self.assertEqual(self.stock(), 3)
+
+
+class StockInvalidationTests(ShopTestCase):
+    """The catalog pages say in or out of stock, so only those flips invalidate them"""
+
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(stock=3)
+        patcher = mock.patch.object(catalog_cache, 'invalidate_products')
+        self.invalidate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def invalidated(self):
+        return [sorted(call.args[0]) for call in self.invalidate.call_args_list]
+
+    def test_reservation_that_leaves_stock_keeps_the_pages(self):
+        inventory.reserve({self.product.pk: 2}, 'REF1')
+        inventory.release(reference='REF1')
+        self.assertEqual(self.invalidated(), [])
+
+    def test_selling_out_and_restocking_invalidate_the_product(self):
+        other = make_product(name='Blouse', stock=4)
+        self.invalidate.reset_mock()
+        inventory.reserve({self.product.pk: 3, other.pk: 1}, 'REF1')
+        self.assertEqual(self.invalidated(), [[self.product.pk]])
+        inventory.release(reference='REF1')
+        self.assertEqual(self.invalidated(), [[self.product.pk], [self.product.pk]])
+
+    def test_shortage_invalidates_nothing(self):
+        with self.assertRaises(InsufficientStockError):
+            inventory.reserve({self.product.pk: 4}, 'REF1')
+        self.assertEqual(self.invalidated(), [])
+
+
+class ReconcilePaymentsTests(CheckoutTestCase):
+    def reconcile(self, answers, *args):
+        """Run reconcile_payments against a Daraja answering {CheckoutRequestID: body}"""
+        gateway = mock.Mock()
+        gateway.stk_query.side_effect = lambda checkout_request_id: mock.Mock(
+            **{'json.return_value': answers[checkout_request_id]}
+        )
+        out = io.StringIO()
+        with mock.patch('Fliq.management.commands.reconcile_payments.get_gateway', return_value=gateway):
+            call_command('reconcile_payments', '--rps', '1000', *args, stdout=out)
+        return gateway, out.getvalue()
+
+    def age(self, minutes=60):
+        PaymentTransaction.objects.update(created_at=F('created_at') - timedelta(minutes=minutes))
+
+    def test_settles_stale_payments(self):
+        payment = self.checkout()
+        self.age()
+        _gateway, out = self.reconcile({'ws_CO_1': {'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'}})
+        self.assertIn('Reconciled 1 of 1 stale payments', out)
+        run_jobs(payments.SETTLE_STOCK)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.result_code), (PaymentTransaction.FAILED, 1032))
+        self.assertEqual(self.stock(), 5)
+
+    def test_leaves_recent_and_unfinished_payments_pending(self):
+        payment = self.checkout()
+        gateway, _out = self.reconcile({})
+        gateway.stk_query.assert_not_called()
+        self.age()
+        self.reconcile({'ws_CO_1': {'errorMessage': 'The transaction is being processed'}})
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, PaymentTransaction.PENDING)
+
+    def test_fails_unknown_payments_no_callback_claimed(self):
+        payment = self.checkout(checkout_request_id=None)
+        payments.mark_unknown(payment.reference, 'Read timed out')
+        self.age(minutes=31)
+        _gateway, out = self.reconcile({})
+        self.assertIn('failed 1 unknown payments', out)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.result_description), (PaymentTransaction.FAILED, payments.NO_ANSWER))
+        self.assertEqual(self.stock(), 5)
+
+    def test_queries_are_spaced_to_the_rate(self):
+        with mock.patch.object(reconcile_payments, 'time') as clock:
+            clock.monotonic.return_value = 100.0
+            limiter = reconcile_payments.RateLimiter(4)
+            for _query in range(3):
+                limiter.wait()
+        self.assertEqual([call.args[0] for call in clock.sleep.call_args_list], [0.25, 0.5])
+
+    def test_unusable_answer_skips_only_its_payment(self):
+        garbled = self.checkout('ws_CO_1')
+        self.cart = make_cart(make_user('other'), {self.product: 1})
+        self.user = self.cart.user
+        paid = self.checkout('ws_CO_2')
+        self.age()
+        with self.assertLogs('default', 'WARNING'):
+            _gateway, out = self.reconcile({
+                'ws_CO_1': {'ResultCode': 'soon', 'ResultDesc': 'Garbled'},
+                'ws_CO_2': {'ResultCode': '0', 'ResultDesc': 'The service request is processed successfully.'},
+            })
+        self.assertIn('Reconciled 1 of 2 stale payments', out)
+        self.assertIn('(1 query errors)', out)
+        garbled.refresh_from_db()
+        paid.refresh_from_db()
+        self.assertEqual(garbled.status, PaymentTransaction.PENDING)
+        self.assertEqual(paid.status, PaymentTransaction.SUCCESS)
+
+
+class AddItemsTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = make_category()
+        self.products = Product.objects.bulk_create([
+            Product(category=category, name='Shirt %d' % number, price=Decimal('100.00'), stock=5)
+            for number in range(5)
+        ])
+        self.cart = make_cart(make_user(), {})
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_batches_stay_within_the_parameter_limit(self):
+        bound = []
+
+        def record(execute, sql, params, many, context):
+            bound.append(len(params or ()))
+            return execute(sql, params, many, context)
+
+        # six parameters hold two rows, but not two rows and the cap
+        with mock.patch.object(connection.features, 'max_query_params', 6), connection.execute_wrapper(record):
+            carts.add_items(self.cart, {product.pk: 1 for product in self.products})
+        self.assertEqual(bound, [4] * 5)
+        self.assertEqual(self.quantities(), {product.pk: 1 for product in self.products})
+
+    def test_lines_stop_at_the_cap(self):
+        product = self.products[0]
+        with self.settings(CART_MAX_QUANTITY=10):
+            carts.add_items(self.cart, {product.pk: 6})
+            carts.add_items(self.cart, {product.pk: 6})
+        self.assertEqual(self.quantities(), {product.pk: 10})
+
+
+class ImportCatalogImageTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image_dir = tempfile.mkdtemp()
+        for folder, content in (('red', b'red shirt'), ('blue', b'blue shirt')):
+            os.makedirs(os.path.join(self.image_dir, folder))
+            with open(os.path.join(self.image_dir, folder, 'shirt.jpg'), 'wb') as image:
+                image.write(content)
+        self.feed = os.path.join(self.image_dir, 'feed.csv')
+        with open(self.feed, 'w', encoding='utf-8') as feed:
+            feed.write(
+                'sku,name,price,stock,category,image\n'
+                'RED-1,Red shirt,100,5,Shirts,red/shirt.jpg\n'
+                'BLUE-1,Blue shirt,100,5,Shirts,blue/shirt.jpg\n'
+            )
+
+    def import_catalog(self):
+        call_command('import_catalog', self.feed, '--image-dir', self.image_dir, stdout=io.StringIO())
+        return dict(Product.objects.values_list('sku', 'image'))
+
+    def test_same_file_name_keeps_one_image_per_product(self):
+        images = self.import_catalog()
+        self.assertNotEqual(images['RED-1'], images['BLUE-1'])
+        self.assertTrue(images['RED-1'].startswith('products/RED-1/'))
+        with default_storage.open(images['BLUE-1']) as image:
+            self.assertEqual(image.read(), b'blue shirt')
+
+    def test_unchanged_images_are_not_uploaded_again(self):
+        first = self.import_catalog()
+        with mock.patch.object(default_storage, 'save') as save:
+            self.assertEqual(self.import_catalog(), first)
+        save.assert_not_called()
+
+    def test_changed_image_gets_a_new_key(self):
+        first = self.import_catalog()
+        with open(os.path.join(self.image_dir, 'red', 'shirt.jpg'), 'wb') as image:
+            image.write(b'darker red shirt')
+        images = self.import_catalog()
+        self.assertNotEqual(images['RED-1'], first['RED-1'])
+        self.assertEqual(images['BLUE-1'], first['BLUE-1'])
+
+
+class KeysetPaginationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        # two products share a price, so the id has to break the tie
+        self.products = [
+            make_product(name='Shirt %d' % number, price=price) for number, price in enumerate(['30', '10', '20', '10', '40'])
+        ]
+        self.ordering = ('price', 'id')
+
+    def names(self, page):
+        return [product.name for product in page]
+
+    def test_walks_forward_and_back_over_ties(self):
+        first = paginate(Product.objects.all(), self.ordering, page_size=2)
+        second = paginate(Product.objects.all(), self.ordering, cursor=first.next_cursor, page_size=2)
+        last = paginate(Product.objects.all(), self.ordering, cursor=second.next_cursor, page_size=2)
+        self.assertEqual([self.names(first), self.names(second), self.names(last)],
+                         [['Shirt 1', 'Shirt 3'], ['Shirt 2', 'Shirt 0'], ['Shirt 4']])
+        self.assertFalse(first.has_previous)
+        self.assertFalse(last.has_next)
+        back = paginate(Product.objects.all(), self.ordering, cursor=last.previous_cursor, page_size=2)
+        self.assertEqual(self.names(back), ['Shirt 2', 'Shirt 0'])
+        self.assertTrue(back.has_previous and back.has_next)
+
+    def test_tampered_cursors_fall_back_to_the_first_page(self):
+        fields = ordering_fields(Product, self.ordering)
+        for cursor in ('garbage', encode_cursor(['10.00'], NEXT), encode_cursor(['ten', 1], NEXT),
+                       encode_cursor(['10.00', 2 ** 64], NEXT), encode_cursor(['10.00', 1], 'x')):
+            self.assertEqual(decode_cursor(cursor, fields), (None, None), cursor)
+        self.assertEqual(self.names(paginate(Product.objects.all(), self.ordering, cursor='garbage', page_size=2)),
+                         ['Shirt 1', 'Shirt 3'])
+
+    def test_listing_links_to_the_next_page(self):
+        response = self.client.get('/', {'sort': 'price', 'page_size': 2})
+        self.assertContains(response, 'Shirt 3')
+        self.assertNotContains(response, 'Shirt 2')
+        cursor = paginate(Product.objects.all(), self.ordering, page_size=2).next_cursor
+        self.assertContains(response, 'cursor=' + cursor)
+        response = self.client.get('/', {'sort': 'price', 'page_size': 2, 'cursor': cursor})
+        self.assertContains(response, 'Shirt 2')
+        self.assertNotContains(response, 'Shirt 3')
+
+
+class SearchTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.linen = make_product(name='Linen shirt')
+        self.linen.description = 'Cool in summer'
+        self.linen.save()
+        self.dress = make_product(name='Summer dress')
+        self.hat = make_product(name='Straw hat')
+
+    def names(self, query, **kwargs):
+        return [product.name for product in search.search_products(query, **kwargs)]
+
+    def test_name_matches_outrank_description_matches(self):
+        self.assertEqual(self.names('summer'), ['Summer dress', 'Linen shirt'])
+
+    def test_last_word_matches_as_a_prefix(self):
+        self.assertEqual(self.names('straw h'), ['Straw hat'])
+        self.assertEqual(self.names('"*) OR ('), [])
+
+    def test_index_follows_renames_and_deletes(self):
+        self.hat.name = 'Panama hat'
+        self.hat.save()
+        self.assertEqual(self.names('straw'), [])
+        self.assertEqual(self.names('panama'), ['Panama hat'])
+        self.dress.delete()
+        self.assertEqual(self.names('summer'), ['Linen shirt'])
+
+    def test_results_page_by_rank(self):
+        first = search.search_products('summer', page_size=1)
+        second = search.search_products('summer', cursor=first.next_cursor, page_size=1)
+        self.assertEqual([product.name for product in first], ['Summer dress'])
+        self.assertEqual([product.name for product in second], ['Linen shirt'])
+        self.assertFalse(second.has_next)
+        back = search.search_products('summer', cursor=second.previous_cursor, page_size=1)
+        self.assertEqual([product.name for product in back], ['Summer dress'])
+
+    def test_search_view(self):
+        self.assertContains(self.client.get('/search/', {'q': 'straw'}), 'Straw hat')
+        self.assertRedirects(self.client.get('/search/', {'q': ' '}), '/')
+
+
+class CartTotalsTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.cart = make_cart(self.user, {make_product(price='100.00'): 2, make_product(name='Sock', price='33.33'): 3})
+
+    def test_lines_and_totals_are_priced_in_the_database(self):
+        with self.assertNumQueries(2):
+            summary = carts.summarize_cart(self.cart)
+        self.assertEqual([item.line_total for item in summary.items], [Decimal('200.00'), Decimal('99.99')])
+        # 2.5% of 299.99 is 7.49975, rounded half up
+        self.assertEqual((summary.subtotal, summary.tax, summary.total), (Decimal('299.99'), Decimal('7.50'), Decimal('307.49')))
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        make_cart(self.user, {make_product(name='Hat %d' % number): 1 for number in range(10)})
+        with self.assertNumQueries(2):
+            self.assertEqual(len(carts.summarize_cart(self.cart).items), 12)
+
+    def test_empty_cart_costs_nothing(self):
+        summary = carts.summarize_cart(make_cart(make_user('other'), {}))
+        self.assertEqual((summary.items, summary.total), ([], Decimal('0.00')))
+
+    def test_cart_page_shows_the_total(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/cart/')
+        self.assertEqual(response.context['total'], Decimal('307.49'))
+
+
+class StockReservationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt = make_product(stock=5)
+        self.sock = make_product(name='Sock', stock=1)
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock'))
+
+    def test_reservation_is_all_or_nothing(self):
+        with self.assertRaises(InsufficientStockError):
+            inventory.reserve({self.shirt.pk: 2, self.sock.pk: 2}, 'REF1')
+        self.assertEqual(self.stock(), {'Shirt': 5, 'Sock': 1})
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_returns_stock_once(self):
+        inventory.reserve({self.shirt.pk: 2, self.sock.pk: 1}, 'REF1')
+        self.assertEqual(self.stock(), {'Shirt': 3, 'Sock': 0})
+        self.assertEqual(inventory.release(reference='REF1'), 2)
+        self.assertEqual(inventory.release(reference='REF1'), 0)
+        self.assertEqual(self.stock(), {'Shirt': 5, 'Sock': 1})
+
+    def test_committed_stock_stays_sold(self):
+        inventory.reserve({self.shirt.pk: 2}, 'REF1')
+        self.assertEqual(inventory.commit(reference='REF1'), 1)
+        self.assertEqual(inventory.release(reference='REF1'), 0)
+        self.assertEqual(self.stock()['Shirt'], 3)
+
+    def test_sweeper_releases_only_expired_holds(self):
+        inventory.reserve({self.shirt.pk: 1}, 'OLD1', ttl=timedelta(minutes=1))
+        inventory.reserve({self.shirt.pk: 1}, 'OLD2', ttl=timedelta(minutes=1))
+        inventory.reserve({self.shirt.pk: 1}, 'NEW', ttl=timedelta(hours=1))
+        later = payments.timezone.now() + timedelta(minutes=5)
+        self.assertEqual(inventory.release_expired(batch_size=1, now=later), 2)
+        self.assertEqual(self.stock()['Shirt'], 4)
+        self.assertEqual(
+            dict(StockReservation.objects.values_list('reference', 'status')),
+            {'OLD1': StockReservation.RELEASED, 'OLD2': StockReservation.RELEASED, 'NEW': StockReservation.HELD},
+        )
+
+    def test_sweeper_command(self):
+        inventory.reserve({self.shirt.pk: 2}, 'REF1', ttl=timedelta(seconds=-1))
+        out = io.StringIO()
+        call_command('release_expired_reservations', stdout=out)
+        self.assertIn('Released 1 expired reservations.', out.getvalue())
+        self.assertEqual(self.stock()['Shirt'], 5)
+
+
+class AccessTokenProviderTests(ShopTestCase):
+    """Two providers on one cache stand in for two worker processes"""
+
+    def setUp(self):
+        super().setUp()
+        self.clock = mock.Mock()
+        self.clock.time.return_value = 1000000.0
+        patcher = mock.patch('Fliq.utils.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetch = mock.Mock(side_effect=[('token-1', 3600), ('token-2', 3600)])
+
+    def provider(self):
+        return AccessTokenProvider(self.fetch, cache_alias='default', refresh_margin=300, jitter=0)
+
+    def test_workers_share_one_token(self):
+        self.assertEqual(self.provider().get_token(), 'token-1')
+        self.assertEqual(self.provider().get_token(), 'token-1')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_token_is_renewed_before_it_expires(self):
+        provider = self.provider()
+        provider.get_token()
+        self.clock.time.return_value += 3600 - 301
+        self.assertEqual(provider.get_token(), 'token-1')
+        self.clock.time.return_value += 2
+        self.assertEqual(provider.get_token(), 'token-2')
+        self.assertEqual(self.provider().get_token(), 'token-2')
+
+    def test_failed_renewal_keeps_the_valid_token(self):
+        provider = self.provider()
+        provider.get_token()
+        self.fetch.side_effect = ConnectionError('Daraja is down')
+        self.clock.time.return_value += 3500
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(provider.get_token(), 'token-1')
+        self.clock.time.return_value += 200
+        with self.assertRaises(ConnectionError):
+            provider.get_token()
+
+    def test_only_the_lock_holder_renews(self):
+        provider = self.provider()
+        provider.get_token()
+        caches['default'].add(provider.lock_key, 'another worker')
+        self.clock.time.return_value += 3500
+        self.assertEqual(self.provider().get_token(), 'token-1')
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_invalidated_token_is_fetched_again(self):
+        provider = self.provider()
+        provider.get_token()
+        provider.invalidate()
+        self.assertEqual(self.provider().get_token(), 'token-2')
+
+
+class LazyGatewayTests(ShopTestCase):
+    def test_building_the_gateway_makes_no_calls(self):
+        with mock.patch('requests.Session.request') as send:
+            gateway = make_gateway()
+        send.assert_not_called()
+        gateway.token_provider.fetch.assert_not_called()
+        self.assertEqual(gateway.query_url, 'https://mpesa.test/mpesa/stkpushquery/v1/query')
+
+    def test_missing_settings_are_named(self):
+        environ = dict(MPESA_ENVIRON, pass_key='', consumer_secret=' ')
+        with mock.patch.dict(os.environ, environ), self.assertRaises(MpesaConfigurationException) as raised:
+            MpesaGateWay()
+        self.assertEqual(str(raised.exception), 'Missing M-Pesa settings: consumer_secret, pass_key')
+
+    def test_one_gateway_per_process(self):
+        with mock.patch.object(utils, '_gateway', None), mock.patch.dict(os.environ, MPESA_ENVIRON):
+            self.assertIs(utils.get_gateway(), utils.get_gateway())
+
+
+class GatewayRequestTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('Fliq.utils.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def retries(self, endpoint):
+        return utils.gateway_metrics.snapshot().get(endpoint, {}).get('retries', 0)
+
+    def test_idempotent_calls_retry_server_errors(self):
+        gateway = make_gateway((503, {}), (200, {'ResultCode': '0'}))
+        before = self.retries('test_query')
+        response = gateway.request('test_query', 'POST', gateway.query_url, idempotent=True, json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(gateway.session.request.call_count, 2)
+        self.assertEqual(self.retries('test_query') - before, 1)
+        self.sleep.assert_called_once()
+        self.assertEqual(gateway.session.request.call_args.kwargs['timeout'], gateway.timeout)
+
+    def test_retries_are_budgeted(self):
+        gateway = make_gateway((500, {}), (500, {}), (500, {}), (200, {}))
+        gateway.max_retries = 2
+        response = gateway.request('test_query', 'POST', gateway.query_url, idempotent=True)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(gateway.session.request.call_count, 3)
+
+    def test_other_calls_are_sent_once(self):
+        gateway = make_gateway((503, {}), (200, {}))
+        response = gateway.request('test_push', 'POST', gateway.checkout_url, json={})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(gateway.session.request.call_count, 1)
+
+    def test_refused_connection_is_told_apart_from_a_lost_answer(self):
+        gateway = make_gateway()
+        refused = urllib3.exceptions.MaxRetryError(
+            None, gateway.checkout_url, urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+        )
+        gateway.session.request.side_effect = requests.exceptions.ConnectionError(refused)
+        with self.assertRaises(utils.RequestNotSent):
+            gateway.request('test_push', 'POST', gateway.checkout_url)
+        gateway.session.request.side_effect = requests.exceptions.ReadTimeout('Read timed out')
+        with self.assertRaises(requests.exceptions.ReadTimeout) as raised:
+            gateway.request('test_push', 'POST', gateway.checkout_url)
+        self.assertNotIsInstance(raised.exception, utils.RequestNotSent)
+
+
+class JobQueueTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler, self.on_dead = mock.Mock(), mock.Mock()
+        patcher = mock.patch.dict(jobs.HANDLERS, {'test': (self.handler, self.on_dead)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_due_jobs_are_claimed_once(self):
+        due = jobs.enqueue('test', {'n': 1})
+        jobs.enqueue('test', {'n': 2}, delay=60)
+        self.assertEqual([job.pk for job in jobs.claim(10)], [due.pk])
+        self.assertEqual(jobs.claim(10), [])
+
+    def test_finished_job_is_done(self):
+        jobs.enqueue('test', {'n': 1})
+        job = jobs.claim(10)[0]
+        jobs.run(job)
+        self.handler.assert_called_once_with({'n': 1})
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_at), (Job.DONE, None))
+
+    def test_failed_job_backs_off_then_dies(self):
+        self.handler.side_effect = jobs.RetryLater('Daraja is busy')
+        job = jobs.enqueue('test', {'n': 1}, max_attempts=2)
+        with self.assertLogs('default', 'WARNING'):
+            jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (Job.QUEUED, 1, 'Daraja is busy'))
+        self.assertGreaterEqual(job.run_at, job.created_at)
+        self.on_dead.assert_not_called()
+        with self.assertLogs('default', 'ERROR'):
+            jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 2))
+        self.on_dead.assert_called_once_with({'n': 1})
+
+    def test_unknown_kind_dies_at_once(self):
+        job = jobs.enqueue('missing', {})
+        with self.assertLogs('default', 'ERROR'):
+            jobs.run(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 1))
+
+    def test_abandoned_jobs_are_requeued(self):
+        job = jobs.enqueue('test', {})
+        jobs.claim(10)
+        self.assertEqual(jobs.requeue_abandoned(), 0)
+        Job.objects.filter(pk=job.pk).update(locked_at=F('locked_at') - timedelta(seconds=jobs.LEASE_SECONDS + 1))
+        self.assertEqual(jobs.requeue_abandoned(), 1)
+        self.assertEqual([claimed.pk for claimed in jobs.claim(10)], [job.pk])
+
+
+
+class ImageRenditionTests(ShopTestCase):
+    def upload(self, name, size=(800, 600), mode='RGB'):
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0110] = 'Camera'
+        Image.new(mode, size, 'red').save(buffer, format='PNG' if mode == 'RGBA' else 'JPEG', exif=exif)
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def open(self, name):
+        with default_storage.open(name) as stored:
+            image = Image.open(stored)
+            image.load()
+        return image
+
+    def test_renditions_are_resized_never_upscaled_and_stripped(self):
+        name = self.upload('products/shirt.jpg')
+        self.assertEqual(images.generate_renditions(name), [320, 640, 800])
+        small = self.open(images.rendition_name(name, 320, 'jpeg'))
+        self.assertEqual(small.size, (320, 240))
+        self.assertEqual(dict(small.getexif()), {})
+        self.assertEqual(self.open(images.rendition_name(name, 800, 'webp')).format, 'WEBP')
+        self.assertFalse(default_storage.exists(images.rendition_name(name, 1024, 'jpeg')))
+
+    def test_transparent_images_get_a_white_jpeg_background(self):
+        name = self.upload('products/logo.png', mode='RGBA')
+        images.generate_renditions(name, widths=(320,))
+        self.assertEqual(self.open(images.rendition_name(name, 320, 'jpeg')).mode, 'RGB')
+
+    def test_saving_a_product_records_its_renditions(self):
+        product = make_product()
+        product.image = self.upload('products/new.jpg')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.image_renditions, {'source': product.image.name, 'widths': [320, 640, 800]})
+
+    def test_renditions_of_a_replaced_image_are_not_recorded(self):
+        product = make_product()
+        name = self.upload('products/old.jpg')
+        self.assertEqual(images.process_product(product.pk, name), [320, 640, 800])
+        product.refresh_from_db()
+        self.assertEqual(product.image_renditions['source'], 'products/shirt.jpg')
+
+    def test_picture_tag_offers_every_rendition(self):
+        product = make_product()
+        self.assertIn('<img src="%sproducts/shirt.jpg"' % default_storage.base_url, product_picture(product))
+        product.image_renditions = {'source': product.image.name, 'widths': [320, 640]}
+        html = product_picture(product)
+        self.assertIn('type="image/webp" srcset="%sproducts/shirt-320w.webp 320w' % default_storage.base_url, html)
+        self.assertIn('src="%sproducts/shirt-640w.jpg"' % default_storage.base_url, html)
+
+
+class ImportCatalogTests(ShopTestCase):
+    def feed(self, name, text):
+        path = os.path.join(tempfile.mkdtemp(), name)
+        with open(path, 'w', encoding='utf-8') as feed:
+            feed.write(text)
+        return path
+
+    def import_catalog(self, path, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_catalog', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_rows_are_upserted_by_sku(self):
+        self.import_catalog(self.feed('feed.csv', (
+            'sku,name,description,price,stock,category\n'
+            'S1,Linen shirt,Cool,100,5,Shirts\n'
+            'S2,Straw hat,,20.5,0,Hats\n'
+        )))
+        out, _err = self.import_catalog(self.feed('feed.csv', (
+            'sku,name,description,price,stock,category\n'
+            'S1,Linen shirt,Cool,90,4,Shirts\n'
+            'S1,Linen shirt,Cooler,80,3,Shirts\n'
+        )), '--batch-size', '1')
+        self.assertIn('Imported 2 of 2 rows', out)
+        self.assertEqual(
+            sorted(Product.objects.values_list('sku', 'price', 'stock', 'category__slug')),
+            [('S1', Decimal('80.00'), 3, 'shirts'), ('S2', Decimal('20.50'), 0, 'hats')],
+        )
+        self.assertEqual([product.sku for product in search.search_products('cooler')], ['S1'])
+
+    def test_bad_rows_are_reported_and_skipped(self):
+        out, err = self.import_catalog(self.feed('feed.jsonl', '\n'.join(json.dumps(row) for row in (
+            {'sku': 'S1', 'name': 'Linen shirt', 'price': '100', 'stock': 5, 'category': 'Shirts'},
+            {'sku': 'S2', 'name': 'Straw hat', 'price': 'free', 'category': 'Hats'},
+            {'sku': 'S3', 'name': 'Sock', 'price': '-1', 'category': 'Socks'},
+            {'name': 'No sku', 'price': '1', 'category': 'Socks'},
+            {'sku': 'S5', 'name': 'Cap', 'price': '10', 'category': 'Hats', 'image': 'missing.jpg'},
+        ))))
+        self.assertIn('Imported 1 of 5 rows', out)
+        errors = err.splitlines()
+        self.assertEqual(errors[:3], [
+            'Row 2: invalid price or stock',
+            'Row 3: price or stock out of range',
+            'Row 4: sku, name and category are required',
+        ])
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(errors[3].startswith('Row 5: image upload failed'))
+        self.assertEqual(list(Product.objects.values_list('sku', flat=True)), ['S1'])
+
+    def test_rows_without_an_image_keep_the_current_one(self):
+        product = make_product()
+        Product.objects.filter(pk=product.pk).update(sku='S1')
+        self.import_catalog(self.feed('feed.csv', 'sku,name,price,stock,category\nS1,Shirt,100,5,Shirts\n'))
+        self.assertEqual(Product.objects.get(sku='S1').image.name, 'products/shirt.jpg')
+
+    def test_missing_file_is_an_error(self):
+        with self.assertRaises(CommandError):
+            self.import_catalog('/nonexistent/feed.csv')
+
+
+class ProductFeedTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        make_product(name='Shirt & "tie"', price='100.00')
+        make_product(name='Hat <b>', price='20.50', stock=0)
+
+    def get(self, fmt, **headers):
+        response = self.client.get('/feeds/products.%s' % fmt, **headers)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv(self):
+        response, body = self.get('csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+        self.assertEqual([(row['name'], row['price'], row['stock']) for row in rows],
+                         [('Shirt & "tie"', '100.00', '5'), ('Hat <b>', '20.50', '0')])
+        self.assertEqual(rows[0]['image_url'], 'http://testserver%sproducts/shirt.jpg' % default_storage.base_url)
+
+    def test_json_and_xml_escape_names(self):
+        _response, body = self.get('json')
+        self.assertEqual([row['name'] for row in json.loads(body)], ['Shirt & "tie"', 'Hat <b>'])
+        _response, body = self.get('xml')
+        self.assertIn(b'<name>Hat &lt;b&gt;</name>', body)
+        self.assertEqual(body.count(b'<product>'), 2)
+
+    def test_gzip_when_accepted(self):
+        response, body = self.get('json', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual((response['Content-Encoding'], response['Vary']), ('gzip', 'Accept-Encoding'))
+        self.assertEqual(len(json.loads(gzip.decompress(body))), 2)
+
+
+class CatalogCacheTests(CatalogClockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+
+    def grid_queries(self):
+        """Queries for the first listing page; the session and messages need none"""
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/').status_code, 200)
+        return len(queries)
+
+    def test_second_view_is_served_from_the_cache(self):
+        self.assertGreater(self.grid_queries(), 0)
+        self.assertEqual(self.grid_queries(), 0)
+
+    def test_saving_a_product_invalidates_the_grid_and_its_page(self):
+        self.client.get('/')
+        self.client.get('/product/%d/' % self.product.pk)
+        self.product.name = 'Blouse'
+        with self.committed():
+            self.product.save()
+        self.assertContains(self.client.get('/'), 'Blouse')
+        self.assertContains(self.client.get('/product/%d/' % self.product.pk), 'Blouse')
+
+    def test_renaming_a_category_invalidates_the_category_list(self):
+        self.assertEqual([category.name for category in catalog_cache.categories()], ['Shirts'])
+        category = self.product.category
+        category.name = 'Tops'
+        with self.committed():
+            category.save()
+        self.assertEqual([category.name for category in catalog_cache.categories()], ['Tops'])
+
+    @override_settings(CATALOG_READ_REPLICAS=['replica1'], REPLICA_LAG_SECONDS=5)
+    def test_nothing_is_cached_while_replicas_may_lag(self):
+        compute = mock.Mock(return_value='grid')
+        catalog_cache.cached('grid', [], compute, [catalog_cache.PRODUCTS])
+        catalog_cache.cached('grid', [], compute, [catalog_cache.PRODUCTS])
+        self.assertEqual(compute.call_count, 2)
+        self.tick(6)
+        catalog_cache.cached('grid', [], compute, [catalog_cache.PRODUCTS])
+        catalog_cache.cached('grid', [], compute, [catalog_cache.PRODUCTS])
+        self.assertEqual(compute.call_count, 3)
+
+
+class DetailConditionalGetTests(CatalogClockTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+        self.url = '/product/%d/' % self.product.pk
+        self.etag = self.client.get(self.url)['ETag']
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_changing_the_product_changes_the_etag(self):
+        self.product.price = Decimal('90.00')
+        with self.committed():
+            self.product.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag).status_code, 200)
+
+    def test_other_products_leave_the_etag_alone(self):
+        with self.committed():
+            make_product(name='Blouse')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag).status_code, 304)
+
+    def test_each_viewer_gets_their_own_etag(self):
+        self.client.force_login(make_user())
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag).status_code, 200)
+
+    def test_pending_message_is_never_swallowed(self):
+        self.client.get('/add-to-cart/%d/' % self.product.pk)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class CartConstraintTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.product = make_product()
+        self.cart = carts.get_cart(self.user)
+
+    def test_one_cart_per_user(self):
+        self.assertEqual(carts.get_cart(self.user), self.cart)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user)
+
+    def test_one_line_per_product(self):
+        carts.add_item(self.cart, self.product.pk)
+        carts.add_item(self.cart, self.product.pk, 2)
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'quantity')), [(self.product.pk, 3)])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartItem.objects.create(cart=self.cart, product=self.product)
+
+    def test_backends_without_upserts_increment_too(self):
+        other_backend = {connection.alias: mock.Mock(vendor='mysql', alias=connection.alias)}
+        with mock.patch.object(carts, 'connections', other_backend), self.settings(CART_MAX_QUANTITY=4):
+            carts.add_item(self.cart, self.product.pk, 3)
+            carts.add_item(self.cart, self.product.pk, 3)
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'quantity')), [(self.product.pk, 4)])
+
+    def test_add_to_cart_is_one_statement(self):
+        carts.add_item(self.cart, self.product.pk)
+        with self.assertNumQueries(1):
+            carts.add_item(self.cart, self.product.pk)
+
+
+class MergeDuplicateCartsTests(TransactionTestCase):
+    """0013 folds the duplicates 0014's constraints would reject"""
+    before = [('Fliq', '0012_catalog_updated_at')]
+    after = [('Fliq', '0014_cart_constraints')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_extra_carts_and_lines_are_merged(self):
+        apps = self.migrate(self.before)
+        user = apps.get_model('auth', 'User').objects.create(username='buyer')
+        category = apps.get_model('Fliq', 'Category').objects.create(name='Shirts', slug='shirts')
+        product = apps.get_model('Fliq', 'Product').objects.create(
+            name='Shirt', description='', image='products/shirt.jpg', price=Decimal('100.00'), category=category, stock=5,
+        )
+        Cart, CartItem = apps.get_model('Fliq', 'Cart'), apps.get_model('Fliq', 'CartItem')
+        oldest, newer = Cart.objects.create(user=user), Cart.objects.create(user=user)
+        CartItem.objects.create(cart=oldest, product=product, quantity=1)
+        CartItem.objects.create(cart=newer, product=product, quantity=2)
+        CartItem.objects.create(cart=newer, product=product, quantity=3)
+
+        apps = self.migrate(self.after)
+        self.assertEqual(list(apps.get_model('Fliq', 'Cart').objects.values_list('id', flat=True)), [oldest.pk])
+        self.assertEqual(
+            list(apps.get_model('Fliq', 'CartItem').objects.values_list('cart_id', 'product_id', 'quantity')),
+            [(oldest.pk, product.pk, 6)],
+        )
+
+
+class OrderHistoryTests(CheckoutTestCase):
+    def test_order_keeps_the_name_and_price_it_was_placed_at(self):
+        payment = self.checkout()
+        Product.objects.filter(pk=self.product.pk).update(name='Blouse', price=Decimal('150.00'))
+        item = Order.objects.get(reference=payment.reference).items.get()
+        self.assertEqual((item.product_name, item.unit_price, item.quantity), ('Shirt', Decimal('100.00'), 2))
+
+    def test_history_is_newest_first_in_two_queries(self):
+        references = []
+        for _order in range(3):
+            references.append(payments.start_payment(self.user, self.cart, PHONE_NUMBER).reference)
+            make_cart(self.user, {self.product: 1})
+        other = make_user('other')
+        orders.place_order(other, make_cart(other, {self.product: 1}), 'OTHER')
+        with self.assertNumQueries(2):
+            page = orders.order_history(self.user, page_size=2)
+            self.assertEqual([len(order.items.all()) for order in page], [1, 1])
+        older = orders.order_history(self.user, cursor=page.next_cursor, page_size=2)
+        self.assertEqual([order.reference for order in page] + [order.reference for order in older], references[::-1])
+
+    def test_history_page(self):
+        self.checkout()
+        self.client.force_login(self.user)
+        response = self.client.get('/orders/')
+        self.assertContains(response, 'Shirt')
+        self.assertContains(response, 'Ksh.200.00')
+        self.client.logout()
+        self.assertEqual(self.client.get('/orders/').status_code, 302)
+
+
+class BenchmarkBaselineTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.command = benchmark.Command(stdout=io.StringIO())
+        self.command.write(self.baseline, self.report(product_list=5, checkout=30))
+
+    def report(self, seed=42, **queries):
+        return {
+            'config': {'categories': 10, 'products': 2000, 'users': 50, 'lines': 10, 'seed': seed},
+            'results': {view: {'queries': count} for view, count in queries.items()},
+        }
+
+    def test_only_views_over_their_baseline_are_regressions(self):
+        report = self.report(product_list=6, checkout=30, cart_view=50)
+        self.assertEqual(self.command.compare(report, self.baseline, 0), ['product_list: 6 queries (baseline 5)'])
+        self.assertEqual(self.command.compare(report, self.baseline, 1), [])
+
+    def test_other_options_are_warned_about(self):
+        self.command.compare(self.report(seed=7, product_list=5), self.baseline, 0)
+        self.assertIn('different options', self.command.stdout.getvalue())
+
+    def test_percentiles_pick_the_nearest_rank(self):
+        samples = list(range(1, 101))
+        self.assertEqual([benchmark.percentile(samples, fraction) for fraction in (0.5, 0.9, 0.99)], [51, 90, 99])
+
+
+class InstrumentationTests(ShopTestCase):
+    def series(self, name, labels):
+        return instrumentation.collect().get((name, labels))
+
+    def observed(self, name, labels):
+        """(observations, sum) of a histogram series"""
+        values = self.series(name, labels) or [0, 0]
+        return sum(values[:-1]), values[-1]
+
+    def test_requests_are_timed_and_their_queries_counted(self):
+        product = make_product()
+        self.client.get('/product/%d/' % product.pk)
+        before = self.observed('fliq_http_request_db_queries', ('product_detail',))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/product/%d/' % product.pk, HTTP_IF_NONE_MATCH='"stale"')
+        after = self.observed('fliq_http_request_db_queries', ('product_detail',))
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, len(queries)))
+        self.assertIsNotNone(self.series('fliq_http_request_duration_seconds', ('product_detail', 'GET', '200')))
+
+    def test_labels_cannot_be_minted_by_clients(self):
+        self.client.generic('BREW', '/no-such-page/')
+        self.assertIsNotNone(self.series('fliq_http_request_duration_seconds', ('<unresolved>', 'OTHER', '404')))
+
+    @override_settings(SLOW_REQUEST_QUERIES=1, **TEST_SETTINGS)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        make_product()
+        with self.assertLogs('default', 'WARNING') as logs:
+            self.client.get('/')
+        self.assertIn('Slow request GET / (home)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_exposition_format(self):
+        totals = {
+            ('fliq_http_request_db_queries', ('say "hi"\n',)): [1, 0, 2] + [0] * 7 + [13],
+            ('fliq_mpesa_call_errors_total', ('stk_push',)): [3],
+        }
+        text = instrumentation.render(totals)
+        self.assertIn('fliq_http_request_db_queries_bucket{view="say \\"hi\\"\\n",le="1"} 1', text)
+        self.assertIn('fliq_http_request_db_queries_bucket{view="say \\"hi\\"\\n",le="2"} 3', text)
+        self.assertIn('fliq_http_request_db_queries_count{view="say \\"hi\\"\\n"} 3', text)
+        self.assertIn('fliq_mpesa_call_errors_total{endpoint="stk_push"} 3', text)
+        self.assertIn('# TYPE fliq_http_request_db_seconds histogram', text)
+
+    def test_processes_are_summed_from_the_metrics_directory(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'metrics-other.json'), 'w') as other:
+            json.dump([['fliq_mpesa_call_retries_total', ['stk_query'], [2]], ['unknown_metric', [], [1]]], other)
+        key = ('fliq_mpesa_call_retries_total', ('stk_query',))
+        before = (self.series(*key) or [0])[0]
+        with self.settings(METRICS_DIR=directory):
+            instrumentation.registry.inc(*key)
+            totals = instrumentation.collect()
+        self.assertEqual(totals[key], [before + 1 + 2])
+        self.assertNotIn(('unknown_metric', ()), totals)
+
+    @override_settings(METRICS_TOKEN='secret', **TEST_SETTINGS)
+    def test_metrics_endpoint_needs_the_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE fliq_http_request_duration_seconds histogram', response.content)
+
+    @override_settings(METRICS_TOKEN='', **TEST_SETTINGS)
+    def test_metrics_endpoint_is_staff_only_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.login(username='staff', password='secret')
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class AsyncViewTests(ShopTestCase):
+    """The catalog and cart URLs served by async_views, as under ASGI"""
+
+    def setUp(self):
+        super().setUp()
+        for pattern in urls.urlpatterns:
+            view = getattr(async_views, getattr(pattern.callback, '__name__', ''), None)
+            if view is not None:
+                patcher = mock.patch.object(pattern, 'callback', view)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+        self.product = make_product()
+        self.user = make_user()
+
+    async def test_catalog_pages(self):
+        response = await self.async_client.get('/')
+        self.assertIs(response.resolver_match.func, async_views.product_list)
+        self.assertContains(response, 'Shirt')
+        self.assertIn('no-cache', response['Cache-Control'])
+        revisit = await self.async_client.get('/', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(revisit.status_code, 304)
+        detail = await self.async_client.get('/product/%d/' % self.product.pk)
+        self.assertContains(detail, 'Shirt')
+        self.assertEqual((await self.async_client.get('/product/%d/' % (self.product.pk + 1))).status_code, 404)
+
+    async def test_cart(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get('/add-to-cart/%d/' % self.product.pk)
+        self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+        response = await self.async_client.get('/cart/')
+        self.assertEqual(response.context['total'], Decimal('102.50'))
+
+    async def test_guest_cart(self):
+        await self.async_client.get('/add-to-cart/%d/' % self.product.pk)
+        response = await self.async_client.get('/cart/')
+        self.assertEqual(response.context['total'], Decimal('102.50'))
+        self.assertFalse(await Cart.objects.aexists())
+
+
+class DatabaseProfileTests(TransactionTestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_sqlite_connections_are_tuned_as_they_open(self):
+        connection.close()
+        pragmas = settings.SQLITE_PRAGMAS
+        self.assertEqual(self.pragma('journal_mode'), pragmas['journal_mode'])
+        self.assertEqual(self.pragma('busy_timeout'), pragmas['busy_timeout'])
+        self.assertEqual(self.pragma('mmap_size'), pragmas['mmap_size'])
+
+    def test_transactions_take_the_write_lock_up_front(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record), transaction.atomic():
+            Product.objects.count()
+        self.assertEqual(statements[0], 'BEGIN IMMEDIATE')
+
+    def test_other_backends_are_left_alone(self):
+        other = mock.Mock(vendor='postgresql')
+        database.configure_connection(None, other)
+        other.connection.execute.assert_not_called()
+
+    def test_connections_persist_and_are_checked(self):
+        self.assertGreater(connection.settings_dict['CONN_MAX_AGE'], 0)
+        self.assertTrue(connection.settings_dict['CONN_HEALTH_CHECKS'])
+
+
+class SessionStorageTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+
+    def test_anonymous_visitors_get_no_session(self):
+        self.client.get('/')
+        response = self.client.get('/add-to-cart/%d/' % self.product.pk, follow=True)
+        self.assertEqual([str(message) for message in response.context['messages']], ['Product added to cart.'])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertFalse(Session.objects.exists())
+
+    def test_logged_in_requests_read_the_session_from_the_cache(self):
+        make_user()
+        self.client.post('/login/', {'username': 'buyer', 'password': 'secret'})
+        self.assertTrue(Session.objects.exists())
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/cart/')
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+
+    def test_purge_deletes_expired_sessions_in_batches(self):
+        now = payments.timezone.now()
+        Session.objects.bulk_create(
+            [Session(session_key='old%d' % number, session_data='', expire_date=now - timedelta(days=1)) for number in range(5)]
+            + [Session(session_key='live', session_data='', expire_date=now + timedelta(days=1))]
+        )
+        out = io.StringIO()
+        call_command('purge_expired_sessions', '--batch-size', '2', '--pause', '0', stdout=out)
+        self.assertIn('Purged 5 expired sessions.', out.getvalue())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+
+
+class GuestCartTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt = make_product()
+        self.socks = make_product(name='Socks', price='50.00')
+
+    def set_cookie(self, pairs):
+        self.client.cookies[guest_cart.COOKIE] = signing.dumps(pairs, salt=guest_cart.SALT, compress=True)
+
+    def quantities(self):
+        return guest_cart.GuestCart.from_request(mock.Mock(COOKIES={
+            guest_cart.COOKIE: self.client.cookies[guest_cart.COOKIE].value,
+        })).quantities
+
+    def test_adding_keeps_the_cart_in_a_signed_cookie(self):
+        self.client.get('/add-to-cart/%d/' % self.shirt.pk)
+        self.client.get('/add-to-cart/%d/' % self.shirt.pk)
+        self.assertEqual(self.quantities(), {self.shirt.pk: 2})
+        self.assertFalse(Cart.objects.exists())
+        response = self.client.get('/cart/')
+        self.assertEqual(response.context['subtotal'], Decimal('200.00'))
+
+    def test_tampered_cookie_is_dropped(self):
+        self.client.cookies[guest_cart.COOKIE] = 'not-signed'
+        response = self.client.get('/cart/')
+        self.assertEqual(response.context['cart_items'], [])
+        self.assertEqual(response.cookies[guest_cart.COOKIE].value, '')
+
+    def test_out_of_range_lines_are_dropped(self):
+        self.set_cookie([[self.shirt.pk, 2], [self.socks.pk, settings.CART_MAX_QUANTITY + 1], [0, 1], [2 ** 63, 1]])
+        response = self.client.get('/cart/')
+        self.assertEqual([item.product for item in response.context['cart_items']], [self.shirt])
+        self.assertEqual(self.quantities(), {self.shirt.pk: 2})
+
+    @override_settings(GUEST_CART_MAX_LINES=1)
+    def test_a_full_cart_takes_no_new_products(self):
+        self.client.get('/add-to-cart/%d/' % self.shirt.pk)
+        response = self.client.get('/add-to-cart/%d/' % self.socks.pk, follow=True)
+        self.assertEqual(
+            [str(message) for message in response.context['messages']][-1], 'Your cart is full. Log in to add more products.',
+        )
+        self.assertEqual(self.quantities(), {self.shirt.pk: 1})
+        self.client.get('/add-to-cart/%d/' % self.shirt.pk)
+        self.assertEqual(self.quantities(), {self.shirt.pk: 2})
+
+    def test_deleted_products_are_forgotten(self):
+        self.set_cookie([[self.shirt.pk, 1], [self.socks.pk, 3]])
+        self.socks.delete()
+        with self.assertNumQueries(1):
+            response = self.client.get('/cart/')
+        self.assertEqual(response.context['subtotal'], Decimal('100.00'))
+        self.assertEqual(self.quantities(), {self.shirt.pk: 1})
+
+    def test_update_and_remove_address_lines_by_product_id(self):
+        self.set_cookie([[self.shirt.pk, 1], [self.socks.pk, 3]])
+        response = self.client.post(
+            '/update-cart/', {'items': [{'id': self.shirt.pk, 'quantity': 4}]}, content_type='application/json',
+        )
+        self.assertEqual(response.json(), {'updated': 1, 'removed': 0})
+        self.client.get('/remove-from-cart/%d/' % self.socks.pk)
+        self.assertEqual(self.quantities(), {self.shirt.pk: 4})
+
+    def test_login_merges_the_guest_cart(self):
+        user = make_user()
+        make_cart(user, {self.shirt: settings.CART_MAX_QUANTITY - 1})
+        self.set_cookie([[self.shirt.pk, 5], [self.socks.pk, 2]])
+        response = self.client.post('/login/', {'username': 'buyer', 'password': 'secret'})
+        self.assertEqual(response.cookies[guest_cart.COOKIE].value, '')
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart__user=user).values_list('product_id', 'quantity')),
+            {self.shirt.pk: settings.CART_MAX_QUANTITY, self.socks.pk: 2},
+        )
@@ -1,18 +1,43 @@
-from django.urls import path
-from . import views
+from django.conf import settings
+from django.urls import path, re_path, register_converter
+from django.urls.converters import IntConverter
+from . import async_views, views
+from .pagination import MAX_INTEGER
+
+# the catalog and cart views have async versions for ASGI deployments
+catalog = async_views if settings.ASYNC_VIEWS else views
+
+
+class IdConverter(IntConverter):
+    """A row id: 404 for numbers too large for any id column instead of a database error"""
+
+    def to_python(self, value):
+        value = int(value)
+        if value > MAX_INTEGER:
+            raise ValueError(value)
+        return value
+
+
+register_converter(IdConverter, 'id')
 
 urlpatterns = [
-    path('', views.product_list, name='home'), 
+    path('', catalog.product_list, name='home'), 
     path('register/', views.register, name='register'), 
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('profile/', views.profile, name='profile'),
-    path('category/slug:category_slug/', views.product_list, name='product_list_by_category'),
-    path('product/<int:product_id>/', views.product_detail, name='product_detail'),
-    path('cart/', views.cart_view, name='cart_view'),
-    path('add-to-cart/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
-    path('remove-from-cart/<int:cart_item_id>/', views.remove_from_cart, name='remove_from_cart'),
+    path('category/slug:category_slug/', catalog.product_list, name='product_list_by_category'),
+    path('search/', views.product_search, name='product_search'),
+    path('product/<id:product_id>/', catalog.product_detail, name='product_detail'),
+    path('cart/', catalog.cart_view, name='cart_view'),
+    path('add-to-cart/<id:product_id>/', catalog.add_to_cart, name='add_to_cart'),
+    path('remove-from-cart/<id:cart_item_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('update-cart/', views.update_cart, name='update_cart'),
     path('checkout/', views.checkout, name='checkout'),
+    path('payment/<str:reference>/', views.payment_status, name='payment_status'),
+    path('orders/', views.order_history, name='order_history'),
+    path('metrics', views.metrics, name='metrics'),
+    re_path(r'^feeds/products\.(?P<fmt>csv|json|xml)$', views.product_feed, name='product_feed'),
     path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
+    path('mpesa/metrics/', views.mpesa_metrics, name='mpesa_metrics'),
 ]
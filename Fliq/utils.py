@@ -1,14 +1,26 @@
+import asyncio
 import logging
+import os
+import random
+import threading
 import time
 import math
 import base64
+import weakref
 import requests
+import urllib3
 
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests import Response
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
 from LaFliq.settings import env
+from . import instrumentation
 from .models import *
 from .exceptions import *
 
@@ -38,72 +50,325 @@ def mpesa_response(r):
 	return r
 
 
+class RequestNotSent(requests.exceptions.ConnectionError):
+	"""No connection could be made, so the server never saw the request"""
+
+
+def connection_failed(err):
+	"""Whether a requests exception happened before the request left us"""
+	if isinstance(err, requests.exceptions.ConnectTimeout):
+		return True
+	reason = getattr(err.args[0], 'reason', None) if err.args else None
+	# refused connections and DNS failures; NewConnectionError subclasses ConnectTimeoutError
+	return isinstance(err, requests.exceptions.ConnectionError) and isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+def requests_response(res):
+	"""
+	Copy an httpx.Response into a requests.Response so the async calls
+	hand back the same MpesaResponse objects as the sync ones
+	"""
+	response = Response()
+	response.status_code = res.status_code
+	response.reason = res.reason_phrase
+	response.url = str(res.url)
+	response.headers.update(res.headers)
+	response.encoding = res.encoding
+	response._content = res.content
+	return response
+
+
+
+class GatewayMetrics:
+    """
+    Thread-safe per-endpoint call, error and latency counters for the
+    Daraja client. `snapshot()` returns a plain dict for monitoring.
+    """
+    # upper bounds (seconds) of the latency histogram buckets
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, seconds, error=False, retries=0):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'seconds_total': 0.0,
+                    'seconds_max': 0.0,
+                    'buckets': [0] * len(self.LATENCY_BUCKETS),
+                }
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['retries'] += retries
+            stats['seconds_total'] += seconds
+            stats['seconds_max'] = max(stats['seconds_max'], seconds)
+            for index, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][index] += 1
+        instrumentation.observe_gateway_call(endpoint, seconds, error=error, retries=retries)
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(stats, buckets=list(stats['buckets'])) for endpoint, stats in self._endpoints.items()}
+
+
+gateway_metrics = GatewayMetrics()
+
+
+class AccessTokenProvider:
+    """
+    Daraja OAuth token shared by every worker process through the Django cache.
+
+    Each process keeps a local copy and treats it as fresh until
+    `refresh_margin` seconds (plus a per-process random jitter) before it
+    expires, so tokens are renewed ahead of time and workers don't all reach
+    the refresh point together. Only the worker holding the cache lock
+    fetches a new token; the rest keep using the current one or wait for it.
+    The lock is exact on memcached, redis and database caches and
+    best-effort on the file cache.
+    """
+    cache_key = 'mpesa:access_token'
+    lock_key = 'mpesa:access_token:lock'
+
+    def __init__(self, fetch, cache_alias=None, refresh_margin=None, jitter=None, lock_timeout=30):
+        self.fetch = fetch
+        self.cache = caches[cache_alias or getattr(settings, 'MPESA_TOKEN_CACHE', 'default')]
+        if refresh_margin is None:
+            refresh_margin = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)
+        if jitter is None:
+            jitter = getattr(settings, 'MPESA_TOKEN_REFRESH_JITTER', 60)
+        self.refresh_before = refresh_margin + random.uniform(0, jitter)
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def _is_fresh(self, entry, now):
+        return entry is not None and now < entry['expires_at'] - self.refresh_before
+
+    def _is_valid(self, entry, now):
+        return entry is not None and now < entry['expires_at']
+
+    def local_token(self):
+        """This process's token if it is still fresh, without touching the cache or network"""
+        entry = self._entry
+        return entry['token'] if self._is_fresh(entry, time.time()) else None
+
+    def get_token(self):
+        entry = self._entry
+        if self._is_fresh(entry, time.time()):
+            return entry['token']
+        with self._lock:
+            entry = self._entry
+            if not self._is_fresh(entry, time.time()):
+                shared = self.cache.get(self.cache_key)
+                if self._is_fresh(shared, time.time()):
+                    entry = shared
+                else:
+                    entry = self._refresh(shared or entry)
+                self._entry = entry
+            return entry['token']
+
+    def invalidate(self):
+        """Drop the token everywhere, e.g. after Daraja rejected it"""
+        with self._lock:
+            self._entry = None
+            self.cache.delete(self.cache_key)
+
+    def _refresh(self, current):
+        locked = self.cache.add(self.lock_key, os.getpid(), timeout=self.lock_timeout)
+        if not locked:
+            # another worker is already refreshing
+            if self._is_valid(current, time.time()):
+                return current
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.1)
+                shared = self.cache.get(self.cache_key)
+                if self._is_valid(shared, time.time()):
+                    return shared
+        try:
+            token, expires_in = self.fetch()
+        except Exception as err:
+            if self._is_valid(current, time.time()):
+                logging.error("Error refreshing access token, reusing current one: {}".format(err))
+                return current
+            raise
+        finally:
+            if locked:
+                self.cache.delete(self.lock_key)
+        entry = {'token': token, 'expires_at': time.time() + expires_in}
+        self.cache.set(self.cache_key, entry, timeout=expires_in)
+        return entry
+
 
 class MpesaGateWay:
+    # environment variables the gateway cannot work without
+    REQUIRED_SETTINGS = (
+        "business_shortcode",
+        "consumer_key",
+        "consumer_secret",
+        "access_token_url",
+        "pass_key",
+        "checkout_url",
+    )
+
     business_shortcode = None
     consumer_key = None
     consumer_secret = None
     access_token_url = None
-    access_token = None
-    access_token_expiration = None
+    pass_key = None
     checkout_url = None
+    query_url = None
     timestamp = None
 
 
     def __init__(self):
-        now = datetime.now()
-        self.business_shortcode = env("business_shortcode")
-        self.consumer_key = env("consumer_key")
-        self.consumer_secret = env("consumer_secret")
-        self.access_token_url = env("access_token_url")
-    
-        self.password = self.generate_password()
-        self.checkout_url = env("checkout_url")
+        """
+        Read and validate the M-Pesa settings. No network I/O happens here;
+        the access token is fetched on the first API call.
+        """
+        config = self.load_settings()
+        self.business_shortcode = config["business_shortcode"]
+        self.consumer_key = config["consumer_key"]
+        self.consumer_secret = config["consumer_secret"]
+        self.access_token_url = config["access_token_url"]
+        self.pass_key = config["pass_key"]
+        self.checkout_url = config["checkout_url"]
+        self.query_url = config["stk_query_url"]
 
-        try:
-            self.access_token = self.getAccessToken()
-            
-            if self.access_token is None:
-                raise Exception("Request for access token failed.")
-        except Exception as e:
-            logging.error("Error {}".format(e))
-            #print("Hellen")
-        else:
-            self.access_token_expiration = time.time() + 3400
+        self.password = self.generate_password()
+        self.token_provider = AccessTokenProvider(self.fetchAccessToken)
 
-    def getAccessToken(self):
+        self.timeout = (
+            getattr(settings, 'MPESA_CONNECT_TIMEOUT', 3.05),
+            getattr(settings, 'MPESA_READ_TIMEOUT', 30),
+        )
+        self.max_retries = getattr(settings, 'MPESA_MAX_RETRIES', 2)
+        self.retry_backoff = getattr(settings, 'MPESA_RETRY_BACKOFF', 0.5)
+        self.session = self.build_session(getattr(settings, 'MPESA_POOL_SIZE', 10))
+        self.async_pool_size = getattr(settings, 'MPESA_ASYNC_POOL_SIZE', 100)
+        # an httpx.AsyncClient is bound to the event loop it was first used on
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def load_settings(cls):
+        config = {name: env.str(name, default="").strip() for name in cls.REQUIRED_SETTINGS}
+        missing = [name for name, value in config.items() if not value]
+        if missing:
+            raise MpesaConfigurationException("Missing M-Pesa settings: {}".format(", ".join(missing)))
+        # the query endpoint lives next to the STK push one unless configured
+        config["stk_query_url"] = env.str("stk_query_url", default="").strip() or config["checkout_url"].replace(
+            "stkpush/v1/processrequest", "stkpushquery/v1/query"
+        )
+        return config
+
+    @staticmethod
+    def build_session(pool_size):
+        """A keep-alive session so calls reuse pooled TCP/TLS connections"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=False)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def request(self, endpoint, method, url, idempotent=False, **kwargs):
+        """
+        Send a request on the pooled session with connect/read timeouts.
+        Idempotent calls are retried on connection errors, 429 and 5xx with
+        exponential backoff and jitter, at most `max_retries` times; others
+        are attempted exactly once. Latency and errors are recorded per
+        endpoint in gateway_metrics.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        started = time.perf_counter()
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as err:
+                if last_attempt:
+                    gateway_metrics.observe(endpoint, time.perf_counter() - started, error=True, retries=attempt)
+                    if connection_failed(err):
+                        raise RequestNotSent(str(err)) from err
+                    raise
+            else:
+                if last_attempt or not (res.status_code == 429 or res.status_code >= 500):
+                    gateway_metrics.observe(endpoint, time.perf_counter() - started, error=not res.ok, retries=attempt)
+                    return res
+            time.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def async_client(self):
+        """The keep-alive httpx.AsyncClient for the running event loop"""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            connect_timeout, read_timeout = self.timeout
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.async_pool_size, max_keepalive_connections=self.async_pool_size),
+            )
+        return client
+
+    async def arequest(self, endpoint, method, url, idempotent=False, **kwargs):
+        """
+        `request` for coroutines, sent with httpx so waiting on Daraja holds
+        no thread. Same retry policy and metrics; returns a requests.Response.
+        """
+        import httpx
+
+        client = self.async_client()
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        started = time.perf_counter()
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                res = await client.request(method, url, **kwargs)
+            except httpx.TransportError as err:
+                if last_attempt:
+                    gateway_metrics.observe(endpoint, time.perf_counter() - started, error=True, retries=attempt)
+                    if isinstance(err, (httpx.ConnectError, httpx.ConnectTimeout)):
+                        raise RequestNotSent(str(err)) from err
+                    raise requests.exceptions.ConnectionError(str(err)) from err
+            else:
+                if last_attempt or not (res.status_code == 429 or res.status_code >= 500):
+                    gateway_metrics.observe(endpoint, time.perf_counter() - started, error=res.is_error, retries=attempt)
+                    return requests_response(res)
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def fetchAccessToken(self):
+        """Request a new OAuth token from Daraja, returning (token, expires_in)"""
         try:
-            res = requests.get(self.access_token_url, auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret))
-            print(res)
+            res = self.request("access_token", "GET", self.access_token_url, idempotent=True, auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret))
+            res.raise_for_status()
+            json_response = res.json()
         except Exception as err:
-            logging.error("Error {}".format(err))
-            #raise err
-        else:
-            token = res.json()["access_token"]
-            self.headers = {"Authorization": "Bearer %s" % token}
-            return token
-
-    class Decorators:
-        @staticmethod
-        def refreshToken(decorated):
-            def wrapper(gateway, *args, **kwargs):
-                if (gateway.access_token_expiration and time.time() > gateway.access_token_expiration):
-                    token = gateway.getAccessToken()
-                    gateway.access_token = token
-                return decorated(gateway, *args, **kwargs)
+            raise MpesaConnectionError("Request for access token failed: {}".format(err))
+        return json_response["access_token"], int(json_response.get("expires_in", 3599))
 
-            return wrapper
+    def getAccessToken(self):
+        return self.token_provider.get_token()
 
+    @property
+    def headers(self):
+        return {"Authorization": "Bearer %s" % self.getAccessToken()}
 
     def generate_password(self):
         """Generates mpesa api password using the provided shortcode and passkey"""
         self.timestamp = now.strftime("%Y%m%d%H%M%S")
-        password_str = env("business_shortcode") + env("pass_key") + self.timestamp
+        password_str = self.business_shortcode + self.pass_key + self.timestamp
         password_bytes = password_str.encode("ascii")
         return base64.b64encode(password_bytes).decode("utf-8")
 
-    @Decorators.refreshToken
-    def stk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
+    def stk_push_data(self, phone_number, amount, callback_url, account_reference, transaction_desc):
         if str(account_reference).strip() == '':
             raise MpesaInvalidParameterException('Account reference cannot be blank')
         if str(transaction_desc).strip() == '':
@@ -132,79 +397,85 @@ class MpesaGateWay:
             "TransactionDesc": transaction_desc,
             
         }
+        return req_data
+
+    def stk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
+        req_data = self.stk_push_data(phone_number, amount, callback_url, account_reference, transaction_desc)
 
         try:
-            res = requests.post(self.checkout_url, json=req_data, headers=self.headers)
+            headers = self.headers
+        except Exception as ex:
+            # nothing was sent, so this one is safe to retry
+            raise MpesaConnectionError(str(ex))
+        try:
+            res = self.request("stk_push", "POST", self.checkout_url, json=req_data, headers=headers)
+            if res.status_code == 401:
+                # the token was refused before the push was looked at, so nothing reached the phone
+                self.token_provider.invalidate()
+                raise MpesaConnectionError('Access token rejected')
             response = mpesa_response(res)
 
             return response
-        except requests.exceptions.ConnectionError:
+        except RequestNotSent:
             raise MpesaConnectionError('Connection failed')
+        except MpesaConnectionError:
+            raise
         except Exception as ex:
-            raise MpesaConnectionError(str(ex))
-    """
-        logging.info("Mpesa request data {}".format(req_data))
-        logging.info("Mpesa response info {}".format(res_data))
+            # a timeout or dropped connection after sending: the prompt may be on the phone
+            raise MpesaUnknownResultError(str(ex))
 
-        if res.ok:
-            data["checkout_request_id"] = res_data["CheckoutRequestID"]
+    async def astk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
+        """`stk_push` for coroutines; only a token refresh, which is rare, takes a thread"""
+        req_data = self.stk_push_data(phone_number, amount, callback_url, account_reference, transaction_desc)
 
-            Transaction.objects.create(**data)
-        print(self.headers)
-        return res_data
-    
-    def check_status(self, data):
         try:
-            status = data["Body"]["stkCallback"]["ResultCode"]
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            status = 1
-        return status
-
-    def get_transaction_object(data):
-        checkout_request_id = data["Body"]["stkCallback"]["CheckoutRequestID"]
-        transaction, _ = Transaction.objects.get_or_create(
-            checkout_request_id=checkout_request_id
-        )
-
-        return transaction
-
-    def handle_successful_pay(self, data, transaction):
-        items = data["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
-        for item in items:
-            if item["Name"] == "Amount":
-                amount = item["Value"]
-            elif item["Name"] == "MpesaReceiptNumber":
-                receipt_no = item["Value"]
-            elif item["Name"] == "PhoneNumber":
-                phone_number = item["Value"]
-
-        transaction.amount = amount
-        transaction.phone_number = PhoneNumber(raw_input=phone_number)
-        transaction.receipt_no = receipt_no
-        transaction.confirmed = True
-
-        return transaction
+            token = self.token_provider.local_token() or await sync_to_async(self.getAccessToken, thread_sensitive=False)()
+        except Exception as ex:
+            raise MpesaConnectionError(str(ex))
+        try:
+            res = await self.arequest(
+                "stk_push", "POST", self.checkout_url, json=req_data, headers={"Authorization": "Bearer %s" % token}
+            )
+            if res.status_code == 401:
+                self.token_provider.invalidate()
+                raise MpesaConnectionError('Access token rejected')
+            response = mpesa_response(res)
 
-    def callback_handler(self, data):
-        status = self.check_status(data)
-        transaction = self.get_transaction_object(data)
-        if status==0:
-            self.handle_successful_pay(data, transaction)
-        else:
-            transaction.status = 1
+            return response
+        except RequestNotSent:
+            raise MpesaConnectionError('Connection failed')
+        except MpesaConnectionError:
+            raise
+        except Exception as ex:
+            raise MpesaUnknownResultError(str(ex))
 
-        transaction.status = status
-        transaction.save()
+    def stk_query(self, checkout_request_id):
+        """
+        Ask Daraja for the status of an STK push. Safe to retry, so it is
+        sent as an idempotent call.
+        """
+        if str(checkout_request_id).strip() == '':
+            raise MpesaInvalidParameterException('Checkout request ID cannot be blank')
 
-        transaction_data = TransactionSerializer(transaction).data
+        req_data = {
+            "BusinessShortCode": self.business_shortcode,
+            "Password": self.password,
+            "Timestamp": self.timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
 
-        logging.info("Transaction completed info {}".format(transaction_data))
+        try:
+            res = self.request("stk_query", "POST", self.query_url, idempotent=True, json=req_data, headers=self.headers)
+            if res.status_code == 401:
+                self.token_provider.invalidate()
+            response = mpesa_response(res)
 
-        return Response({"status": "ok", "code": 0}, status=200)
+            return response
+        except requests.exceptions.ConnectionError:
+            raise MpesaConnectionError('Connection failed')
+        except Exception as ex:
+            raise MpesaConnectionError(str(ex))
 
-        """
-    @Decorators.refreshToken
     def c2b(self, amount, phone_number, bill_reference_number):
         if str(bill_reference_number).strip() == '':
             raise MpesaInvalidParameterException('Bill reference cannot be blank')
@@ -223,11 +494,30 @@ class MpesaGateWay:
         }
 
         try:
-            res = requests.post(self.checkout_url, json=req_data, headers=self.headers, timeout=30)
+            res = self.request("c2b", "POST", self.checkout_url, json=req_data, headers=self.headers)
+            if res.status_code == 401:
+                self.token_provider.invalidate()
             response = mpesa_response(res)
 
             return response
         except requests.exceptions.ConnectionError:
             raise MpesaConnectionError('Connection failed')
         except Exception as ex:
-            raise MpesaConnectionError(str(ex))
\ No newline at end of file
+            raise MpesaConnectionError(str(ex))
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    Return the process-wide MpesaGateWay, building it on first use so that
+    importing the app (migrate, shell, worker boot) never touches M-Pesa.
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = MpesaGateWay()
+    return _gateway
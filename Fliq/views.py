@@ -6,25 +6,36 @@ import base64
 import time
 import datetime
 import hashlib
+import hmac
 import json
 import logging
+from urllib.parse import urlencode
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
 from .forms import UserRegistrationForm, CheckoutForm, ProfileForm
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib import messages
-from .models import Product, Category, Cart, CartItem, Profile, Order
+from .models import Product, Category, Cart, CartItem, Profile, Order, PaymentTransaction
+from django.db import router
 from django.db.models import Subquery, OuterRef, Sum
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from .utils import MpesaGateWay
-
-cl = MpesaGateWay()
+from . import catalog_cache, feeds, instrumentation, orders, payments
+from .cart import add_item, apply_quantities, get_cart, summarize_cart
+from .guest_cart import GuestCart
+from .pagination import MAX_INTEGER, decode_cursor, get_page_size, ordering_fields, paginate
+from .search import search_products
+from .exceptions import EmptyCartError, InsufficientStockError
+from .utils import gateway_metrics
 
 # Create your views here.
 
@@ -50,8 +61,12 @@ def login_view(request):
         user = authenticate(request, username=username, password=password)
         if user is not None:
             login(request, user)
+            # whatever they picked before logging in joins their cart
+            guest_cart = GuestCart.from_request(request)
+            if guest_cart:
+                guest_cart.merge_into(get_cart(user))
             messages.success(request, 'You have been logged in.')
-            return redirect('home')
+            return guest_cart.save(redirect('home'))
         else:
             messages.error(request, 'Invalid login credentials.')
     return render(request, 'auth/login.html')
@@ -74,78 +89,241 @@ def profile(request):
         form = ProfileForm(instance=user.profile)
     return render(request, 'profile.html', {'form': form, 'user': user})
 
+# orderings offered on the catalog; each ends in a unique column so keyset pages are stable
+CATALOG_ORDERINGS = {
+    # newest listed first
+    'id': ('-id',),
+    'price': ('price', 'id'),
+}
+
+# the only Product columns the catalog grid renders
+CATALOG_FIELDS = ('id', 'name', 'price', 'stock', 'image', 'image_renditions')
+
+def grid_cursor(cursor, ordering):
+    """
+    (cursor, cache key parts) for a catalog grid page. The key is built from
+    the decoded cursor, so visitors can't mint cache keys with made-up
+    cursor strings; a cursor that doesn't decode is dropped, and the page
+    is the (cached) first page, which is what paginate would show for it.
+    """
+    direction, values = decode_cursor(cursor, ordering_fields(Product, ordering))
+    if direction is None:
+        return None, [ordering]
+    return cursor, [ordering, direction, values]
+
+
+def render_product_grid(page, query):
+    return render_to_string('product_grid.html', {
+        'products': page,
+        'page': page,
+        'search_query': query.get('q'),
+        'next_query': urlencode(dict(query, cursor=page.next_cursor)) if page.has_next else '',
+        'previous_query': urlencode(dict(query, cursor=page.previous_cursor)) if page.has_previous else '',
+    })
+
+def _page_versions(request, namespaces):
+    """
+    The cache version tokens of what a catalog page shows, read once per
+    request for both validators. Pages carrying a flash message get no
+    validators so the message is never swallowed by a 304, nor do pages that
+    a lagging read replica may still render from old rows.
+    """
+    if len(messages.get_messages(request)):
+        return None
+    if not hasattr(request, '_page_versions'):
+        request._page_versions = {}
+    key = tuple(namespaces)
+    if key not in request._page_versions:
+        request._page_versions[key] = catalog_cache.get_versions(namespaces)
+    versions = request._page_versions[key]
+    return versions if catalog_cache.settled(versions) else None
+
+def _page_etag(request, namespaces, *parts):
+    """
+    ETag for a catalog page: the cache version tokens of what it shows, the
+    URL and the viewer, since the navbar differs per user.
+    """
+    versions = _page_versions(request, namespaces)
+    if versions is None:
+        return None
+    viewer = request.user.pk if request.user.is_authenticated else 'anon'
+    key = ':'.join(str(part) for part in versions + [viewer, request.get_full_path()] + list(parts))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def _listing_etag(request):
+    return _page_etag(request, [catalog_cache.CATEGORIES, catalog_cache.PRODUCTS])
+
+def _listing_last_modified(request):
+    # the tokens rather than Max(updated_at), which deletes and category renames leave alone
+    versions = _page_versions(request, [catalog_cache.CATEGORIES, catalog_cache.PRODUCTS])
+    return catalog_cache.changed_at(versions) if versions is not None else None
+
+def _detail_etag(request, product_id):
+    return _page_etag(request, [catalog_cache.CATEGORIES, catalog_cache.product_namespace(product_id)])
+
+def _detail_last_modified(request, product_id):
+    if len(messages.get_messages(request)):
+        return None
+    row = Product.objects.filter(id=product_id).values_list('updated_at', 'category__updated_at').first()
+    return max(row) if row else None
+
+@cache_control(no_cache=True)
+@condition(etag_func=_listing_etag, last_modified_func=_listing_last_modified)
 def product_list(request):
+    categories = catalog_cache.categories()
     category_slug = request.GET.get('category')
+    products = Product.objects.all()
     if category_slug:
-        category = get_object_or_404(Category, slug=category_slug)
-        products = Product.objects.filter(category=category)
-    else:
-        products = Product.objects.all()
+        category = next((category for category in categories if category.slug == category_slug), None)
+        if category is None:
+            raise Http404('No such category')
+        products = products.filter(category_id=category.id)
+
+    sort = request.GET.get('sort')
+    if sort not in CATALOG_ORDERINGS:
+        sort = 'id'
+    page_size = get_page_size(request)
+    cursor, position = grid_cursor(request.GET.get('cursor'), CATALOG_ORDERINGS[sort])
+
+    query = {'sort': sort, 'page_size': page_size}
+    if category_slug:
+        query['category'] = category_slug
+
+    def grid():
+        page = paginate(products.only(*CATALOG_FIELDS), CATALOG_ORDERINGS[sort], cursor=cursor, page_size=page_size)
+        return render_product_grid(page, query)
 
-    categories = Category.objects.all()
     context = {
-        'products': products,
+        'grid': catalog_cache.cached('grid', [category_slug, page_size] + position, grid, [catalog_cache.PRODUCTS]),
         'categories': categories,
         'current_category': category_slug,
+        'current_sort': sort,
+        'page_size': page_size,
+    }
+    return render(request, 'home.html', context)
+
+def product_search(request):
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return redirect('home')
+
+    page_size = get_page_size(request)
+    page = search_products(query, cursor=request.GET.get('cursor'), page_size=page_size, fields=CATALOG_FIELDS)
+
+    context = {
+        'grid': render_product_grid(page, {'q': query, 'page_size': page_size}),
+        'categories': catalog_cache.categories(),
+        'search_query': query,
+        'page_size': page_size,
     }
     return render(request, 'home.html', context)
 
+@cache_control(no_cache=True)
+@condition(etag_func=_detail_etag, last_modified_func=_detail_last_modified)
 def product_detail(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
+    def body():
+        product = get_object_or_404(Product.objects.select_related('category'), id=product_id)
+        return render_to_string('product_detail_body.html', {'product': product})
+
+    # the detail body shows the category name, so it depends on both namespaces
+    depends_on = [catalog_cache.CATEGORIES, catalog_cache.product_namespace(product_id)]
     context = {
-        'product': product,
+        'body': catalog_cache.cached('product', [product_id], body, depends_on),
     }
     return render(request, 'product_detail.html', context)
 
 #cart
 
 def cart_view(request):
-    cart = Cart.objects.filter(user=request.user).first()
-    if not cart:
-        cart = Cart.objects.create(user=request.user)
-    cart_items = cart.cartitem_set.all()
-    subtotal = sum(item.get_total_cost() for item in cart_items)
-    tax = decimal.Decimal('0.025') * subtotal
-    tax = tax.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_HALF_UP)
-    total = subtotal + tax
-    total = total.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_HALF_UP)
-    context = {
-        'cart_items': cart_items,
-        'cart': cart,
-        'subtotal': subtotal,
-        'tax': tax,
-        'total': total,
-    }
+    if not request.user.is_authenticated:
+        guest_cart = GuestCart.from_request(request)
+        summary = guest_cart.summarize()
+        return guest_cart.save(render(request, 'shopping_cart.html', summary.as_context()))
+    cart = get_cart(request.user)
+    summary = summarize_cart(cart)
+    context = dict(summary.as_context(), cart=cart)
     return render(request, 'shopping_cart.html', context)
 
 def add_to_cart(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    cart = Cart.objects.filter(user=request.user).first()
-    if not cart:
-        cart = Cart.objects.create(user=request.user)
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
-    cart_item.quantity += 1
-    cart_item.save()
+    product = get_object_or_404(Product.objects.only('id'), id=product_id)
+    if not request.user.is_authenticated:
+        guest_cart = GuestCart.from_request(request)
+        if guest_cart.add(product.id):
+            messages.success(request, 'Product added to cart.')
+        else:
+            messages.error(request, 'Your cart is full. Log in to add more products.')
+        return guest_cart.save(redirect('cart_view'))
+    add_item(get_cart(request.user), product.id)
     messages.success(request, 'Product added to cart.')
     return redirect('cart_view')
 
 def remove_from_cart(request, cart_item_id):
-    cart_item = get_object_or_404(CartItem, id=cart_item_id)
+    if not request.user.is_authenticated:
+        # guest cart lines are addressed by product id
+        guest_cart = GuestCart.from_request(request)
+        guest_cart.remove(cart_item_id)
+        messages.success(request, 'Product removed from cart.')
+        return guest_cart.save(redirect('cart_view'))
+    cart_item = get_object_or_404(CartItem, id=cart_item_id, cart__user=request.user)
     cart_item.delete()
     messages.success(request, 'Product removed from cart.')
     return redirect('cart_view')
 
+def parse_cart_quantities(request):
+    """
+    Read {cart_item_id: quantity} from either the cart form (parallel
+    `cart_item`/`quantity` fields) or a JSON body shaped like
+    {"items": [{"id": 1, "quantity": 2}, ...]}.
+    Raises ValueError on malformed input, on ids no database column can
+    hold and on quantities outside 0..CART_MAX_QUANTITY.
+    """
+    if request.content_type == 'application/json':
+        payload = json.loads(request.body or b'{}')
+        pairs = [(item['id'], item['quantity']) for item in payload.get('items', [])]
+    else:
+        pairs = zip(request.POST.getlist('cart_item'), request.POST.getlist('quantity'))
+
+    quantities = {}
+    for item_id, quantity in pairs:
+        item_id, quantity = int(item_id), int(quantity)
+        if not 0 < item_id <= MAX_INTEGER:
+            raise ValueError('No such cart line')
+        if quantity < 0:
+            raise ValueError('Quantity cannot be negative')
+        if quantity > settings.CART_MAX_QUANTITY:
+            raise ValueError('Quantity is too large')
+        quantities[item_id] = quantity
+    return quantities
+
 def update_cart(request):
-    if request.method == 'POST':
-        cart_items = request.POST.getlist('cart_item')
-        quantities = request.POST.getlist('quantity')
-        for i in range(len(cart_items)):
-            cart_item = CartItem.objects.get(id=cart_items[i])
-            cart_item.quantity = quantities[i]
-            cart_item.save()
-        messages.success(request, 'Cart updated.')
+    if request.method != 'POST':
+        return redirect('cart_view')
+
+    is_json = request.content_type == 'application/json'
+    try:
+        quantities = parse_cart_quantities(request)
+    except (ValueError, TypeError, KeyError, AttributeError, OverflowError):
+        # OverflowError: int() of a JSON number too large for a float (1e400 is infinity)
+        if is_json:
+            return JsonResponse({'error': 'Invalid cart update.'}, status=400)
+        messages.error(request, 'Invalid cart update.')
         return redirect('cart_view')
 
+    if request.user.is_authenticated:
+        guest_cart = None
+        cart = Cart.objects.filter(user=request.user).first()
+        updated, removed = apply_quantities(cart, quantities) if cart else (0, 0)
+    else:
+        guest_cart = GuestCart.from_request(request)
+        updated, removed = guest_cart.apply_quantities(quantities)
+
+    if is_json:
+        response = JsonResponse({'updated': updated, 'removed': removed})
+    else:
+        messages.success(request, 'Cart updated.')
+        response = redirect('cart_view')
+    return guest_cart.save(response) if guest_cart is not None else response
+
 
 
 
@@ -155,10 +333,7 @@ def checkout(request):
         cart = Cart.objects.get(user=request.user)
     except Cart.DoesNotExist:
         return redirect('cart_view')
-    cart_items = cart.cartitem_set.all()
-    subtotal = sum(item.get_total_cost() for item in cart_items)
-    tax = round(subtotal * Decimal(0.025), 2)
-    total = subtotal + tax
+    summary = summarize_cart(cart)
 
     if request.method == 'POST':
         form = CheckoutForm(request.POST or None)
@@ -167,37 +342,120 @@ def checkout(request):
             profile = request.user.profile
             profile.phone_number = form.cleaned_data['phone_number']
             profile.save()
-            callback_url = "http://pos.pos.ocratsystems.co.ke/callback/"
-            account_reference = "LaFliq"
-            transaction_description = "Payment"
-
-            # Create the Mpesa transaction
-            response = cl.stk_push(phone_number=profile.phone_number, amount=int(total), callback_url=callback_url, account_reference=account_reference, transaction_desc=transaction_description)
-            
-            return HttpResponse(response)
-            
-            
-        else:
-            errors = form.errors
 
-            print(errors)
+            # Hold the stock, move the cart into an order and queue the STK push; a worker sends it.
+            # A repeated submit gets the payment its first submit started.
+            try:
+                payment = payments.start_payment(request.user, cart, profile.phone_number)
+            except InsufficientStockError:
+                messages.error(request, 'Some items in your cart are no longer in stock.')
+                return redirect('cart_view')
+            except EmptyCartError:
+                messages.error(request, 'Your cart is empty.')
+                return redirect('cart_view')
+
+            return redirect('payment_status', reference=payment.reference)
+    elif not summary.items:
+        messages.error(request, 'Your cart is empty.')
+        return redirect('cart_view')
     else:
         form = CheckoutForm()
 
-    return render(request, 'checkout.html', {'cart_items': cart_items, 'subtotal': subtotal, 'tax': tax, 'total': total, 'form': form})
+    return render(request, 'checkout.html', dict(summary.as_context(), form=form))
+
+
+@login_required
+def payment_status(request, reference):
+    payment = get_object_or_404(PaymentTransaction, reference=reference, user=request.user)
+    if request.headers.get('Accept') == 'application/json':
+        return JsonResponse({
+            'status': payment.status,
+            'description': payment.result_description,
+        })
+    return render(request, 'payment_status.html', {'payment': payment})
+
+@login_required
+def order_history(request):
+    page_size = get_page_size(request, default=10)
+    page = orders.order_history(request.user, cursor=request.GET.get('cursor'), page_size=page_size)
+    query = {'page_size': page_size}
+    context = {
+        'orders': page,
+        'page': page,
+        'next_query': urlencode(dict(query, cursor=page.next_cursor)) if page.has_next else '',
+        'previous_query': urlencode(dict(query, cursor=page.previous_cursor)) if page.has_previous else '',
+    }
+    return render(request, 'order_history.html', context)
+
+
+def _feed_state(request):
+    # computed once per request for both the ETag and Last-Modified checks
+    if not hasattr(request, '_feed_state'):
+        request._feed_state = feeds.catalog_state()
+    return request._feed_state
+
+def _feed_wants_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def _feed_etag(request, fmt):
+    version, _last_modified = _feed_state(request)
+    if version is None:
+        return None
+    return '%s-%s-%s' % (fmt, 'gz' if _feed_wants_gzip(request) else 'id', version)
+
+def _feed_last_modified(request, fmt):
+    return _feed_state(request)[1]
+
+@condition(etag_func=_feed_etag, last_modified_func=_feed_last_modified)
+def product_feed(request, fmt):
+    compress = _feed_wants_gzip(request)
+    # choose the replica now; the rows are only read once the response streams
+    using = router.db_for_read(Product)
+    response = StreamingHttpResponse(
+        feeds.product_feed(fmt, compress=compress, absolute_url=request.build_absolute_uri, using=using),
+        content_type=feeds.CONTENT_TYPES[fmt],
+    )
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'inline; filename="products.%s"' % fmt
+    return response
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint; requires `Authorization: Bearer <METRICS_TOKEN>`.
+    Without a METRICS_TOKEN only logged-in staff can read it.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        if not request.user.is_staff:
+            return HttpResponse(status=403)
+    elif not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return HttpResponse(status=401)
+    return HttpResponse(instrumentation.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def mpesa_metrics(request):
+    return JsonResponse(gateway_metrics.snapshot())
 
 
 @csrf_exempt
 def mpesa_callback(request):
     # Get the Mpesa response data
-    response = request.body.decode('utf-8')
-    data = json.loads(response)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        stk_callback = data['Body']['stkCallback']
+        if not isinstance(stk_callback['CheckoutRequestID'], str):
+            raise TypeError('CheckoutRequestID is not a string')
+        # result_code is an integer column
+        if not -2 ** 31 <= int(stk_callback['ResultCode']) < 2 ** 31:
+            raise ValueError('ResultCode out of range')
+    except (ValueError, KeyError, TypeError, OverflowError):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Rejected'}, status=400)
 
-    # Update the order status and transaction code
-    order = Order.objects.filter(user=request.user).last()
-    if order:
-        order.status = data['Body']['stkCallback']['ResultCode'] == 0 and 'shipped' or 'processing'
-        order.transaction_code = data['Body']['stkCallback']['CheckoutRequestID']
-        order.save()
+    # Record the result; stock is settled in the background
+    payments.apply_callback(stk_callback)
 
-    return HttpResponse(status=200)
\ No newline at end of file
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
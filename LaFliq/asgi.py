@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'LaFliq.settings')
+# serve the async catalog and cart views (Fliq/async_views.py)
+os.environ.setdefault('ASYNC_VIEWS', 'true')
 
 application = get_asgi_application()